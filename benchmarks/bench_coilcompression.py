@@ -0,0 +1,57 @@
+# Speedup against image error of SVD coil compression (utils.coilcompression) ahead of iterativeSENSE
+# on the bundled data/*.npz coil images (2x undersampled, coil maps estimated from the fully sampled data).
+#
+# usage: python benchmarks/bench_coilcompression.py [--virtual-coils 1 2 4] [--energy 0.9 0.95 0.99] [--max-iter 20]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.mri import mriForwardOp, mriAdjointOp, iterativeSENSE, fft2c, rss
+from utils.coilcompression import compress_coils
+from benchmarks.common import load_coil_images
+
+
+def reconstruct(kspace, smaps, mask, max_iter, coil_compression=None, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        img = iterativeSENSE(kspace, smaps, mask=mask, fwdop=mriForwardOp, adjop=mriAdjointOp, max_iter=max_iter,
+                             coil_compression=coil_compression)
+        times.append(time.perf_counter() - t)
+    return img, float(np.median(times))
+
+
+def run(virtual_coils, energies, max_iter, repeats):
+    for name, coil_imgs in load_coil_images().items():
+        coil_imgs = coil_imgs / np.amax(np.abs(coil_imgs))
+        combined = rss(coil_imgs)
+        smaps = (coil_imgs / np.maximum(combined, 1e-6)[..., np.newaxis]).astype(np.complex64)
+        mask = np.zeros(np.shape(coil_imgs), dtype=np.float32)
+        mask[:, ::2] = 1
+        Ny = np.shape(mask)[1]
+        mask[:, Ny//2 - 12:Ny//2 + 12] = 1
+        kspace = fft2c(coil_imgs) * mask
+        reference, t_ref = reconstruct(kspace, smaps, mask, max_iter, repeats=repeats)
+        Nc = np.shape(kspace)[-1]
+        print(f'{name}: {Nc} coils, {t_ref*1e3:.1f} ms')
+        settings = [('coils', n) for n in virtual_coils if n < Nc] + [('energy', e) for e in energies]
+        for kind, value in settings:
+            _, _, _, info = compress_coils(kspace, smaps, **({'n_virtual': value} if kind == 'coils' else {'energy': value}),
+                                           coil_axis=-1, mask=mask)
+            img, t = reconstruct(kspace, smaps, mask, max_iter, value, repeats)
+            err = np.linalg.norm(img - reference) / np.linalg.norm(reference)
+            print(f'  {kind}={value:<5} -> {info["virtual_coils"]} virtual coils ({info["energy"]*100:5.1f}% energy) | '
+                  f'{t*1e3:8.1f} ms, speedup x{t_ref/t:5.2f} | rel. error vs all coils {err:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coil compression: speedup against image error')
+    parser.add_argument('--virtual-coils', type=int, nargs='+', default=[1, 2, 3, 4, 6])
+    parser.add_argument('--energy', type=float, nargs='+', default=[0.9, 0.95, 0.99])
+    parser.add_argument('--max-iter', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    run(args.virtual_coils, args.energy, args.max_iter, args.repeats)
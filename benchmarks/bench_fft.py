@@ -0,0 +1,58 @@
+# Centered 2D FFT backends (utils.fftbackend) on [Nx, Ny, Nc, Nt] stacks: time per fft2c and
+# deviation from the NumPy reference, in double and single precision.
+#
+# usage: python benchmarks/bench_fft.py [--sizes 128 256] [--coils 8] [--nt 1 4] [--workers -1]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.fftbackend import NumpyFFTBackend, FFTBackend, CheckerboardFFTBackend
+from utils.precision import use_precision
+
+
+def timeit(fun, repeats):
+    fun()  # warm-up (plans, modulation patterns)
+    t = time.perf_counter()
+    for _ in range(repeats):
+        fun()
+    return (time.perf_counter() - t) / repeats
+
+
+def run(sizes, n_coils, nts, workers, repeats):
+    rng = np.random.default_rng(0)
+    backends = [('numpy', NumpyFFTBackend()), ('scipy', FFTBackend()), (f'scipy workers={workers}', FFTBackend(workers)),
+                ('checkerboard', CheckerboardFFTBackend()),
+                (f'checkerboard workers={workers}', CheckerboardFFTBackend(workers))]
+    for precision, dtype in (('double', np.complex128), ('single', np.complex64)):
+        with use_precision(precision):
+            for N in sizes:
+                for Nt in nts:
+                    shape = (N, N, n_coils, Nt)
+                    x = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(dtype)
+                    ref = np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(x.astype(np.complex128), axes=(0, 1)), norm='ortho',
+                                                      axes=(0, 1)), axes=(0, 1))
+                    scale = np.abs(ref).max()
+                    for name, backend in backends:
+                        err = np.abs(backend.fft2c(x) - ref).max() / scale
+                        t = timeit(lambda: backend.fft2c(x), repeats)
+                        print(f'{precision:6s} {str(shape):22s} {name:28s} {t*1e3:9.2f} ms  max. rel. error {err:.1e}')
+                    # in-place on a preallocated buffer
+                    backend = CheckerboardFFTBackend(workers)
+                    buf = np.empty_like(x)
+                    err = np.abs(backend.fft2c(x, out=buf) - ref).max() / scale
+                    t = timeit(lambda: backend.fft2c(x, out=buf), repeats)
+                    print(f'{precision:6s} {str(shape):22s} {"checkerboard out=buffer":28s} {t*1e3:9.2f} ms  max. rel. error {err:.1e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Centered 2D FFT backends on [Nx, Ny, Nc, Nt] stacks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256])
+    parser.add_argument('--coils', type=int, default=8)
+    parser.add_argument('--nt', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--workers', type=int, default=-1)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.coils, args.nt, args.workers, args.repeats)
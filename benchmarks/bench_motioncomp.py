@@ -0,0 +1,299 @@
+# Time and peak memory of the motion-compensation hot paths (CPU only) on the bundled data/*.npz images
+# with synthetic coil maps, saved as JSON to compare runs across commits.
+#
+# usage: python benchmarks/bench_motioncomp.py [--sizes 64 128 256] [--nt 1 2 4 8] [--only apply_sparse_motion]
+#                                              [--output results.json]
+#        python benchmarks/bench_motioncomp.py --compare base.json new.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import inspect
+from benchmarks.common import load_images, resize
+from utils import motioncomp, motionsim, radialsampling
+from utils.mri import mriForwardOp, mriAdjointOp, BatchForwardOp, BatchAdjointOp, iterativeSENSE
+from utils.motioncomp import get_sparse_motion_matrix, apply_sparse_motion
+from utils.motionsim import simulate_motion, transform_img, get_flow
+from utils.radialsampling import get_kpos, compute_radial_dcf, prepare_radial
+from utils.warping import warp_2D
+from utils.padding import zpad
+from scipy.sparse import vstack
+
+# APIs added over time are looked up by feature checks (None / False if missing), so that the benchmarks run on
+# earlier commits as well and the results stay comparable across them
+MotionOperator = getattr(motioncomp, 'MotionOperator', None)
+WarpOperator = getattr(motioncomp, 'WarpOperator', None)
+BatchMotionOperator = getattr(motioncomp, 'BatchMotionOperator', None)
+ELLMotionOperator = getattr(motioncomp, 'ELLMotionOperator', None)
+get_sampling_flow = getattr(motionsim, 'get_sampling_flow', None)
+radial_trajectory = getattr(radialsampling, 'radial_trajectory', None)
+clear_trajectory_cache = getattr(radialsampling, 'clear_trajectory_cache', None)
+HAS_PHASE_RAMP = 'phase_ramp' in inspect.signature(simulate_motion).parameters
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    # register a benchmark: fun(case) returns a list of (parameters, callable)
+    def register(fun):
+        BENCHMARKS[name] = fun
+        return fun
+    return register
+
+
+def sampling_flow(img, p):
+    # flows [N, N, 2, K] in the convention of get_sparse_motion_matrix; before get_sampling_flow, approximated by the
+    # swapped components of get_flow (same cost, the timings do not depend on the exact offsets)
+    if get_sampling_flow is not None:
+        return get_sampling_flow(img, p)
+    return np.stack([get_flow(img, p_t)[..., ::-1] for p_t in p], -1)
+
+
+class Case():
+    # synthetic test case of size N x N: image, coil maps, Nt motion states (flows, sparse matrices, masks)
+    def __init__(self, img, N, n_coils, nts, seed=0):
+        rng = np.random.default_rng(seed)
+        self.N = N
+        self.nts = nts
+        self.img = resize(img, N).astype(np.complex64)
+        y, x = np.mgrid[:N, :N] / N
+        centers = rng.uniform(0, 1, (n_coils, 2))
+        self.smaps = np.stack([np.exp(-((x - cx)**2 + (y - cy)**2) / 0.5) * np.exp(1j * 2 * np.pi * c / n_coils)
+                               for c, (cx, cy) in enumerate(centers)], -1).astype(np.complex64)
+        self.mask = np.ones((N, N, n_coils), dtype=np.float32)
+        p = np.concatenate([rng.normal(0, 2, (max(nts), 2)), rng.normal(0, 3, (max(nts), 1)),
+                            np.zeros((max(nts), 1)), np.ones((max(nts), 2))], 1)
+        p[0] = [0, 0, 0, 0, 1, 1]
+        self.p = p
+        self.flows = sampling_flow(np.abs(self.img), p)
+        self.smm = {Nt: vstack([get_sparse_motion_matrix(self.flows[..., t]) for t in range(Nt)]).tocsr() for Nt in nts}
+
+    def masks(self, Nt):
+        # interleaved phase-encoding lines per motion state
+        masks = np.zeros(np.shape(self.mask) + (Nt,), dtype=np.float32)
+        for t in range(Nt):
+            masks[:, t::Nt, :, t] = 1
+        return masks
+
+
+@benchmark('get_sparse_motion_matrix')
+def bench_sparse_motion_matrix(case):
+    flow = case.flows[..., -1]
+    return [({}, lambda: get_sparse_motion_matrix(flow))]
+
+
+@benchmark('apply_sparse_motion')
+def bench_apply_sparse_motion(case):
+    N2 = case.N**2
+    spr_mat = case.smm[max(case.nts)][-N2:]
+    return [({'adjoint': adj}, lambda adj=adj: apply_sparse_motion(case.img, spr_mat, adj)) for adj in (0, 1)]
+
+
+@benchmark('motion_operator')
+def bench_motion_operator(case):
+    # sparse-matrix (MotionOperator) vs matrix-free (WarpOperator) motion state: build cost and peak memory
+    # (the operator itself) vs application cost, i.e. the crossover over image size and number of applications
+    flow = case.flows[..., -1]
+    runs = []
+    for name, cls in (('sparse', MotionOperator), ('matrix-free', WarpOperator)):
+        if cls is None:
+            continue
+        op = cls(flow)
+        runs += [({'operator': name, 'op': 'build'}, lambda cls=cls: cls(flow)),
+                 ({'operator': name, 'op': 'forward'}, lambda op=op: op.forward(case.img)),
+                 ({'operator': name, 'op': 'adjoint'}, lambda op=op: op.adjoint(case.img))]
+    return runs
+
+
+@benchmark('batch_motion_operator')
+def bench_batch_motion_operator(case):
+    # all Nt states: stacked CSR (BatchMotionOperator) vs ELL storage (ELLMotionOperator)
+    runs = []
+    for Nt in case.nts:
+        imgs = np.repeat(case.img[..., np.newaxis], Nt, -1)
+        for name, cls in (('csr', BatchMotionOperator), ('ell', ELLMotionOperator)):
+            if cls is None:
+                continue
+            op = cls(case.smm[Nt])
+            runs += [({'operator': name, 'Nt': Nt, 'op': 'build'}, lambda cls=cls, Nt=Nt: cls(case.smm[Nt])),
+                     ({'operator': name, 'Nt': Nt, 'op': 'forward'}, lambda op=op: op.forward(case.img)),
+                     ({'operator': name, 'Nt': Nt, 'op': 'adjoint'}, lambda op=op, imgs=imgs: op.adjoint(imgs))]
+    return runs
+
+
+@benchmark('BatchForwardOp')
+def bench_batch_forward(case):
+    return [({'Nt': Nt}, lambda Nt=Nt: BatchForwardOp(case.img, case.masks(Nt), case.smaps, case.smm[Nt]))
+            for Nt in case.nts]
+
+
+@benchmark('BatchAdjointOp')
+def bench_batch_adjoint(case):
+    runs = []
+    for Nt in case.nts:
+        kspace = BatchForwardOp(case.img, case.masks(Nt), case.smaps, case.smm[Nt])
+        runs.append(({'Nt': Nt}, lambda Nt=Nt, kspace=kspace: BatchAdjointOp(kspace, case.masks(Nt), case.smaps,
+                                                                             case.smm[Nt])))
+    return runs
+
+
+@benchmark('iterativeSENSE')
+def bench_iterative_sense(case, max_iter=10):
+    kspace = mriForwardOp(case.img, case.mask, case.smaps)
+    runs = [({'motion': False, 'max_iter': max_iter},
+             lambda: iterativeSENSE(kspace, case.smaps, mask=case.mask, fwdop=mriForwardOp, adjop=mriAdjointOp,
+                                    max_iter=max_iter))]
+    Nt = max(case.nts)
+    masks = case.masks(Nt)
+    kspace_motion = BatchForwardOp(case.img, masks, case.smaps, case.smm[Nt])
+    runs.append(({'motion': True, 'Nt': Nt, 'max_iter': max_iter},
+                 lambda: iterativeSENSE(kspace_motion, case.smaps, mask=masks, flow=case.smm[Nt], fwdop=BatchForwardOp,
+                                        adjop=BatchAdjointOp, max_iter=max_iter)))
+    return runs
+
+
+@benchmark('simulate_motion')
+def bench_simulate_motion(case):
+    N = case.N
+    constant = np.zeros((N, 6))
+    constant[::4] = [10, 5, 0, 0, 1, 1]
+    t = np.arange(N) * 5e-3
+    periodic = np.concatenate([np.stack([15 * np.sin(5 * t), 8 * np.cos(6 * t)], 1), np.zeros((N, 2)),
+                               np.ones((N, 2))], 1)
+    rotation = periodic.copy()
+    rotation[:, 2] = 5 * np.sin(4 * t)  # degrees, not a translation: always warped
+    runs = [({'motion': 'rotation', 'phase_ramp': False},
+             lambda: simulate_motion(case.img, case.smaps, case.mask, rotation))]
+    # translations: image-domain warps with static coil maps (default) vs. the opt-in phase ramps
+    for name, p in (('constant', constant), ('time-dependent', periodic)):
+        runs.append(({'motion': name, 'phase_ramp': False},
+                     lambda p=p: simulate_motion(case.img, case.smaps, case.mask, p)))
+        if HAS_PHASE_RAMP:
+            runs.append(({'motion': name, 'phase_ramp': True},
+                         lambda p=p: simulate_motion(case.img, case.smaps, case.mask, p, phase_ramp=True)))
+    return runs
+
+
+@benchmark('transform_img')
+def bench_transform_img(case):
+    return [({}, lambda: transform_img(np.abs(case.img), [10, 5, 20, 0.1, 1, 1]))]
+
+
+@benchmark('warp_2D')
+def bench_warp_2D(case):
+    flow = case.flows[..., -1]
+    return [({'complex': c}, lambda c=c: warp_2D(case.img.astype(np.complex128) if c else np.abs(case.img), flow))
+            for c in (False, True)]
+
+
+@benchmark('compute_radial_dcf')
+def bench_radial_dcf(case):
+    n_spokes = int(np.round(np.pi / 2 * case.N))
+    kpos = get_kpos(case.N, n_spokes, 'golden', 0)
+    return [({}, lambda: compute_radial_dcf(kpos))]
+
+
+def prepare_radial_uncached(acc, nRead):
+    # trajectory setup from scratch: empty in-memory cache (if any), no on-disk cache
+    if clear_trajectory_cache is not None:
+        clear_trajectory_cache()
+    return prepare_radial(acc=acc, nRead=nRead)
+
+
+@benchmark('prepare_radial')
+def bench_prepare_radial(case):
+    # setup (cache cleared in every call) and, with radial_trajectory, memoized repeat (cache hit after the warm-up call)
+    runs = []
+    for acc in (1, 4):
+        runs.append(({'acc': acc, 'cached': False}, lambda acc=acc: prepare_radial_uncached(acc, case.N)))
+        if radial_trajectory is not None:
+            runs.append(({'acc': acc, 'cached': True}, lambda acc=acc: prepare_radial(acc=acc, nRead=case.N)))
+    return runs
+
+
+def measure(fun, repeats):
+    # median wall time [s] over repeats (after one warm-up call) and peak traced memory [MB] of a single call
+    fun()
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    fun()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return float(np.median(times)), peak / 1024**2
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, nts, n_coils, repeats, only=None):
+    results = []
+    for name, img in load_images().items():
+        nRead = np.amax(np.shape(img))
+        img = zpad(img, (nRead, nRead))
+        for N in sizes:
+            case = Case(img, N, n_coils, nts)
+            for bench, setup in BENCHMARKS.items():
+                if only and bench not in only:
+                    continue
+                for params, fun in setup(case):
+                    t, peak = measure(fun, repeats)
+                    results.append({'benchmark': bench, 'image': name, 'N': N, 'coils': n_coils, 'params': params,
+                                    'time_s': t, 'peak_mb': peak})
+                    print(f'{bench:26s} {name:12s} N={N:4d} {json.dumps(params):40s} {t*1e3:10.2f} ms {peak:9.1f} MB')
+    return {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'results': results}
+
+
+def key(result):
+    return (result['benchmark'], result['image'], result['N'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(base_file, new_file):
+    # time and peak memory ratio new / base of all benchmarks present in both runs
+    with open(base_file) as f:
+        base = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    base_results = {key(r): r for r in base['results']}
+    print(f'base {base.get("commit")} ({base.get("date")}) -> new {new.get("commit")} ({new.get("date")})')
+    for r in new['results']:
+        b = base_results.get(key(r))
+        if b is None:
+            continue
+        print(f'{r["benchmark"]:26s} {r["image"]:12s} N={r["N"]:4d} {json.dumps(r["params"]):40s} '
+              f'time x{r["time_s"] / b["time_s"]:6.2f}  memory x{r["peak_mb"] / max(b["peak_mb"], 1e-9):6.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and peak memory of the motion-compensation hot paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--nt', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--coils', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None)
+    parser.add_argument('--output', default='bench_motioncomp.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two JSON result files')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = run(args.sizes, args.nt, args.coils, args.repeats, args.only)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'results saved to {args.output}')
@@ -0,0 +1,63 @@
+# Accuracy and throughput of the CPU Kaiser-Bessel NUFFT (utils.nufft.KBNUFFT)
+# against the direct NDFT on the bundled data/*.npz images.
+#
+# usage: python benchmarks/bench_nufft.py [--sizes 64 128 256] [--acc 1 4] [--ndft-samples 2000]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.nufft import KBNUFFT, ndft
+from utils.radialsampling import prepare_radial
+from utils.padding import zpad
+from benchmarks.common import load_images, resize
+
+
+def timeit(fun, repeats):
+    fun()  # warm-up
+    t = time.perf_counter()
+    for _ in range(repeats):
+        fun()
+    return (time.perf_counter() - t) / repeats
+
+
+def run(sizes, accs, n_coils, ndft_samples, repeats, kernel_widths):
+    rng = np.random.default_rng(0)
+    for name, img_full in load_images().items():
+        nRead = np.amax(np.shape(img_full))
+        img_full = zpad(img_full, (nRead, nRead))
+        for N in sizes:
+            img = resize(img_full, N)
+            smaps = np.exp(-((np.arange(N)[np.newaxis, :, np.newaxis] - rng.uniform(0, N, n_coils)[:, np.newaxis, np.newaxis]) / N) ** 2)
+            smaps = (smaps * np.ones((1, 1, N))).astype(np.complex64)
+            for acc in accs:
+                kpos, dcf = prepare_radial(acc=acc, nRead=N)
+                sub = rng.choice(np.shape(kpos)[0], min(ndft_samples, np.shape(kpos)[0]), replace=False)
+                ref = ndft(img, kpos[sub])
+                for W in kernel_widths:
+                    nufft = KBNUFFT(kpos, (N, N), n_coils=n_coils, density_comp=dcf, smaps=smaps, kernel_width=W)
+                    single = KBNUFFT(kpos, (N, N), kernel_width=W)
+                    err = np.linalg.norm(single.op(img)[sub] - ref) / np.linalg.norm(ref)
+                    t_fwd = timeit(lambda: nufft.op(img), repeats)
+                    kspace = nufft.op(img)
+                    t_adj = timeit(lambda: nufft.adj_op(kspace), repeats)
+                    n_samples = np.shape(kpos)[0] * n_coils
+                    print(f'{name:12s} N={N:4d} acc={acc:2d} W={W} M={np.shape(kpos)[0]:7d} coils={n_coils} | '
+                          f'rel. error vs NDFT {err:.2e} | fwd {t_fwd*1e3:8.2f} ms ({n_samples/t_fwd/1e6:6.2f} MS/s) | '
+                          f'adj {t_adj*1e3:8.2f} ms')
+                t_ndft = timeit(lambda: ndft(img, kpos[sub]), 1) * np.shape(kpos)[0] / len(sub)
+                print(f'{name:12s} N={N:4d} acc={acc:2d} direct NDFT (single coil, extrapolated) {t_ndft*1e3:10.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KBNUFFT accuracy and throughput against the direct NDFT')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--acc', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--coils', type=int, default=8)
+    parser.add_argument('--ndft-samples', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--kernel-widths', type=int, nargs='+', default=[4, 6])
+    args = parser.parse_args()
+    run(args.sizes, args.acc, args.coils, args.ndft_samples, args.repeats, args.kernel_widths)
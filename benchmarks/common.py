@@ -0,0 +1,49 @@
+# Test images shared by the benchmarks: the bundled data/*.npz archives (git-lfs pointers are skipped).
+# Imported as benchmarks.common (the benchmarks put the repository root on sys.path).
+import os
+import numpy as np
+from utils.padding import zpad
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def load_images(datadir=DATADIR):
+    # coil-combined 2D test images from the bundled archives (git-lfs pointers are skipped)
+    images = {}
+    for name in ['brain_slice', 'brain_large', 'heart_large']:
+        path = os.path.join(datadir, name + '.npz')
+        try:
+            img = np.load(path)['arr_0']
+        except (OSError, ValueError):
+            print(f'skipping {name}: not available (git lfs pull?)')
+            continue
+        while img.ndim > 3:  # first slice / phase
+            img = img[..., 0, :]
+        images[name] = np.sqrt(np.sum(np.abs(img) ** 2, -1)).astype(np.complex64)
+    return images
+
+
+def resize(img, N):
+    # centred k-space cropping / zero-padding of a square image to N x N
+    kspace = np.fft.fftshift(np.fft.fft2(img))
+    n = np.shape(img)[0]
+    if N > n:
+        kspace = zpad(kspace, (N, N))
+    else:
+        kspace = kspace[n//2 - N//2:n//2 - N//2 + N, n//2 - N//2:n//2 - N//2 + N]
+    return np.fft.ifft2(np.fft.ifftshift(kspace)) * N / n
+
+
+def load_coil_images(datadir=DATADIR):
+    # multi-coil 2D images [X, Y, coils] (first slice / phase), git-lfs pointers are skipped
+    images = {}
+    for name in ['brain_slice', 'brain_large', 'heart_large']:
+        try:
+            img = np.load(os.path.join(datadir, name + '.npz'))['arr_0']
+        except (OSError, ValueError):
+            print(f'skipping {name}: not available (git lfs pull?)')
+            continue
+        while img.ndim > 3:
+            img = img[..., 0, :]
+        images[name] = img
+    return images
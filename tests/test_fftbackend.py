@@ -0,0 +1,22 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.fftbackend import NumpyFFTBackend, FFTBackend, CheckerboardFFTBackend
+
+
+# N = 0 and N = 2 (mod 4) on each axis, odd sizes (shift fallback), non-square
+@pytest.mark.parametrize('shape', [(8, 8), (6, 8), (8, 6), (6, 10), (218, 256), (256, 216), (7, 8)])
+@pytest.mark.parametrize('inverse', [False, True])
+@pytest.mark.parametrize('backend', [FFTBackend, CheckerboardFFTBackend])
+def test_backend_matches_numpy(shape, inverse, backend):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(shape + (3,)) + 1j * rng.standard_normal(shape + (3,))
+    ref = NumpyFFTBackend().transform(x, inverse=inverse)
+    np.testing.assert_allclose(backend().transform(x, inverse=inverse), ref, atol=1e-12)
+    # preallocated output and overwritten input
+    out = np.empty_like(x)
+    np.testing.assert_allclose(backend().transform(x, inverse=inverse, out=out), ref, atol=1e-12)
+    np.testing.assert_allclose(backend().transform(x.copy(), inverse=inverse, overwrite_x=True), ref, atol=1e-12)
@@ -0,0 +1,109 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('merlintf')
+pytest.importorskip('mri.operators')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.mri import iterativeSENSE, GPUNUFFTOp, BatchForwardOp, BatchAdjointOp
+from utils.motioncomp import get_sparse_motion_matrix, BatchMotionOperator, ELLMotionOperator, TranslationMotion, \
+    BatchWarpOperator, get_motion_operators, get_warp_operators
+from utils.motionsim import get_sampling_flow
+from utils.radialsampling import prepare_radial
+
+
+def radial_problem(N=24, Nc=6, acc=2):
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.linspace(-1, 1, N), np.linspace(-1, 1, N), indexing='ij')
+    image = (x ** 2 + y ** 2 < 0.5) * (1 + x) + 0j
+    csm = np.stack([np.exp(-((x - np.cos(a)) ** 2 + (y - np.sin(a)) ** 2)) * np.exp(1j * a)
+                    for a in 2 * np.pi * np.arange(Nc) / Nc])
+    csm = csm + 0.05 * rng.standard_normal(np.shape(csm))
+    kpos, dcf = prepare_radial(acc=acc, nRead=N)
+    return image, csm, kpos, dcf
+
+
+def test_radial_coil_compression():
+    image, csm, kpos, dcf = radial_problem()
+    nufft = GPUNUFFTOp(kpos, csm, dcf, np.shape(image)[0], implementation='kbnufft')
+    kspace = nufft.forward(image)
+    ref = iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=nufft.forward, adjop=nufft.adjoint, max_iter=20)
+    img = iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=nufft.forward, adjop=nufft.adjoint, max_iter=20,
+                         coil_compression=3)
+    assert np.shape(img) == np.shape(image)
+    assert np.linalg.norm(img - ref) < 0.1 * np.linalg.norm(ref)
+
+
+def test_radial_coil_compression_fixed_operator():
+    image, csm, kpos, dcf = radial_problem()
+    nufft = GPUNUFFTOp(kpos, csm, dcf, np.shape(image)[0], implementation='kbnufft')
+    kspace = nufft.forward(image)
+    with pytest.raises(ValueError, match='coil_compression'):
+        iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=nufft.forward, adjop=nufft.nufft.adj_op, coil_compression=3)
+
+
+def test_radial_toeplitz():
+    # the Toeplitz normal operator is built from the KBNUFFT of fwdop/adjop: same solution as NUFFT forward + adjoint
+    image, csm, kpos, dcf = radial_problem()
+    nufft = GPUNUFFTOp(kpos, csm, dcf, np.shape(image)[0], implementation='kbnufft')
+    kspace = nufft.forward(image)
+    ref = iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=nufft.forward, adjop=nufft.adjoint, max_iter=10)
+    img = iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=nufft.forward, adjop=nufft.adjoint, max_iter=10,
+                         toeplitz=True)
+    assert np.linalg.norm(img - ref) < 1e-2 * np.linalg.norm(ref)
+    # operators of unknown scaling are rejected
+    with pytest.raises(ValueError, match='toeplitz'):
+        iterativeSENSE(kspace, csm, kpos, dcf=dcf, fwdop=lambda x, *args: nufft.forward(x),
+                       adjop=lambda y, *args: nufft.adjoint(y), toeplitz=True)
+
+
+def motion_problem(N=32, Nc=4):
+    # two motion states (motion-free, rotated + translated), every 2nd phase-encoding line per state
+    x, y = np.meshgrid(np.linspace(-1, 1, N), np.linspace(-1, 1, N), indexing='ij')
+    image = (x ** 2 + y ** 2 < 0.4) * (1 + x) + 0j
+    smaps = np.stack([np.exp(-((x - np.cos(a)) ** 2 + (y - np.sin(a)) ** 2)) * np.exp(1j * a)
+                      for a in 2 * np.pi * np.arange(Nc) / Nc], -1)
+    flows = get_sampling_flow(image, np.array([[0, 0, 0, 0, 1, 1], [2, -3, 10, 0, 1, 1]]))
+    masks = np.zeros((N, N, Nc, 2))
+    masks[:, ::2, :, 0] = 1
+    masks[:, 1::2, :, 1] = 1
+    return image, smaps, flows, masks
+
+
+def recon(kspace, smaps, masks, flow):
+    return iterativeSENSE(kspace, smaps, mask=masks, flow=flow, fwdop=BatchForwardOp, adjop=BatchAdjointOp,
+                          max_iter=15)
+
+
+@pytest.mark.parametrize('operator', [BatchMotionOperator, ELLMotionOperator])
+def test_motion_operator_reconstruction(operator):
+    # operator objects in iterativeSENSE give the reconstruction of the stacked sparse motion matrix
+    image, smaps, flows, masks = motion_problem()
+    smm = get_sparse_motion_matrix(flows)
+    kspace = BatchForwardOp(image, masks, smaps, smm)
+    ref = recon(kspace, smaps, masks, smm)
+    np.testing.assert_allclose(recon(kspace, smaps, masks, operator(flows)), ref, atol=1e-6 * np.abs(ref).max())
+    # without masks the number of states comes from the operator
+    assert np.shape(recon(BatchForwardOp(image, np.ones_like(masks), smaps, smm), smaps, None, operator(flows))) == \
+        np.shape(image)
+
+
+@pytest.mark.parametrize('motions', [BatchWarpOperator, get_motion_operators, get_warp_operators])
+def test_warp_operator_reconstruction(motions):
+    # matrix-free warps and per-state operator lists in iterativeSENSE
+    image, smaps, flows, masks = motion_problem()
+    smm = get_sparse_motion_matrix(flows)
+    kspace = BatchForwardOp(image, masks, smaps, smm)
+    ref = recon(kspace, smaps, masks, smm)
+    np.testing.assert_allclose(recon(kspace, smaps, masks, motions(flows)), ref, atol=1e-5 * np.abs(ref).max())
+    assert np.shape(recon(BatchForwardOp(image, np.ones_like(masks), smaps, smm), smaps, None, motions(flows))) == \
+        np.shape(image)
+
+
+def test_translation_motion_reconstruction():
+    image, smaps, flows, masks = motion_problem()
+    motion = TranslationMotion([[0, 0], [1.5, -2.5]])
+    kspace = BatchForwardOp(image, masks, smaps, motion)
+    img = recon(kspace, smaps, masks, motion)
+    assert np.linalg.norm(img - image) < 0.05 * np.linalg.norm(image)
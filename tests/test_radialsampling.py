@@ -0,0 +1,42 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('mri.operators')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.radialsampling import subsample_radial, radial_trajectory
+from utils.nufft import KBNUFFT
+from utils.padding import zpad
+
+
+def cine(X=24, Y=20, slices=2, phases=3, coils=3):
+    rng = np.random.default_rng(0)
+    shape = (X, Y, slices, phases, coils)
+    img = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+    smaps = rng.standard_normal((X, Y, slices, coils)) + 1j * rng.standard_normal((X, Y, slices, coils))
+    return img, smaps
+
+
+def test_subsample_radial_modes():
+    img, smaps = cine()
+    out = {mode: subsample_radial(img, smaps, acc=2, cphases=[0, 2], implementation='kbnufft', mode=mode)
+           for mode in ('batched', 'serial')}
+    assert np.shape(out['batched']) == (24, 24, 2, 2)
+    np.testing.assert_allclose(out['batched'], out['serial'], atol=1e-5 * np.abs(out['serial']).max())
+    # A^H A of phase 2 (second trajectory), slice 1, combined with the coil maps
+    kpos, dcf = radial_trajectory(24, 2, n_phases=2)
+    nufft = KBNUFFT(kpos[1], (24, 24), density_comp=dcf[1])
+    coil_imgs = np.moveaxis(zpad(img, (24, 24, 2, 3, 3))[:, :, 1, 2], -1, 0)
+    ref = np.sum(nufft.adj_op(nufft.op(coil_imgs)) * np.conj(np.moveaxis(zpad(smaps, (24, 24, 2, 3))[:, :, 1], -1, 0)), 0)
+    np.testing.assert_allclose(out['serial'][:, :, 1, 1], ref, atol=1e-5 * np.abs(ref).max())
+
+
+def test_subsample_radial_kspace():
+    img, smaps = cine()
+    kspace = subsample_radial(img, smaps, acc=2, cphases=[0, 2], implementation='kbnufft', output='kspace')
+    kpos, dcf = radial_trajectory(24, 2, n_phases=2)
+    assert np.shape(kspace) == (np.shape(kpos)[1], 2, 3, 2)
+    nufft = KBNUFFT(kpos[0], (24, 24), density_comp=dcf[0])
+    ref = nufft.op(np.moveaxis(zpad(img, (24, 24, 2, 3, 3))[:, :, 0, 0], -1, 0))
+    np.testing.assert_allclose(kspace[:, 0, :, 0].T, ref, atol=1e-5 * np.abs(ref).max())
@@ -0,0 +1,74 @@
+import numpy as np
+
+# SVD/PCA-based coil compression: k-space and coil sensitivity maps are projected consistently onto
+# the dominant right singular vectors of the [samples, coils] data matrix (virtual coils). The projection
+# is unitary, i.e. white noise stays white.
+
+
+def get_coil_compression_matrix(kspace, n_virtual=None, energy=None, coil_axis=-1, mask=None):
+    # kspace      multi-coil k-space data
+    # n_virtual   target number of virtual coils
+    # energy      target fraction of the signal energy (0, 1], used if n_virtual is None
+    # coil_axis   coil dimension of kspace
+    # mask        optional sampling mask (broadcastable to kspace), only sampled points enter the SVD
+    # return      compression matrix [Nc, Nv], retained energy fraction
+    data = np.moveaxis(np.asarray(kspace), coil_axis, -1)
+    Nc = np.shape(data)[-1]
+    data = np.reshape(data, (-1, Nc))
+    if mask is not None:
+        sampled = np.reshape(np.moveaxis(np.broadcast_to(mask != 0, np.shape(kspace)), coil_axis, -1), (-1, Nc))
+        data = data[np.any(sampled, axis=1)]
+    # eigen-decomposition of the coil covariance instead of the SVD of the (tall) data matrix
+    cov = data.conj().T @ data
+    eigval, eigvec = np.linalg.eigh(cov)
+    eigval, eigvec = np.maximum(eigval[::-1], 0), eigvec[:, ::-1]
+    cumulative = np.cumsum(eigval) / max(np.sum(eigval), np.finfo(float).tiny)
+    if n_virtual is None:
+        n_virtual = Nc if energy is None else int(np.searchsorted(cumulative, energy - 1e-12) + 1)
+    n_virtual = int(min(max(n_virtual, 1), Nc))
+    return eigvec[:, :n_virtual], float(cumulative[n_virtual - 1])
+
+
+def apply_coil_compression(x, matrix, coil_axis=-1):
+    # x           k-space data or coil sensitivity maps
+    # matrix      compression matrix [Nc, Nv]
+    # return      x with Nv virtual coils along coil_axis
+    x = np.moveaxis(np.asarray(x), coil_axis, -1)
+    return np.moveaxis(x @ matrix.astype(np.result_type(x, np.complex64), copy=False), -1, coil_axis)
+
+
+def compress_mask(mask, n_virtual, coil_axis=-1):
+    # sampling masks have to be identical for all coils, the virtual coils share them
+    mask = np.asarray(mask)
+    m = np.moveaxis(mask, coil_axis, 0)
+    if np.shape(m)[0] == 1:
+        return mask
+    if not np.all(m == m[:1]):
+        raise ValueError('Coil compression requires the same sampling mask for all coils')
+    return np.moveaxis(np.repeat(m[:1], n_virtual, axis=0), 0, coil_axis)
+
+
+def compress_coils(kspace, smaps, n_virtual=None, energy=None, coil_axis=-1, mask=None, smaps_coil_axis=None):
+    # kspace            multi-coil k-space data
+    # smaps             coil sensitivity maps
+    # n_virtual         target number of virtual coils
+    # energy            target energy fraction (0, 1], used if n_virtual is None
+    # coil_axis         coil dimension of kspace (and mask)
+    # mask              optional sampling mask, compressed along with the data if it has a coil dimension
+    # smaps_coil_axis   coil dimension of smaps, if None same as coil_axis
+    # return            compressed kspace, smaps, mask (unchanged without coil dimension), info {'coils', 'virtual_coils', 'energy', 'matrix'}
+    coil_axis = coil_axis % np.ndim(kspace)
+    smaps_coil_axis = coil_axis if smaps_coil_axis is None else smaps_coil_axis
+    sampling = None
+    if mask is not None:
+        sampling = np.asarray(mask) != 0
+        if np.ndim(sampling) > np.ndim(kspace):  # e.g. one mask per motion state [X, Y, coils, T]
+            sampling = np.any(sampling, axis=tuple(range(np.ndim(kspace), np.ndim(sampling))))
+    matrix, kept = get_coil_compression_matrix(kspace, n_virtual, energy, coil_axis, sampling)
+    Nc, Nv = np.shape(matrix)
+    kspace_cc = apply_coil_compression(kspace, matrix, coil_axis)
+    smaps_cc = apply_coil_compression(smaps, matrix, smaps_coil_axis)
+    mask_cc = mask
+    if mask is not None and np.ndim(mask) > coil_axis and np.shape(mask)[coil_axis] == Nc:
+        mask_cc = compress_mask(mask, Nv, coil_axis)
+    return kspace_cc, smaps_cc, mask_cc, {'coils': Nc, 'virtual_coils': Nv, 'energy': kept, 'matrix': matrix}
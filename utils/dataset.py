@@ -0,0 +1,148 @@
+import os
+import shutil
+import threading
+import queue
+import zipfile
+import numpy as np
+
+# data directory of the repository
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# axis layout of the bundled archives (one character per axis)
+# x, y: in-plane dimensions, z: slices, t: (cardiac) phases, c: coils
+LAYOUTS = {'brain_slice': 'xyc', 'brain_large': 'xyzc', 'heart_large': 'xytc'}
+DEFAULT_LAYOUTS = {2: 'xy', 3: 'xyc', 4: 'xyzc', 5: 'xyztc'}
+AXIS_NAMES = {'slice': 'z', 'phase': 't', 'coil': 'c'}
+
+
+def npz_to_npy(path, key='arr_0', cache_dir=None):
+    # path        .npz archive
+    # key         array in the archive
+    # cache_dir   directory of the .npy cache, if None next to the archive
+    # return      path of the uncompressed .npy cache (<name>.<key>.npy), (re-)created if missing or older than the archive
+    #             The archive member is streamed to disk, i.e. it is never decompressed into memory as a whole.
+    cache_dir = os.path.dirname(os.path.abspath(path)) if cache_dir is None else cache_dir
+    name = os.path.splitext(os.path.basename(path))[0]
+    npy = os.path.join(cache_dir, '%s.%s.npy' % (name, key))
+    if os.path.exists(npy) and os.path.getmtime(npy) >= os.path.getmtime(path):
+        return npy
+
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        raise ValueError('%s is not a valid .npz archive (git-lfs pointer? run "git lfs pull")' % path)
+    with archive:
+        if key + '.npy' not in archive.namelist():
+            raise KeyError('%s is not a file in the archive %s' % (key, path))
+        tmp = npy + '.tmp%d' % os.getpid()
+        with archive.open(key + '.npy') as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024**2)
+    os.replace(tmp, npy)
+    return npy
+
+
+def open_dataset(name, key='arr_0', layout=None, cache_dir=None):
+    # name        path of an .npz/.npy file or name of a bundled dataset ('brain_slice', 'brain_large', 'heart_large')
+    # return      Dataset
+    path = name
+    if not os.path.exists(path):
+        path = os.path.join(DATA_DIR, name if name.endswith('.npz') else name + '.npz')
+    return Dataset(path, key=key, layout=layout, cache_dir=cache_dir)
+
+
+class Dataset():
+    # Memory-mapped, lazily indexed access to an .npz archive (via its .npy cache) or an .npy file.
+    # Only the indexed items are read from disk.
+    # path        .npz or .npy file
+    # key         array in the .npz archive
+    # layout      axis layout, e.g. 'xyzc' (see LAYOUTS), if None from LAYOUTS or by rank
+    # cache_dir   directory of the .npy cache
+    def __init__(self, path, key='arr_0', layout=None, cache_dir=None):
+        self.path = path
+        self.npy = path if path.endswith('.npy') else npz_to_npy(path, key, cache_dir)
+        self.data = np.load(self.npy, mmap_mode='r')
+        name = os.path.splitext(os.path.basename(path))[0]
+        self.layout = layout or LAYOUTS.get(name, DEFAULT_LAYOUTS.get(self.data.ndim))
+        if self.layout is None or len(self.layout) != self.data.ndim:
+            raise ValueError('Layout %s does not match data of shape %s' % (self.layout, self.data.shape))
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def axis(self, name):
+        # name   'slice', 'phase', 'coil' or a layout character
+        char = AXIS_NAMES.get(name, name)
+        if char not in self.layout:
+            raise KeyError('Dataset with layout %s has no %s axis' % (self.layout, name))
+        return self.layout.index(char)
+
+    def size(self, name):
+        return self.data.shape[self.axis(name)]
+
+    def __getitem__(self, index):
+        # numpy indexing on the memory-mapped array, returns an in-memory copy of the selection
+        return np.array(self.data[index])
+
+    def get(self, slice=None, phase=None, coil=None):
+        # lazy access by slice, phase and/or coil index (int, slice object or index list), all others complete
+        index = [np.s_[:]] * self.data.ndim
+        for name, value in (('slice', slice), ('phase', phase), ('coil', coil)):
+            if value is not None:
+                index[self.axis(name)] = value
+        return self[tuple(index)]
+
+    def iterate(self, over='slice', prefetch=1, **kwargs):
+        # over        axis to iterate over ('slice', 'phase', 'coil')
+        # prefetch    number of items loaded ahead in a background thread (0: no prefetching)
+        # kwargs      fixed indices of the other axes, e.g. coil=0
+        # yields      items in order, the next one is read while the current one is processed
+        items = (lambda i=i: self.get(**dict(kwargs, **{over: i})) for i in range(self.size(over)))
+        return prefetch_iterator(items, prefetch)
+
+
+def prefetch_iterator(loaders, prefetch=1):
+    # loaders     iterable of callables, each loading one item
+    # prefetch    number of items loaded ahead in a background thread (0: load on demand)
+    # yields      loaded items in order
+    if prefetch <= 0:
+        for load in loaders:
+            yield load()
+        return
+
+    items = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def worker():
+        try:
+            for load in loaders:
+                item = load()
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,114 @@
+import numpy as np
+import scipy.fft
+from utils.precision import complex_dtype
+
+# Pluggable FFT backends for the centered, orthonormal 2D FFTs (utils.mri.fft2c / ifft2c)
+#
+# 'numpy'         np.fft with ifftshift / fftshift (always computes in double precision)
+# 'scipy'         scipy.fft with ifftshift / fftshift, single precision stays single (default)
+# 'checkerboard'  scipy.fft, the shifts are replaced by a precomputed checkerboard modulation
+#                 (exact for even sizes, odd sizes fall back to shifts); supports in-place transforms
+#                 on preallocated buffers (out=...) and overwriting the input (overwrite_x=True)
+#
+# workers: number of threads of scipy.fft (-1: all CPUs). Plans are reused by scipy.fft's internal
+# plan cache, the modulation patterns are cached per shape here.
+
+
+class FFTBackend():
+    # scipy.fft with shifts
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def _fft(self, x, axes, inverse, overwrite_x=False):
+        fun = scipy.fft.ifft2 if inverse else scipy.fft.fft2
+        return fun(x, norm='ortho', axes=axes, workers=self.workers, overwrite_x=overwrite_x)
+
+    def transform(self, x, axes=(0, 1), inverse=False, out=None, overwrite_x=False):
+        x = np.asarray(x, dtype=complex_dtype(x))
+        y = scipy.fft.fftshift(self._fft(scipy.fft.ifftshift(x, axes=axes), axes, inverse, True), axes=axes)
+        if out is not None:
+            out[...] = y
+            return out
+        return y
+
+    def fft2c(self, image, axes=(0, 1), out=None, overwrite_x=False):
+        return self.transform(image, axes, False, out, overwrite_x)
+
+    def ifft2c(self, kspace, axes=(0, 1), out=None, overwrite_x=False):
+        return self.transform(kspace, axes, True, out, overwrite_x)
+
+    def __repr__(self):
+        return '%s(workers=%s)' % (self.name, self.workers)
+
+
+class NumpyFFTBackend(FFTBackend):
+    # np.fft with shifts (reference)
+    name = 'numpy'
+
+    def _fft(self, x, axes, inverse, overwrite_x=False):
+        fun = np.fft.ifft2 if inverse else np.fft.fft2
+        return fun(x, norm='ortho', axes=axes).astype(x.dtype, copy=False)
+
+
+class CheckerboardFFTBackend(FFTBackend):
+    # For even N: fftshift(fft(ifftshift(x)))[k] = (-1)^(k + N/2) fft((-1)^n x)[k] (same for ifft),
+    # i.e. both shifts become one elementwise multiplication before and after the transform
+    # (the factor (-1)^(N/2) is applied once, after the transform).
+    name = 'checkerboard'
+
+    def __init__(self, workers=None):
+        super().__init__(workers)
+        self.patterns = {}
+
+    def pattern(self, shape, axes, dtype, centered=False):
+        # modulation (-1)^n (centered: (-1)^(n + N/2)) per transformed axis, broadcastable to shape
+        axes = tuple(a % len(shape) for a in axes)
+        key = (tuple(shape[a] for a in axes), axes, len(shape), np.dtype(dtype).str, centered)
+        if key not in self.patterns:
+            c = np.ones([shape[a] if a in axes else 1 for a in range(len(shape))], dtype=np.finfo(dtype).dtype)
+            for a in axes:
+                n = np.arange(shape[a])
+                sign = (-1.0)**(n + shape[a] // 2 if centered else n)
+                c = c * np.reshape(sign, [-1 if b == a else 1 for b in range(len(shape))])
+            c.flags.writeable = False
+            self.patterns[key] = c
+        return self.patterns[key]
+
+    def transform(self, x, axes=(0, 1), inverse=False, out=None, overwrite_x=False):
+        x = np.asarray(x)
+        if any(np.shape(x)[a] % 2 for a in axes):
+            return super().transform(x, axes, inverse, out, overwrite_x)
+        dtype = complex_dtype(x)
+        c = self.pattern(np.shape(x), axes, dtype)
+        if out is not None:
+            buf = np.multiply(x, c, out=out, casting='same_kind')
+        elif overwrite_x and x.dtype == dtype and x.flags.writeable:
+            buf = np.multiply(x, c, out=x)
+        else:
+            buf = np.multiply(x, c, dtype=dtype, casting='same_kind')
+        y = self._fft(buf, axes, inverse, overwrite_x=True)
+        c = self.pattern(np.shape(x), axes, dtype, centered=True)
+        if out is not None:
+            return np.multiply(y, c, out=out)
+        return np.multiply(y, c, out=y)
+
+
+BACKENDS = {'numpy': NumpyFFTBackend, 'scipy': FFTBackend, 'checkerboard': CheckerboardFFTBackend}
+_backend = {'backend': FFTBackend()}
+
+
+def set_fft_backend(backend='scipy', workers=None):
+    # backend   name ('numpy', 'scipy', 'checkerboard') or FFTBackend instance
+    # workers   number of scipy.fft threads (-1: all CPUs)
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown FFT backend: %s' % backend)
+        backend = BACKENDS[backend](workers)
+    _backend['backend'] = backend
+    return backend
+
+
+def get_fft_backend():
+    return _backend['backend']
@@ -1,6 +1,8 @@
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix, issparse, vstack
 import math
+from utils.precision import complex_dtype, real_dtype
+from utils.profiling import profiled
 
 #####################
 # Auxiliary functions
@@ -24,58 +26,73 @@ def lin_index(x,y,Nx):
   # get 1D linear index from 2D index
   return int(x + Nx*y)
 
+# array versions of the above, operating on all pixels at once
+
+def bound_index_array(x,Nx):
+  # restrict coordinates x to matrix limit [0,Nx-1]
+  return np.clip(x, 0, Nx-1)
+
+def bound_weight_array(w,x,y,Nx,Ny):
+  # null weights outside the FOV
+  outside = (x<0) | (x>(Nx-1)) | (y<0) | (y>(Ny-1))
+  return np.where(outside, 0, w)
+
+def lin_index_array(x,y,Nx):
+  # get 1D linear indexes from 2D indexes
+  return (x + Nx*y).astype(np.int64)
+
 #####################
 # Key function !!!
 #####################
 
 # get_sparse_motion_matrix takes a [Nx,Ny,2] flow field (i.e no underlying mesh)
-# and creates the corresponding [Nx*Ny Nx*Ny] sparse motion matrix
+# and creates the corresponding [Nx*Ny Nx*Ny] sparse motion matrix.
+# A stack of flow fields [Nx,Ny,2,Nt] yields the vertically stacked [Nt*Nx*Ny Nx*Ny]
+# matrix, i.e. the same as vstack([get_sparse_motion_matrix(flow[...,t]) for t])
 
+@profiled()
 def get_sparse_motion_matrix(flow_field):
 # creates a sparse motion matrix corresponding to the motion in the flow field
 # assuming linear interpolation
-  Ny = np.shape(flow_field)[1]
-  Nx = np.shape(flow_field)[0]
-  sparse_mot = csr_matrix((Ny*Nx,Ny*Nx))
-
-  for y in range(np.shape(flow_field)[1]):
-    for x in range(np.shape(flow_field)[0]):
-      # cartesian interpolant coordinates
-      ux = flow_field[x,y,0]
-      uy = flow_field[x,y,1]
-      y1 = math.floor(y+uy)
-      y2 = math.floor(y+uy+1)
-      x1 = math.floor(x+ux)
-      x2 = math.floor(x+ux+1)
-      # interpolants for linear interpolation
-      wx = ux-math.floor(ux)
-      wy = uy-math.floor(uy)
-      w11 = bound_weight((1-wx)*(1-wy),x1,y1,Nx,Ny)
-      w12 = bound_weight((1-wx)*wy,x1,y2,Nx,Ny)
-      w21 = bound_weight(wx*(1-wy),x2,y1,Nx,Ny)
-      w22 = bound_weight(wx*wy,x2,y2,Nx,Ny)
-      # avoiding out of FOV issues
-      y1 = bound_index(y1,Ny)
-      y2 = bound_index(y2,Ny)
-      x1 = bound_index(x1,Nx)
-      x2 = bound_index(x2,Nx)
-      # loading sparse matrix indexes
-      li = int(lin_index(x,y,Nx))
-      x1y1 = int(lin_index(x1,y1,Nx))
-      x1y2 = int(lin_index(x1,y2,Nx))
-      x2y1 = int(lin_index(x2,y1,Nx))
-      x2y2 = int(lin_index(x2,y2,Nx))
-      # assigning weights to sparse matrix
-      if w11 != 0:
-        sparse_mot[li,x1y1] = w11
-      if w12 != 0:
-        sparse_mot[li,x1y2] = w12
-      if w21 != 0:
-        sparse_mot[li,x2y1] = w21
-      if w22 != 0:
-        sparse_mot[li,x2y2] = w22
-
-  return sparse_mot
+  flow_field = np.asarray(flow_field)
+  if flow_field.ndim == 3:
+    flow_field = flow_field[..., np.newaxis]
+  Nx, Ny, _, Nt = np.shape(flow_field)
+
+  # pixel grid, linear index li = x + Nx*y (Fortran order as in apply_sparse_motion)
+  x, y = np.meshgrid(np.arange(Nx), np.arange(Ny), indexing='ij')
+  li = lin_index_array(x, y, Nx)
+
+  rows, cols, vals = [], [], []
+  for t in range(Nt):
+    # cartesian interpolant coordinates
+    ux = flow_field[:, :, 0, t]
+    uy = flow_field[:, :, 1, t]
+    x1 = np.floor(x + ux).astype(np.int64)
+    y1 = np.floor(y + uy).astype(np.int64)
+    x2 = x1 + 1
+    y2 = y1 + 1
+    # interpolants for linear interpolation
+    wx = ux - np.floor(ux)
+    wy = uy - np.floor(uy)
+    corners = [((1 - wx) * (1 - wy), x1, y1),
+               ((1 - wx) * wy, x1, y2),
+               (wx * (1 - wy), x2, y1),
+               (wx * wy, x2, y2)]
+    for w, xc, yc in corners:
+      # null weights outside the FOV and avoid out of FOV indexes
+      w = bound_weight_array(w, xc, yc, Nx, Ny)
+      idx = lin_index_array(bound_index_array(xc, Nx), bound_index_array(yc, Ny), Nx)
+      nz = w != 0
+      rows.append(li[nz] + t * Nx * Ny)
+      cols.append(idx[nz])
+      vals.append(w[nz])
+
+  rows = np.concatenate(rows)
+  cols = np.concatenate(cols)
+  vals = np.concatenate(vals).astype(np.float64)
+  # in-FOV corners of a pixel are distinct, so no duplicate entries are summed up
+  return coo_matrix((vals, (rows, cols)), shape=(Nt*Nx*Ny, Nx*Ny)).tocsr()
 
 #####################
 # Key function !!!
@@ -84,6 +101,7 @@ def get_sparse_motion_matrix(flow_field):
 # apply_sparse_motion takes a [Nx,Ny] image and a [Nx*Ny,Nx*Ny] spr_mat and applies
 # the corresponding motion. adj_flag determines if the forward or transpose motion
 # is applied (tranpose should be a good approximation of the inverse)
+@profiled()
 def apply_sparse_motion(img,spr_mat,adj_flag):
     # applies a motion field via the sparse representation
     Ny = np.shape(img)[1]
@@ -104,11 +122,467 @@ def apply_sparse_motion(img,spr_mat,adj_flag):
     # mind nans
     img_r = np.nan_to_num(img_r)
     img_i = np.nan_to_num(img_i)
-    img = np.vectorize(complex)(img_r[:,0], img_i[:,0])
+    img = np.empty(Nx*Ny, dtype=complex_dtype(img))
+    img.real = img_r[:,0]
+    img.imag = img_i[:,0]
     img = np.reshape(img,(Nx,Ny),order='F')
     return img
 
 
+
+# MotionOperator wraps a single motion state for repeated application (e.g. inside CG).
+# The CSR matrix, its transpose and the Jacobian normalization of both directions are
+# computed once, so forward/adjoint reduce to one sparse product and one scaling.
+class MotionOperator():
+    def __init__(self, motion):
+        # motion   [Nx,Ny,2] flow field or [Nx*Ny,Nx*Ny] sparse motion matrix
+        if issparse(motion):
+            self.spr_mat = csr_matrix(motion)
+        else:
+            self.spr_mat = get_sparse_motion_matrix(motion)
+        # weights in the precision of the dtype policy (utils.precision)
+        self.spr_mat = self.spr_mat.astype(real_dtype(self.spr_mat), copy=False)
+        self.spr_mat_t = self.spr_mat.transpose().tocsr()
+        # correction pertaining to errors in discrete interpolations with large jacobians
+        self.norm_fwd = self._inverse_norm(self.spr_mat)
+        self.norm_adj = self._inverse_norm(self.spr_mat_t)
+
+    @staticmethod
+    def _inverse_norm(spr_mat):
+        # reciprocal row sums, zero where no pixel contributes (mind nans)
+        m_norm = np.asarray(spr_mat.sum(axis=1, dtype=spr_mat.dtype)).ravel()
+        inv_norm = np.zeros_like(m_norm)
+        np.divide(1, m_norm, out=inv_norm, where=m_norm != 0)
+        return inv_norm
+
+    def _apply(self, img, spr_mat, inv_norm):
+        img = np.asarray(img)
+        Nx, Ny = np.shape(img)[0], np.shape(img)[1]
+        dtype = complex_dtype(img)
+        out = (spr_mat @ np.reshape(img, (Nx*Ny,), order='F')) * inv_norm
+        return np.reshape(out.astype(dtype, copy=False), (Nx, Ny), order='F')
+
+    @profiled()
+    def forward(self, img):
+        # same as apply_sparse_motion(img, spr_mat, 0)
+        return self._apply(img, self.spr_mat, self.norm_fwd)
+
+    @profiled()
+    def adjoint(self, img):
+        # same as apply_sparse_motion(img, spr_mat, 1)
+        return self._apply(img, self.spr_mat_t, self.norm_adj)
+
+
+def get_motion_operators(motions):
+    # motions   [Nx,Ny,2,Nt] flow fields or vertical stack of Nt sparse motion matrices
+    # return:   list of Nt MotionOperator
+    if issparse(motions):
+        N = np.shape(motions)[1]
+        Nt = np.shape(motions)[0] // N
+        motions = csr_matrix(motions)
+        return [MotionOperator(motions[t*N:(t+1)*N, :]) for t in range(Nt)]
+    return [MotionOperator(motions[:, :, :, t]) for t in range(np.shape(motions)[-1])]
+
+
+# BatchMotionOperator applies all Nt motion states at once: the forward warp is a
+# single product with the stacked [Nt*Nx*Ny, Nx*Ny] matrix, the adjoint a single
+# product with the block-diagonal matrix of the per-state transposes.
+class BatchMotionOperator():
+    def __init__(self, motions):
+        # motions   [Nx,Ny,2,Nt] flow fields, vertical stack of Nt sparse motion matrices
+        #           or list of MotionOperator
+        if isinstance(motions, (list, tuple)):
+            motions = vstack([m.spr_mat for m in motions])
+        if issparse(motions):
+            self.spr_mat = csr_matrix(motions)
+        else:
+            self.spr_mat = get_sparse_motion_matrix(motions)
+        self.spr_mat = self.spr_mat.astype(real_dtype(self.spr_mat), copy=False)
+        self.N = np.shape(self.spr_mat)[1]
+        self.Nt = np.shape(self.spr_mat)[0] // self.N
+        # entry (t*N+i, j) of the stack is entry (t*N+j, t*N+i) of blockdiag(M_t^T)
+        coo = self.spr_mat.tocoo()
+        t = coo.row // self.N
+        self.spr_mat_t = coo_matrix((coo.data, (t * self.N + coo.col, coo.row)),
+                                    shape=(self.Nt * self.N, self.Nt * self.N)).tocsr()
+        self.norm_fwd = MotionOperator._inverse_norm(self.spr_mat)
+        self.norm_adj = MotionOperator._inverse_norm(self.spr_mat_t)
+
+    @profiled()
+    def forward(self, img):
+        # img       [Nx,Ny] image
+        # return:   [Nx,Ny,Nt] image warped into every motion state
+        img = np.asarray(img)
+        Nx, Ny = np.shape(img)[0], np.shape(img)[1]
+        dtype = complex_dtype(img)
+        out = (self.spr_mat @ np.reshape(img, (Nx*Ny,), order='F')) * self.norm_fwd
+        return np.reshape(out.astype(dtype, copy=False), (Nx, Ny, self.Nt), order='F')
+
+    @profiled()
+    def adjoint(self, imgs):
+        # imgs      [Nx,Ny,Nt] one image per motion state
+        # return:   [Nx,Ny,Nt] images warped back to the reference state (sum over Nt for A^H)
+        imgs = np.asarray(imgs)
+        Nx, Ny = np.shape(imgs)[0], np.shape(imgs)[1]
+        dtype = complex_dtype(imgs)
+        out = (self.spr_mat_t @ np.reshape(imgs, (Nx*Ny*self.Nt,), order='F')) * self.norm_adj
+        return np.reshape(out.astype(dtype, copy=False), (Nx, Ny, self.Nt), order='F')
+
+
+# WarpOperator is the matrix-free counterpart of MotionOperator: bilinear (2D) / trilinear (3D)
+# interpolation and its adjoint (scatter-add) are evaluated on the fly from the flow field,
+# so only the flow and the two normalizations are stored (O(N) instead of the 4N (8N in 3D)
+# weights plus 64-bit indices of the sparse matrix), which also makes 3D volumes feasible.
+# Same stencil, boundary handling and Jacobian normalization as get_sparse_motion_matrix /
+# apply_sparse_motion; with normalize=False forward and adjoint are exact adjoints (M, M^T).
+class WarpOperator():
+    def __init__(self, flow, normalize=True):
+        # flow       [Nx,Ny,2] or [Nx,Ny,Nz,3] flow field
+        # normalize  apply the Jacobian normalization of apply_sparse_motion
+        flow = np.asarray(flow)
+        self.shape = np.shape(flow)[:-1]
+        if len(self.shape) not in (2, 3) or np.shape(flow)[-1] != len(self.shape):
+            raise ValueError('WarpOperator expects a [Nx,Ny,2] or [Nx,Ny,Nz,3] flow field, got %s' % (np.shape(flow),))
+        self.N = int(np.prod(self.shape))
+        self.flow = flow.astype(real_dtype(flow), copy=False)
+        self.normalize = normalize
+        if normalize:
+            row_sums = np.zeros(self.N, dtype=self.flow.dtype)
+            col_sums = np.zeros(self.N, dtype=self.flow.dtype)
+            for idx, w in self._stencil():
+                row_sums += w
+                col_sums += np.bincount(idx, w, minlength=self.N).astype(self.flow.dtype, copy=False)
+            self.norm_fwd = self._reciprocal(row_sums)
+            self.norm_adj = self._reciprocal(col_sums)
+
+    @staticmethod
+    def _reciprocal(m_norm):
+        # zero where no pixel contributes (mind nans)
+        inv_norm = np.zeros_like(m_norm)
+        np.divide(1, m_norm, out=inv_norm, where=m_norm != 0)
+        return inv_norm
+
+    def _stencil(self):
+        # yields (linear index, weight) of the 2^d interpolation corners of all pixels, linear
+        # index in Fortran order as in apply_sparse_motion; out of FOV corners get zero weight
+        d = len(self.shape)
+        base, frac = [], []
+        for k in range(d):
+            u = self.flow[..., k]
+            grid = np.reshape(np.arange(self.shape[k]), [-1 if j == k else 1 for j in range(d)])
+            base.append((grid + np.floor(u)).astype(np.int64))
+            frac.append(u - np.floor(u))
+        for corner in np.ndindex(*(2,) * d):
+            w = np.ones(self.shape, dtype=self.flow.dtype)
+            outside = np.zeros(self.shape, dtype=bool)
+            coords = []
+            for k in range(d):
+                w = w * (frac[k] if corner[k] else 1 - frac[k])
+                c = base[k] + corner[k]
+                outside |= (c < 0) | (c > self.shape[k] - 1)
+                coords.append(np.clip(c, 0, self.shape[k] - 1))
+            w[outside] = 0
+            idx = np.ravel_multi_index(coords, self.shape, order='F')
+            yield np.ravel(idx, order='F'), np.ravel(w, order='F')
+
+    @profiled()
+    def forward(self, img):
+        # same as apply_sparse_motion(img, get_sparse_motion_matrix(flow), 0) (gather)
+        img = np.asarray(img)
+        x = np.reshape(img, (self.N,), order='F')
+        out = np.zeros(self.N, dtype=complex_dtype(img))
+        for idx, w in self._stencil():
+            out += w * x[idx]
+        if self.normalize:
+            out *= self.norm_fwd
+        return np.reshape(out, self.shape, order='F')
+
+    @profiled()
+    def adjoint(self, img):
+        # same as apply_sparse_motion(img, get_sparse_motion_matrix(flow), 1) (scatter-add)
+        img = np.asarray(img)
+        y = np.reshape(img, (self.N,), order='F')
+        out_r = np.zeros(self.N)
+        out_i = np.zeros(self.N)
+        for idx, w in self._stencil():
+            out_r += np.bincount(idx, w * y.real, minlength=self.N)
+            out_i += np.bincount(idx, w * y.imag, minlength=self.N)
+        out = np.empty(self.N, dtype=complex_dtype(img))
+        out.real = out_r
+        out.imag = out_i
+        if self.normalize:
+            out *= self.norm_adj
+        return np.reshape(out, self.shape, order='F')
+
+
+def get_warp_operators(flows, normalize=True):
+    # flows     [Nx,Ny,2,Nt] or [Nx,Ny,Nz,3,Nt] flow fields
+    # return:   list of Nt WarpOperator (drop-in motions for BatchForwardOp / BatchAdjointOp)
+    return [WarpOperator(flows[..., t], normalize) for t in range(np.shape(flows)[-1])]
+
+
+# BatchWarpOperator is the matrix-free counterpart of BatchMotionOperator (batched mode of
+# BatchForwardOp / BatchAdjointOp): all Nt states stacked along the last axis.
+class BatchWarpOperator():
+    def __init__(self, flows, normalize=True):
+        # flows     [Nx,Ny,2,Nt] or [Nx,Ny,Nz,3,Nt] flow fields or list of WarpOperator
+        if isinstance(flows, (list, tuple)):
+            self.operators = list(flows)
+        else:
+            self.operators = get_warp_operators(flows, normalize)
+        self.Nt = len(self.operators)
+
+    @profiled()
+    def forward(self, img):
+        # img       [Nx,Ny(,Nz)] image
+        # return:   [Nx,Ny(,Nz),Nt] image warped into every motion state
+        return np.stack([op.forward(img) for op in self.operators], -1)
+
+    @profiled()
+    def adjoint(self, imgs):
+        # imgs      [Nx,Ny(,Nz),Nt] one image per motion state
+        # return:   [Nx,Ny(,Nz),Nt] images warped back to the reference state (sum over Nt for A^H)
+        return np.stack([op.adjoint(imgs[..., t]) for t, op in enumerate(self.operators)], -1)
+
+
+# ELL (fixed-stencil) storage of the motion matrices: every row has at most 4 nonzeros, so each
+# state is an int32 column index array [N,4] plus a float32 weight array [N,4] (32 bytes per pixel
+# and state instead of ~72 for CSR with 64-bit indices, and no stored transpose; 48 bytes with the
+# float64 weights of the 'double' precision policy). Unused slots
+# have weight 0. Linear indexes li = x + Nx*y as in get_sparse_motion_matrix.
+
+def get_ell_motion_matrix(flow_field, dtype=np.float32):
+  # flow_field  [Nx,Ny,2] or [Nx,Ny,2,Nt] flow field(s)
+  # return:     indexes [Nt,N,4] (int32), weights [Nt,N,4] (dtype)
+  flow_field = np.asarray(flow_field)
+  if flow_field.ndim == 3:
+    flow_field = flow_field[..., np.newaxis]
+  Nx, Ny, _, Nt = np.shape(flow_field)
+  x, y = np.meshgrid(np.arange(Nx), np.arange(Ny), indexing='ij')
+  idx = np.empty((Nt, Nx*Ny, 4), dtype=np.int32)
+  wgt = np.empty((Nt, Nx*Ny, 4), dtype=dtype)
+  for t in range(Nt):
+    ux = flow_field[:, :, 0, t]
+    uy = flow_field[:, :, 1, t]
+    x1 = np.floor(x + ux).astype(np.int64)
+    y1 = np.floor(y + uy).astype(np.int64)
+    wx = ux - np.floor(ux)
+    wy = uy - np.floor(uy)
+    corners = [((1 - wx) * (1 - wy), x1, y1),
+               ((1 - wx) * wy, x1, y1 + 1),
+               (wx * (1 - wy), x1 + 1, y1),
+               (wx * wy, x1 + 1, y1 + 1)]
+    for k, (w, xc, yc) in enumerate(corners):
+      w = bound_weight_array(w, xc, yc, Nx, Ny)
+      idx[t, :, k] = np.ravel(lin_index_array(bound_index_array(xc, Nx), bound_index_array(yc, Ny), Nx), order='F')
+      wgt[t, :, k] = np.ravel(w, order='F')
+  return idx, wgt
+
+def csr_to_ell(spr_mat, dtype=np.float32):
+  # spr_mat     [Nt*N,N] (stacked) sparse motion matrix with at most 4 nonzeros per row
+  # return:     indexes [Nt,N,4] (int32), weights [Nt,N,4] (dtype)
+  spr_mat = csr_matrix(spr_mat)
+  spr_mat.sum_duplicates()
+  R, N = np.shape(spr_mat)
+  counts = np.diff(spr_mat.indptr)
+  if np.any(counts > 4):
+    raise ValueError('ELL storage holds at most 4 nonzeros per row, got %d' % counts.max())
+  rows = np.repeat(np.arange(R), counts)
+  slots = np.arange(spr_mat.nnz) - spr_mat.indptr[rows]
+  idx = np.zeros((R, 4), dtype=np.int32)
+  wgt = np.zeros((R, 4), dtype=dtype)
+  idx[rows, slots] = spr_mat.indices
+  wgt[rows, slots] = spr_mat.data
+  return np.reshape(idx, (R // N, N, 4)), np.reshape(wgt, (R // N, N, 4))
+
+def ell_to_csr(idx, wgt):
+  # idx, wgt    [Nt,N,4] ELL indexes and weights
+  # return:     [Nt*N,N] stacked CSR motion matrix (zero weights dropped)
+  Nt, N, K = np.shape(idx)
+  rows = np.repeat(np.arange(Nt*N), K)
+  nz = np.ravel(wgt) != 0
+  return coo_matrix((np.ravel(wgt)[nz], (rows[nz], np.ravel(idx)[nz].astype(np.int64))), shape=(Nt*N, N)).tocsr()
+
+
+# ELLMotionOperator applies all Nt states from ELL storage (batched mode of BatchForwardOp /
+# BatchAdjointOp). A row-major [N,4] ELL block is a CSR matrix with a fixed stride of 4, so the
+# index and weight arrays are wrapped without copy and applied with scipy's compiled kernels:
+# the forward warp is one CSR product of the stacked states (gather), the adjoint the CSC
+# product of each state's transposed view (scatter-add). The Jacobian normalizations are
+# precomputed once.
+class ELLMotionOperator():
+    def __init__(self, motions, dtype=None):
+        # motions   [Nx,Ny,2] / [Nx,Ny,2,Nt] flow fields, (stacked) sparse motion matrix or (indexes, weights)
+        # dtype     weight dtype, default: real dtype of the precision policy (utils.precision), e.g. np.float32
+        #           keeps the compact storage for double precision images (one upcast copy on first use)
+        if dtype is None:
+            dtype = real_dtype()
+        if isinstance(motions, tuple):
+            idx, wgt = motions
+        elif issparse(motions):
+            idx, wgt = csr_to_ell(motions, dtype)
+        else:
+            idx, wgt = get_ell_motion_matrix(motions, dtype)
+        self.idx = np.ascontiguousarray(idx, dtype=np.int32)
+        # weights cast once here, not in every product
+        self.wgt = np.ascontiguousarray(wgt, dtype=dtype)
+        self.Nt, self.N, K = np.shape(self.idx)
+        self.indptr = np.arange(0, self.Nt*self.N*K + 1, K, dtype=np.int32 if self.Nt*self.N*K < 2**31 else np.int64)
+        # stacked and per-state CSR views of the weights, per weight dtype (see _matrices)
+        self.matrices = {}
+        self.spr_mat, self.states = self._matrices(self.wgt.dtype)
+        # correction pertaining to errors in discrete interpolations with large jacobians
+        self.norm_fwd = WarpOperator._reciprocal(np.sum(self.wgt, axis=2, dtype=self.wgt.dtype))
+        col_sums = [np.bincount(np.ravel(self.idx[t]), np.ravel(self.wgt[t]), minlength=self.N) for t in range(self.Nt)]
+        self.norm_adj = WarpOperator._reciprocal(np.array(col_sums, dtype=self.wgt.dtype))
+
+    def _matrices(self, dtype):
+        # stacked [Nt*N,N] and per-state [N,N] CSR matrices with weights of the given real dtype; the views of
+        # the stored weights are wrapped without copy, a higher precision image (e.g. complex128 with float32
+        # weights) gets one upcast copy of the weights on first use instead of an upcast in every product
+        if dtype not in self.matrices:
+            wgt = self.wgt.astype(dtype, copy=False)
+            spr_mat = csr_matrix((np.ravel(wgt), np.ravel(self.idx), self.indptr), shape=(self.Nt*self.N, self.N),
+                                 copy=False)
+            states = [csr_matrix((np.ravel(wgt[t]), np.ravel(self.idx[t]), self.indptr[:self.N + 1]),
+                                 shape=(self.N, self.N), copy=False) for t in range(self.Nt)]
+            self.matrices[dtype] = (spr_mat, states)
+        return self.matrices[dtype]
+
+    @property
+    def nbytes(self):
+        # storage of indexes, weights, row pointers and normalizations
+        return self.idx.nbytes + self.wgt.nbytes + self.indptr.nbytes + self.norm_fwd.nbytes + self.norm_adj.nbytes
+
+    def tocsr(self):
+        # [Nt*N,N] stacked CSR motion matrix (e.g. for BatchMotionOperator / MotionOperator)
+        return ell_to_csr(self.idx, self.wgt)
+
+    @staticmethod
+    def _apply(spr_mat, x, dtype):
+        # real and imaginary part separately with the real kernel of the matching precision
+        x = np.ascontiguousarray(x, dtype=dtype)
+        out = np.empty(np.shape(spr_mat)[0], dtype=dtype)
+        out.real = spr_mat @ np.ascontiguousarray(x.real)
+        out.imag = spr_mat @ np.ascontiguousarray(x.imag)
+        return out
+
+    @profiled()
+    def forward(self, img):
+        # img       [Nx,Ny] image
+        # return:   [Nx,Ny,Nt] image warped into every motion state
+        img = np.asarray(img)
+        Nx, Ny = np.shape(img)[0], np.shape(img)[1]
+        dtype = complex_dtype(img)
+        x = np.reshape(img, (Nx*Ny,), order='F')
+        spr_mat, _ = self._matrices(np.finfo(dtype).dtype)
+        out = self._apply(spr_mat, x, dtype) * np.ravel(self.norm_fwd)
+        return np.reshape(out, (Nx, Ny, self.Nt), order='F')
+
+    @profiled()
+    def adjoint(self, imgs):
+        # imgs      [Nx,Ny,Nt] one image per motion state
+        # return:   [Nx,Ny,Nt] images warped back to the reference state (sum over Nt for A^H)
+        imgs = np.asarray(imgs)
+        Nx, Ny = np.shape(imgs)[0], np.shape(imgs)[1]
+        dtype = complex_dtype(imgs)
+        y = np.reshape(imgs, (Nx*Ny, self.Nt), order='F')
+        out = np.empty((Nx*Ny, self.Nt), dtype=dtype)
+        _, states = self._matrices(np.finfo(dtype).dtype)
+        for t in range(self.Nt):
+            # CSC product with the transposed view (scatter-add)
+            out[:, t] = self._apply(states[t].T, y[:, t], dtype) * self.norm_adj[t]
+        return np.reshape(out, (Nx, Ny, self.Nt), order='F')
+
+
+# Translation-only motion: a (circular) shift out[n] = img[n + d] is a linear phase ramp in k-space,
+# F{img[n + d]}[k] = exp(2 pi i (k - N/2) d / N) F{img}[k] (centered FFT), i.e. exact for any
+# sub-pixel shift without interpolation blur and without image-domain resampling.
+
+def translation_phase(shape, shifts, dtype=np.complex128):
+  # shape       image shape [Nx,Ny]
+  # shifts      [2] or [Nt,2] shifts d in the flow convention (numpy axis order, pixels)
+  # return:     phase ramps [Nx,Ny] or [Nx,Ny,Nt]
+  d = np.atleast_2d(np.asarray(shifts, dtype='float'))
+  kx = (np.arange(shape[0]) - shape[0] // 2) / shape[0]
+  ky = (np.arange(shape[1]) - shape[1] // 2) / shape[1]
+  ramp = np.exp(2j * np.pi * kx[:, np.newaxis, np.newaxis] * d[:, 0]) * np.exp(2j * np.pi * ky[np.newaxis, :, np.newaxis] * d[:, 1])
+  ramp = ramp.astype(dtype, copy=False)
+  if np.ndim(shifts) == 1:
+    return ramp[..., 0]
+  return ramp
+
+def get_translation_shifts(flows, tol=1e-6):
+  # flows       [Nx,Ny,2] or [Nx,Ny,2,Nt] flow fields
+  # return:     [Nt,2] shifts if every state is a pure translation (spatially constant flow), else None
+  flows = np.asarray(flows)
+  if flows.ndim == 3:
+    flows = flows[..., np.newaxis]
+  if flows.ndim != 4 or np.shape(flows)[2] != 2:
+    return None
+  shifts = flows[0, 0]
+  if np.max(np.abs(flows - shifts), initial=0) > tol:
+    return None
+  return np.ascontiguousarray(shifts.T)
+
+
+# TranslationMotion holds translation-only motion states for BatchForwardOp / BatchAdjointOp, which
+# then evaluate the Batchelor model in k-space: one FFT of the coil images of the reference image,
+# modulated per k-space point by the phase ramp of the state it is sampled in (sum_t masks_t ramp_t),
+# instead of Nt image-domain warps and Nt multi-coil FFTs. The ramps shift the coil images, so the coil maps
+# move along with the object and the shift wraps around the FOV (circular), unlike the image-domain warps
+# with static coil maps. This is a different forward model, an approximation for smooth coil maps and
+# objects surrounded by background, and therefore only used when a TranslationMotion is passed explicitly.
+class TranslationMotion():
+    def __init__(self, shifts):
+        # shifts    [Nt,2] shifts (flow convention) or [Nx,Ny,2,Nt] spatially constant flow fields
+        shifts = np.asarray(shifts, dtype='float')
+        if shifts.ndim > 2:
+            flows = shifts
+            shifts = get_translation_shifts(flows)
+            if shifts is None:
+                raise ValueError('TranslationMotion requires spatially constant flow fields')
+        self.shifts = np.atleast_2d(shifts)
+        self.Nt = len(self.shifts)
+        self.ramps = {}
+
+    def phase(self, shape, dtype=np.complex128):
+        # [Nx,Ny,Nt] phase ramps, cached per shape and dtype
+        key = (tuple(shape), np.dtype(dtype).str)
+        if key not in self.ramps:
+            self.ramps[key] = translation_phase(shape, self.shifts, dtype)
+        return self.ramps[key]
+
+    def modulation(self, masks, dtype=np.complex128):
+        # masks     [Nx,Ny,Nc,Nt] sampling masks per state
+        # return:   [Nx,Ny,Nc] k-space modulation sum_t masks_t ramp_t
+        ramp = self.phase(np.shape(masks)[:2], dtype)
+        return np.einsum('xyct,xyt->xyc', masks, ramp)
+
+    def forward(self, img):
+        # [Nx,Ny,Nt] image shifted into every motion state (image domain, via the k-space ramps)
+        img = np.asarray(img)
+        dtype = complex_dtype(img)
+        ramp = self.phase(np.shape(img)[:2], dtype)
+        ax = (0, 1)
+        k = np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(img, axes=ax), axes=ax), axes=ax)
+        out = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(k[..., np.newaxis] * ramp, axes=ax), axes=ax), axes=ax)
+        return out.astype(dtype, copy=False)
+
+    def adjoint(self, imgs):
+        # [Nx,Ny,Nt] images shifted back to the reference state (sum over Nt for A^H)
+        imgs = np.asarray(imgs)
+        dtype = complex_dtype(imgs)
+        ramp = self.phase(np.shape(imgs)[:2], dtype)
+        ax = (0, 1)
+        k = np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(imgs, axes=ax), axes=ax), axes=ax)
+        out = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(k * np.conj(ramp), axes=ax), axes=ax), axes=ax)
+        return out.astype(dtype, copy=False)
+
+
+# operators selecting the batched mode of BatchForwardOp / BatchAdjointOp
+BATCH_MOTION_OPERATORS = (BatchMotionOperator, BatchWarpOperator, ELLMotionOperator)
+
 if __name__ == "__main__":
     #######################
     ## MAIN for simple test
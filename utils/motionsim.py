@@ -1,10 +1,12 @@
 import numpy as np
+from functools import lru_cache
 from utils.mri import mriForwardOp
+from utils.motioncomp import translation_phase
 import SimpleITK as sitk
 import matplotlib.pyplot as plt
 
 
-def simulate_motion(img_cc, smaps, mask, p):
+def simulate_motion(img_cc, smaps, mask, p, tol=0, phase_ramp=False):
     # img_cc      motion-free coil-combined image
     # smaps       coil sensitivity maps
     # mask        k-space sampling mask
@@ -12,10 +14,18 @@ def simulate_motion(img_cc, smaps, mask, p):
     #             b) affine motion course (time-dependent or time-constant), nPE x 6
     #             np.abs(p[:, :5]) > 0 = mask_motion; time points of phase-encoding steps
     #             at which motion parameters > 0 are defined, i.e. motion is happening
+    # tol         time-dependent motion: parameter rows which agree up to tol are merged into
+    #             one motion state (0: only identical rows are merged)
+    # phase_ramp  opt-in: translation-only motion (p[2:] == [0, 0, 1, 1]) is applied as per-line phase ramps on
+    #             the k-space of the reference image (no resampling, exact sub-pixel shifts), otherwise by
+    #             image-domain warping per motion state. The ramps shift the coil images, i.e. the coil maps
+    #             move with the object and the shift is circular, unlike the warp with static coil maps
     # return:     motion-affected k-space, motion mask
 
     kspace = mriForwardOp(img_cc, mask, smaps)
     p = np.asarray(p)
+    if phase_ramp and is_translation(p):
+        return translate_kspace(kspace, p)
     tmp = np.unique(p, axis=0)
     if len(np.shape(p)) == 1:
         mask_motion = np.ones_like(kspace)
@@ -26,15 +36,306 @@ def simulate_motion(img_cc, smaps, mask, p):
     if len(np.shape(p)) == 1 or np.shape(tmp[~np.all(tmp == 0, axis=1)])[0] == 1:  # constant motion over time
         if len(np.shape(p)) != 1:
             p = np.squeeze(tmp[~np.all(tmp == 0, axis=1)])
-        kspace_motion = mriForwardOp(transform_img(img_cc, p), mask, smaps)
+        kspace_motion = mriForwardOp(warp_affine(img_cc, p), mask, smaps)
         return kspace * (1 - mask_motion) + kspace_motion * mask_motion, mask_motion
     else:  # time-dependent motion
+        # one transform + forward operator per unique motion state, scattered back to its lines
         kspace_aff = np.zeros_like(kspace)
-        for ky in np.arange(np.shape(img_cc)[1]):
-            kspace_aff[:, ky, :] = mriForwardOp(transform_img(img_cc, p[ky, :]), mask, smaps)[:, ky, :]
+        nPE = np.shape(img_cc)[1]
+        states, labels = group_motion_states(p[:nPE, :], tol)
+        img_states = warp_affine(img_cc, states)  # all motion states in one vectorized warp
+        for istate in range(np.shape(states)[0]):
+            lines = np.flatnonzero(labels == istate)
+            kspace_aff[:, lines, :] = mriForwardOp(img_states[..., istate], mask, smaps)[:, lines, :]
         return kspace_aff, mask_motion
 
 
+def is_translation(p):
+    # True if all rows of the motion parameters / course are translations (or all-zero, i.e. motion-free)
+    p = np.atleast_2d(np.asarray(p, dtype='float'))
+    if np.shape(p)[1] != 6:
+        return False
+    return bool(np.all(np.all(p == 0, axis=1) | np.all(p[:, 2:] == IDENTITY[2:], axis=1)))
+
+
+def translation_shifts(p):
+    # shifts d [.., 2] (numpy axis order) of translations p, warp_affine(img, p)[n] = img[n + d]; all-zero rows: no shift
+    p = np.asarray(p, dtype='float')
+    return np.stack([p[..., 1], p[..., 0]], -1)
+
+
+def translate_kspace(kspace, p):
+    # kspace      k-space of the motion-free image [Nx, Ny, ...]
+    # p           translation (1x6, all lines) or translation course (one row per phase-encoding line)
+    # return:     motion-affected k-space, motion mask (as simulate_motion)
+    Nx, Ny = np.shape(kspace)[:2]
+    expand = (np.newaxis,) * (np.ndim(kspace) - 2)
+    if np.ndim(p) == 1:
+        mask_motion = np.ones_like(kspace)
+        return kspace * translation_phase((Nx, Ny), translation_shifts(p))[(Ellipsis,) + expand], mask_motion
+    p = p[:Ny]
+    mask_motion = np.abs(np.sum(p[:, :5], axis=1)) > 0
+    mask_motion = np.tile(mask_motion[np.newaxis, :, np.newaxis], (Nx, 1, np.shape(kspace)[-1]))
+    # phase ramp of line j under the shift of its acquisition step: exp(2 pi i (kx dx / Nx + ky_j dy / Ny))
+    d = translation_shifts(p)
+    kx = (np.arange(Nx) - Nx // 2) / Nx
+    ky = (np.arange(len(p)) - Ny // 2) / Ny
+    ramp = np.exp(2j * np.pi * (kx[:, np.newaxis] * d[np.newaxis, :, 0] + (ky * d[:, 1])[np.newaxis, :]))
+    kspace = np.array(kspace, dtype=np.result_type(kspace, np.complex64))
+    kspace[:, :len(p)] *= ramp[(Ellipsis,) + expand].astype(kspace.dtype, copy=False)
+    return kspace, mask_motion
+
+
+def group_motion_states(p, tol=0):
+    # p           motion course, nPE x n_params
+    # tol         rows agreeing up to tol (per parameter, quantization step) are merged
+    # return:     unique motion states K x n_params (mean of the merged rows), state index per row (nPE)
+    p = np.asarray(p, dtype='float')
+    if tol <= 0:
+        states, labels = np.unique(p, axis=0, return_inverse=True)
+        return states, np.ravel(labels)
+    _, labels = np.unique(np.round(p / tol).astype(np.int64), axis=0, return_inverse=True)
+    labels = np.ravel(labels)
+    counts = np.bincount(labels)
+    states = np.zeros((len(counts), np.shape(p)[1]))
+    np.add.at(states, labels, p)
+    return states / counts[:, np.newaxis], labels
+
+
+def stream_motion(img_cc, smaps, mask, p, chunk_size=1, order=None, tol=0, phase_ramp=False):
+    # img_cc      motion-free coil-combined image [Nx, Ny] or multi-slice [Nx, Ny, Nslices]
+    # smaps       coil sensitivity maps [Nx, Ny, Nc] or [Nx, Ny, Nslices, Nc]
+    # mask        k-space sampling mask (broadcastable to k-space), non-sampled phase-encoding lines are skipped
+    # p           affine motion parameters (constant) or motion course, one row per acquisition step
+    #             (all-zero rows: motion-free), see simulate_motion
+    # chunk_size  number of phase-encoding lines per shot
+    # order       acquisition order of the phase-encoding lines (default: linear)
+    # tol         merging tolerance of motion states (see group_motion_states)
+    # phase_ramp  opt-in: translation-only states are phase ramps on the lines of the reference k-space
+    #             (coil maps move with the object, see simulate_motion)
+    # yields:     (lines, k-space chunk [Nx, len(lines), ..., Nc], state index), in acquisition order;
+    #             a shot with several motion states is split into one chunk per state
+    # Only the coil images of the current motion state are kept in memory.
+    img_cc = np.asarray(img_cc)
+    smaps = np.asarray(smaps)
+    mask = np.asarray(mask)
+    Ny = np.shape(img_cc)[1]
+    order = np.arange(Ny) if order is None else np.asarray(order)
+    states, line_states = get_line_states(p, Ny, order, tol)
+    acquired = np.any(np.reshape(np.moveaxis(mask != 0, 1, 0), (np.shape(mask)[1], -1)), axis=1)
+    order = order[acquired[order]]
+
+    translation = phase_ramp and is_translation(states)
+    if translation:
+        Nx = np.shape(img_cc)[0]
+        shifts = translation_shifts(states)
+        expand = (np.newaxis,) * (np.ndim(smaps) - 1)
+
+    current, coil_x = None, None
+    for start in range(0, len(order), chunk_size):
+        shot = order[start:start + chunk_size]
+        _, first = np.unique(line_states[shot], return_index=True)
+        for state in line_states[shot][np.sort(first)]:
+            lines = shot[line_states[shot] == state]
+            if translation:
+                # only the reference coil images, shifted states are phase ramps on its lines
+                if coil_x is None:
+                    coil_x = fft_readout(smaps * img_cc[..., np.newaxis])
+                chunk = fft_lines(coil_x, lines) * mask[:, lines]
+                if state >= 0:
+                    ramp = translation_phase((Nx, Ny), shifts[state])[:, lines]
+                    chunk = chunk * ramp[(Ellipsis,) + expand[1:]].astype(chunk.dtype, copy=False)
+                yield lines, chunk, state
+                continue
+            if state != current:
+                img = img_cc if state < 0 else warp_pose(img_cc, states[state])
+                coil_x = fft_readout(smaps * img[..., np.newaxis])
+                current = state
+            yield lines, fft_lines(coil_x, lines) * mask[:, lines], state
+
+
+def simulate_motion_stream(img_cc, smaps, mask, p, out=None, callback=None, chunk_size=1, order=None, tol=0,
+                           phase_ramp=False):
+    # img_cc, smaps, mask, p, chunk_size, order, tol, phase_ramp: see stream_motion
+    # out         None: k-space in memory, str: path of a memory-mapped .npy file,
+    #             array/np.memmap: preallocated output, False: do not store (use callback)
+    # callback    called per chunk as callback(lines, kspace_chunk, state)
+    # return:     motion-affected k-space (None if out is False), motion state index per phase-encoding line
+    #             (-1: motion-free, replaces the dense motion mask of simulate_motion), motion states K x n_params
+    img_cc = np.asarray(img_cc)
+    Ny = np.shape(img_cc)[1]
+    shape = np.shape(img_cc)[:2] + np.shape(smaps)[2:]
+    dtype = np.result_type(img_cc, smaps, np.complex64)
+    if out is None:
+        out = np.zeros(shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+
+    for lines, chunk, state in stream_motion(img_cc, smaps, mask, p, chunk_size, order, tol, phase_ramp):
+        if out is not False:
+            out[:, lines] = chunk
+        if callback is not None:
+            callback(lines, chunk, state)
+    if isinstance(out, np.memmap):
+        out.flush()
+    states, line_states = get_line_states(p, Ny, np.arange(Ny) if order is None else order, tol)
+    return (None if out is False else out), line_states, states
+
+
+def get_line_states(p, Ny, order, tol=0):
+    # p           affine motion parameters (constant) or motion course, one row per acquisition step
+    # Ny          number of phase-encoding lines
+    # order       acquisition order of the phase-encoding lines
+    # return:     motion states K x n_params, state index per phase-encoding line (-1: motion-free)
+    p = np.asarray(p, dtype='float')
+    if np.ndim(p) == 1:
+        return p[np.newaxis, :], np.zeros(Ny, dtype=np.int32)
+    p = p[:len(order)]
+    moving = ~np.all(p == 0, axis=1)
+    labels = np.full(len(p), -1, dtype=np.int32)
+    states = np.zeros((0, np.shape(p)[1]))
+    if np.any(moving):
+        states, labels[moving] = group_motion_states(p[moving], tol)
+    line_states = np.full(Ny, -1, dtype=np.int32)
+    line_states[order[:len(p)]] = labels
+    return states, line_states
+
+
+IDENTITY = np.array([0, 0, 0, 0, 1, 1], dtype='float')
+
+
+class MotionBins():
+    # result of bin_motion_states
+    # states       motion states K x 6 (motion-free state: identity parameters)
+    # line_states  state index per phase-encoding line (Ny)
+    # masks        sampling masks per state [Nx, Ny, Nc, K] (BatchForwardOp / BatchAdjointOp)
+    # flows        flow fields [Nx, Ny, 2, K] (BatchForwardOp / BatchAdjointOp)
+    # counts       number of phase-encoding lines per state
+    # max_error    maximal residual displacement per state [pixels] (over its lines and the FOV)
+    # mean_error   mean residual displacement per state [pixels] (over its lines, maximum over the FOV)
+    def __init__(self, states, line_states, masks, flows, max_error, mean_error):
+        self.states = states
+        self.line_states = line_states
+        self.masks = masks
+        self.flows = flows
+        self.counts = np.bincount(line_states, minlength=len(states))
+        self.max_error = max_error
+        self.mean_error = mean_error
+
+    @property
+    def Nt(self):
+        return len(self.states)
+
+    def __repr__(self):
+        return 'MotionBins(Nt=%d, max_error=%.3f px)' % (self.Nt, np.max(self.max_error, initial=0))
+
+
+def get_corner_displacements(shape, p):
+    # displacements [K, 4, 2] of the sampling positions of warp_affine at the FOV corners; the difference of two
+    # affine displacement fields is affine in the position, i.e. its maximal norm over the FOV is attained at a corner
+    M = get_resample_matrices(shape, np.atleast_2d(p))
+    Nx, Ny = shape
+    corners = np.array([[0, 0, 1], [Ny - 1, 0, 1], [0, Nx - 1, 1], [Ny - 1, Nx - 1, 1]], dtype='float').T
+    return np.swapaxes(M[:, 0:2, :] @ corners - corners[np.newaxis, 0:2, :], 1, 2)
+
+
+def displacement_distance(a, b):
+    # a [n, 4, 2], b [k, 4, 2] corner displacements -> [n, k] maximal displacement difference over the FOV [pixels]
+    return np.max(np.linalg.norm(a[:, np.newaxis] - b[np.newaxis], axis=-1), axis=-1)
+
+
+def bin_motion_states(p, shape, n_states=None, max_error=None, order=None, mask=None, n_coils=1, max_iter=20):
+    # p           motion course (simulated or estimated), one row per acquisition step, nPE x 6 (all-zero rows: motion-free)
+    # shape       image shape [Nx, Ny]
+    # n_states    target number of motion states (including the motion-free state)
+    # max_error   target maximal residual displacement [pixels], used if n_states is None (default: 0.5)
+    # order       acquisition order of the phase-encoding lines (default: linear), lines beyond the course are motion-free
+    # mask        sampling mask [Nx, Ny, Nc] (default: fully sampled with n_coils coils)
+    # max_iter    maximal number of refinement iterations
+    # return:     MotionBins
+    # The steps are clustered by the displacement they cause (farthest-point seeding up to the target, which bounds
+    # the residual by max_error, then k-means refinement as long as the target stays met); each state is the mean of
+    # its steps' parameters. Fewer states mean proportionally fewer warps and FFTs in BatchForwardOp / BatchAdjointOp.
+    Nx, Ny = shape
+    if n_states is None and max_error is None:
+        max_error = 0.5
+    p = np.atleast_2d(np.asarray(p, dtype='float'))
+    order = np.arange(Ny) if order is None else np.asarray(order)
+    p = p[:len(order)]
+    moving = ~np.all(p == 0, axis=1)
+    params = np.where(moving[:, np.newaxis], p, IDENTITY)
+    feats = get_corner_displacements(shape, params)
+
+    # the motion-free state is fixed (index 0) if any line is motion-free
+    static = bool(np.any(~moving)) or len(p) < Ny
+    centers = [IDENTITY] if static else [params[np.flatnonzero(moving)[0]]]
+    while True:
+        dist = np.min(displacement_distance(feats, get_corner_displacements(shape, np.array(centers))), axis=1)
+        if np.max(dist, initial=0) <= (max_error if n_states is None else 0) or len(centers) == n_states:
+            break
+        centers.append(params[np.argmax(dist)])
+    centers = np.array(centers)
+    labels = np.argmin(displacement_distance(feats, get_corner_displacements(shape, centers)), axis=1)
+
+    def residual(states, labels):
+        return np.linalg.norm(feats - get_corner_displacements(shape, states)[labels], axis=-1).max(axis=-1)
+
+    # k-means refinement of the free states (mean parameters), accepted while the target is met
+    bound = np.max(residual(centers, labels), initial=0)
+    target = max(bound, max_error) if n_states is None else bound
+    for _ in range(max_iter):
+        states = centers.copy()
+        for k in range(int(static), len(centers)):
+            if np.any(labels == k):
+                states[k] = np.mean(params[labels == k], axis=0)
+        new_labels = np.argmin(displacement_distance(feats, get_corner_displacements(shape, states)), axis=1)
+        if np.max(residual(states, new_labels), initial=0) > target:
+            break
+        converged = np.array_equal(new_labels, labels) and np.allclose(states, centers)
+        centers, labels = states, new_labels
+        if converged:
+            break
+
+    # drop empty states (the motion-free one is kept if lines beyond the course need it)
+    used = np.unique(np.concatenate([labels, [0] if static else []]).astype(int))
+    states = centers[used]
+    labels = np.searchsorted(used, labels)
+    err = residual(states, labels)
+    K = len(states)
+    max_err = np.array([np.max(err[labels == k], initial=0) for k in range(K)])
+    mean_err = np.array([np.mean(err[labels == k]) if np.any(labels == k) else 0. for k in range(K)])
+
+    line_states = np.zeros(Ny, dtype=np.int32)
+    line_states[order[:len(p)]] = labels
+    if mask is None:
+        mask = np.ones((Nx, Ny, n_coils), dtype=np.float32)
+    masks = mask[..., np.newaxis] * (line_states[np.newaxis, :, np.newaxis, np.newaxis] == np.arange(K)).astype(mask.dtype)
+    flows = get_sampling_flow(shape, states)
+    return MotionBins(states, line_states, masks, flows, max_err, mean_err)
+
+
+def warp_pose(img, p):
+    # 2D motion parameters are applied slice by slice to multi-slice images
+    if np.ndim(img) == 3 and np.size(p) == 6:
+        return np.stack([warp_affine(img[:, :, s], p) for s in range(np.shape(img)[2])], 2)
+    return warp_affine(img, p)
+
+
+def fft_readout(coil_img):
+    # centered orthonormal FFT along the readout direction (axis 0)
+    return np.fft.fftshift(np.fft.fft(np.fft.ifftshift(coil_img, axes=0), norm='ortho', axis=0), axes=0)
+
+
+def fft_lines(coil_x, lines):
+    # centered orthonormal FFT along the phase-encoding direction (axis 1), evaluated on the given lines only:
+    # a direct DFT for short shots, a full FFT otherwise
+    Ny = np.shape(coil_x)[1]
+    if len(lines) >= np.log2(Ny):
+        return np.fft.fftshift(np.fft.fft(np.fft.ifftshift(coil_x, axes=1), norm='ortho', axis=1), axes=1)[:, lines]
+    F = np.exp(-2j * np.pi * np.outer(np.asarray(lines) - Ny // 2, np.arange(Ny) - Ny // 2) / Ny) / np.sqrt(Ny)
+    return np.moveaxis(np.tensordot(F.astype(np.result_type(coil_x, np.complex64)), coil_x, axes=([1], [1])), 0, 1)
+
+
 def plot_motion_course(motion_course, TR=1):
     # motion_course     temporal variation of motion, i.e. temporal course of motion parameters, shape: [motion_parameters, total_time]
     # TR                repetition time [ms]
@@ -60,36 +361,32 @@ def plot_motion_course(motion_course, TR=1):
 
 
 def get_transform(img, p):
-    # img      input image to be transformed
-    # p        affine transformation parameters
-    #          3D (rank(img) == 3): t_x, t_y, t_z, \phi [°], \theta [°], \psi [°], G_{xy}, G_{xz}, G_{yz}, S_x, S_y, S_z
+    # img      input image to be transformed (2D)
+    # p        affine transformation parameters, single vector or stack [K, 6]
     #          2D (rank(img) == 2): t_x, t_y, \phi [°], G_{xy}, S_x, S_y
-    # return   deformation field
-    dim = len(np.shape(img))
-    p = np.asarray(p, dtype='float')
-    if dim == 2:  # 2D
-        trans = affine_translate(p[0:2], dim)
-        rotate = affine_rotate(p[2], dim, tuple(np.asarray(np.shape(img))/2))
-        shear = affine_shear(p[3], dim)
-        scale = affine_scale(p[4:], dim)
-    else:
-        trans = affine_translate(p[0:4], dim)
-        rotate = affine_rotate(p[4:7], dim, tuple(np.asarray(np.shape(img))/2))
-        shear = affine_shear(p[7:6], dim)
-        scale = affine_scale(p[6:], dim)
-
-    affine = sitk.CompositeTransform([trans, rotate, shear, scale])
-    XX, YY = np.meshgrid(np.linspace(0, np.shape(img)[0], np.shape(img)[0]), np.linspace(0, np.shape(img)[1], np.shape(img)[1]))
-
-    # Transform points and compute deformation vectors.
-    pointsX = np.zeros(XX.shape)
-    pointsY = np.zeros(XX.shape)
-    for index, value in np.ndenumerate(XX):
-        px,py = affine.TransformPoint((value, YY[index]))
-        pointsX[index]=px - value
-        pointsY[index]=py - YY[index]
-
-    return np.stack([pointsX, pointsY], -1)
+    # return   deformation field [Nx, Ny, 2], or [Nx, Ny, 2, K] for a parameter stack
+    shape = np.shape(img)
+    if len(shape) != 2:
+        raise NotImplementedError('Only 2D deformation fields implemented')
+
+    # displacement of the composite transform in closed form: (A - I) q + b, for all grid points at once
+    M = get_resample_matrices(shape, p)
+    XX, YY = get_transform_grid(shape)
+    q = np.stack([XX.ravel(), YY.ravel()], 0)
+    u = (M[:, :2, :2] - np.eye(2)) @ q + M[:, :2, 2:]
+    u = np.moveaxis(np.reshape(u, (-1, 2) + XX.shape), (0, 1), (-1, -2))
+    if np.ndim(p) == 1:
+        return u[..., 0]
+    return u
+
+
+@lru_cache(maxsize=8)
+def get_transform_grid(shape):
+    # sampling points of get_transform (linspace over the image extent), read-only
+    XX, YY = np.meshgrid(np.linspace(0, shape[0], shape[0]), np.linspace(0, shape[1], shape[1]))
+    XX.flags.writeable = False
+    YY.flags.writeable = False
+    return XX, YY
 
 
 def transform_img(img, p):
@@ -191,11 +488,18 @@ def resample(image, transform, interpolator=sitk.sitkLinear, default_value=0.0):
 
 
 def get_affine_matrix(img, p):
+    # img      input image (2D)
+    # p        affine transformation parameters t_x, t_y, \phi [°], G_{xy}, S_x, S_y, single vector or stack [K, 6]
+    # return   [3, 3] affine matrix, or [K, 3, 3] for a parameter stack
     if len(np.shape(img)) > 2:
-        raise "Only 2D processing implemented"
+        raise NotImplementedError('Only 2D processing implemented')
     x, y = np.shape(img)
     x /= 2
     y /= 2
+    p = np.asarray(p, dtype='float')
+    ps = np.atleast_2d(p)
+    K = np.shape(ps)[0]
+    eye = np.tile(np.eye(3), (K, 1, 1))
 
     # translation from origin to point (x,y)
     P1 = np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]])
@@ -203,51 +507,196 @@ def get_affine_matrix(img, p):
     P2 = np.array([[1, 0, x], [0, 1, y], [0, 0, 1]])
 
     # translation
-    T = np.array([[0, 0, p[0]], [0, 0, p[1]], [0, 0, 0]])
+    T = np.zeros((K, 3, 3))
+    T[:, 0:2, 2] = ps[:, 0:2]
 
     # rotation
-    radians = -np.pi * np.asarray(p[2]) / 180.
-    R = np.array([[np.cos(radians), -np.sin(radians), 0], [np.sin(radians), np.cos(radians), 0], [0, 0, 1]])
+    radians = -np.pi * ps[:, 2] / 180.
+    R = eye.copy()
+    R[:, 0, 0], R[:, 0, 1] = np.cos(radians), -np.sin(radians)
+    R[:, 1, 0], R[:, 1, 1] = np.sin(radians), np.cos(radians)
 
     # shearing
-    G = np.array([[1, p[3], 0], [0, 1, 0], [0, 0, 1]])
+    G = eye.copy()
+    G[:, 0, 1] = ps[:, 3]
 
     # scaling
-    S = np.array([[p[4], 0, 0], [0, p[5], 0], [0, 0, 1]])
+    S = eye.copy()
+    S[:, 0, 0], S[:, 1, 1] = ps[:, 4], ps[:, 5]
 
     # affine matrix
-    return np.linalg.multi_dot([P2, G, S, R, P1]) + T
+    aff = P2 @ G @ S @ R @ P1 + T
+    if p.ndim == 1:
+        return aff[0]
+    return aff
+
+@lru_cache(maxsize=8)
+def get_mesh_positions(shape):
+  # homogeneous mesh positions [3, Npix] of get_deformation_field_from_affine, read-only
+  height, width = shape
+  gridY, gridX = np.mgrid[1:width+1, 1:height+1]
+  positions = np.stack([gridX.ravel(), gridY.ravel(), np.ones(height * width)], 0).astype('float')
+  positions.flags.writeable = False
+  return positions
 
 def get_deformation_field_from_affine(img, affine_mat):
+  # affine_mat  [3, 3] or stacked [K, 3, 3] affine matrices
+  # return      [width, height, 2] or [width, height, 2, K] deformation (with overlaid grid)
   height, width = np.shape(img)
-  gridY, gridX = np.mgrid[1:width+1, 1:height+1]
-  positions = np.concatenate((np.transpose(gridX.flatten()[:, np.newaxis], (1, 0)), np.transpose(gridY.flatten()[:, np.newaxis], (1, 0)), np.ones((1, img.size))), axis=0)  # with overlaid grid
-  #positions = np.concatenate((np.ones((1, img.size)), np.ones((1, img.size)), np.ones((1, img.size))), axis=0)
-  u = affine_mat @ positions
-  u = np.transpose(np.reshape(np.transpose(u[0:2, :], (1, 0)), (height, width, 2)), (1, 0, 2))
-  return u
+  u = np.asarray(affine_mat)[..., 0:2, :] @ get_mesh_positions((height, width))
+  u = np.reshape(u.T, (height, width, 2) + np.shape(u)[:-2])
+  return np.swapaxes(u, 0, 1)
 
 def add_mesh_to_def(u):
-  height, width, nd = np.shape(u)
+  height, width, nd = np.shape(u)[:3]
   gridY, gridX = np.mgrid[1:width+1, 1:height+1]
   q = np.zeros(np.shape(u))
-  q[:,:,0] = u[:,:,0] + gridY
-  q[:,:,1] = u[:,:,1] + gridX
+  q[:,:,0] = u[:,:,0] + gridY.reshape(gridY.shape + (1,) * (np.ndim(u) - 3))
+  q[:,:,1] = u[:,:,1] + gridX.reshape(gridX.shape + (1,) * (np.ndim(u) - 3))
   return q
 
 def remove_mesh_from_def(u):
-  height, width, nd = np.shape(u)
+  height, width, nd = np.shape(u)[:3]
   gridY, gridX = np.mgrid[1:width+1, 1:height+1]
   q = np.zeros(np.shape(u))
-  q[:,:,0] = u[:,:,0] - gridY
-  q[:,:,1] = u[:,:,1] - gridX
+  q[:,:,0] = u[:,:,0] - gridY.reshape(gridY.shape + (1,) * (np.ndim(u) - 3))
+  q[:,:,1] = u[:,:,1] - gridX.reshape(gridX.shape + (1,) * (np.ndim(u) - 3))
   return q
 
 def get_flow(img, p):
+    # img      input image (2D)
+    # p        affine transformation parameters, single vector or stack [K, 6]
+    # return   flow field [Nx, Ny, 2], or [Nx, Ny, 2, K] for a parameter stack
+    #          (displacement of get_deformation_field_from_affine without the mesh, component order of warp_2D;
+    #          get_sampling_flow returns the convention of utils.motioncomp)
     aff = get_affine_matrix(img, p)
     u = get_deformation_field_from_affine(img, aff)
     return remove_mesh_from_def(u)
 
+def get_sampling_flow(img, p):
+    # img      input image (2D) or its shape
+    # p        affine transformation parameters, single vector or stack [K, 6]
+    # return   flow field [Nx, Ny, 2], or [Nx, Ny, 2, K] for a parameter stack, in the convention of utils.motioncomp
+    #          (offset of the sampling position per pixel, numpy axis order), i.e. get_sparse_motion_matrix(flow)
+    #          reproduces warp_affine(img, p) / transform_img(img, p); warp_2D expects the SimpleITK component order,
+    #          see swap_flow_components
+    shape = tuple(int(s) for s in (img if np.ndim(img) == 1 else np.shape(img)))
+    M = get_resample_matrices(shape, np.atleast_2d(p))
+    grid = get_coordinate_grid(shape)
+    u = (M[:, 0:2, :] @ grid)[:, ::-1, :] - grid[1::-1][np.newaxis]
+    u = np.moveaxis(np.reshape(u, (-1, 2) + shape), (0, 1), (-1, -2))
+    if np.ndim(p) == 1:
+        return u[..., 0]
+    return u
+
+def swap_flow_components(u):
+    # converts flow fields [Nx, Ny, 2, ...] between the utils.motioncomp component order (numpy axis order,
+    # get_sampling_flow)
+    # and the SimpleITK order of warp_2D / get_deformation_field_from_affine (and back)
+    return np.asarray(u)[:, :, ::-1]
+
+#####################
+# Vectorized NumPy affine warping (same conventions as transform_img, without SimpleITK)
+#####################
+
+def get_resample_matrices(shape, p):
+    # shape    image shape (2D or 3D)
+    # p        affine transformation parameters (see transform_img), single vector or stack [K, 6] / [K, 12]
+    #          3D: t_x, t_y, t_z, \phi [°], \theta [°], \psi [°], G_{xy}, G_{xz}, G_{yz}, S_x, S_y, S_z
+    # return   [K, dim+1, dim+1] homogeneous matrices mapping output to input positions (SimpleITK point order),
+    #          composed as translate(rotate(shear(scale(x)))) with the centre of rotation of transform_img
+    dim = len(shape)
+    p = np.atleast_2d(np.asarray(p, dtype='float'))
+    K = np.shape(p)[0]
+    eye = np.tile(np.eye(dim + 1), (K, 1, 1))
+    center = np.asarray(shape, dtype='float') / 2
+
+    R = eye.copy()
+    G = eye.copy()
+    S = eye.copy()
+    if dim == 2:
+        trans, scale = p[:, 0:2], p[:, 4:6]
+        radians = -np.pi * p[:, 2] / 180.
+        R[:, 0, 0] = np.cos(radians)
+        R[:, 0, 1] = -np.sin(radians)
+        R[:, 1, 0] = np.sin(radians)
+        R[:, 1, 1] = np.cos(radians)
+        G[:, 0, 1] = p[:, 3]
+    else:
+        trans, scale = p[:, 0:3], p[:, 9:12]
+        phi, theta, psi = (np.pi * p[:, 3:6] / 180.).T
+        Rx, Ry, Rz = eye.copy(), eye.copy(), eye.copy()
+        Rx[:, 1, 1], Rx[:, 1, 2], Rx[:, 2, 1], Rx[:, 2, 2] = np.cos(phi), np.sin(phi), -np.sin(phi), np.cos(phi)
+        Ry[:, 0, 0], Ry[:, 0, 2], Ry[:, 2, 0], Ry[:, 2, 2] = np.cos(theta), np.sin(theta), -np.sin(theta), np.cos(theta)
+        Rz[:, 0, 0], Rz[:, 0, 1], Rz[:, 1, 0], Rz[:, 1, 1] = np.cos(psi), np.sin(psi), -np.sin(psi), np.cos(psi)
+        R = Rx @ Ry @ Rz
+        G[:, 0, 1], G[:, 0, 2], G[:, 1, 2] = p[:, 6], p[:, 7], p[:, 8]
+    S[:, np.arange(dim), np.arange(dim)] = scale
+
+    T = eye.copy()
+    T[:, :dim, dim] = trans
+    C = eye.copy()
+    C[:, :dim, dim] = center
+    Cinv = eye.copy()
+    Cinv[:, :dim, dim] = -center
+    return T @ C @ R @ Cinv @ G @ S
+
+
+@lru_cache(maxsize=8)
+def get_coordinate_grid(shape):
+    # homogeneous pixel coordinates [dim+1, Npix] in SimpleITK point order (numpy axes reversed), C-order pixels
+    grid = np.indices(shape, dtype='float').reshape(len(shape), -1)[::-1]
+    grid = np.concatenate([grid, np.ones((1, np.shape(grid)[1]))], 0)
+    grid.flags.writeable = False
+    return grid
+
+
+def interpolate_linear(img, coords, default_value=0.0):
+    # img      input image (real or complex, 2D or 3D)
+    # coords   [K, dim, Npix] sampling positions in numpy axis order
+    # return   [K, Npix] (multi-)linearly interpolated values; positions outside [-0.5, N-0.5) get
+    #          default_value, positions between border pixel and border are clamped (as SimpleITK)
+    shape = np.shape(img)
+    dim = len(shape)
+    flat = np.ravel(img)
+    size = np.asarray(shape)[np.newaxis, :, np.newaxis]
+    valid = np.all((coords >= -0.5) & (coords < size - 0.5), axis=1)
+    coords = np.clip(coords, 0, size - 1)
+    lower = np.minimum(np.floor(coords), np.maximum(size - 2, 0)).astype(np.int64)
+    weight = coords - lower
+    strides = np.cumprod((1,) + tuple(shape[:0:-1]))[::-1]
+    # flat index of the lower corner and offsets to the upper neighbour per axis (0 for singleton axes)
+    base = np.einsum('kdn,d->kn', lower, strides)
+    step = [np.where(lower[:, d, :] + 1 < shape[d], strides[d], 0) for d in range(dim)]
+    out = 0
+    for corner in np.ndindex(*(2,) * dim):
+        idx = base
+        w = 1
+        for d in range(dim):
+            if corner[d]:
+                idx = idx + step[d]
+                w = w * weight[:, d, :]
+            else:
+                w = w * (1 - weight[:, d, :])
+        out = out + w * np.take(flat, idx)
+    return np.where(valid, out, default_value)
+
+
+def warp_affine(img, p, default_value=0.0):
+    # img      input image (2D or 3D), complex-valued images keep their phase
+    # p        affine transformation parameters (see transform_img), single vector or stack [K, 6] / [K, 12]
+    # return   transformed image, or [..., K] stack of transformed images for a parameter stack
+    img = np.asarray(img)
+    shape = np.shape(img)
+    dim = len(shape)
+    M = get_resample_matrices(shape, p)
+    coords = (M[:, :dim, :] @ get_coordinate_grid(shape))[:, ::-1, :]
+    out = interpolate_linear(img, coords, default_value).reshape((-1,) + shape)
+    if np.ndim(p) == 1:
+        return out[0]
+    return np.moveaxis(out, 0, -1)
+
+
 # centered cropping
 def crop(x, s):
     # x: input data
@@ -1,12 +1,20 @@
 import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor
 #from gpuNUFFT import NUFFTOp
 from merlintf.complex import *
 from merlintf.keras.layers.data_consistency import itSENSE, DCPM
 from merlintf.keras.layers.mri import MulticoilForwardOp, MulticoilAdjointOp
 from mri.operators import NonCartesianFFT
+from scipy.sparse import issparse
+from utils.nufft import get_nufft, nufft_cache, ToeplitzNormalOp, KBNUFFT
 from utils.motioncomp import *
+from utils.precision import complex_dtype, cast, use_precision
+from utils.profiling import profiled, region
+from utils.fftbackend import get_fft_backend, set_fft_backend
+from utils.coilcompression import compress_coils
 import tensorflow as tf
-from scipy.sparse import vstack
+from utils.tfops import TFMotionCache, batchelor_forward, batchelor_adjoint, tf_nufft
 
 
 def rss(coil_img):
@@ -31,160 +39,264 @@ def squeeze_batch_dim(x):
         return x
 
 # Cartesian 2D operators
+@profiled()
 def mriAdjointOp(kspace, mask, smaps):
-    return np.sum(ifft2c(kspace * mask)*np.conj(smaps), axis=-1)
+    return np.sum(ifft2c(kspace * mask, overwrite_x=True)*np.conj(smaps), axis=-1)
 
+@profiled()
 def mriForwardOp(image, mask, smaps):
-    return fft2c(smaps * image[:,:,np.newaxis]) * mask
+    return fft2c(smaps * image[..., np.newaxis], overwrite_x=True) * mask
 
-def fft2c(image, axes=(0,1)):
-    return np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(image, axes=axes), norm='ortho', axes=axes), axes=axes)
+# centered orthonormal 2D FFTs computed by the selected backend (utils.fftbackend.set_fft_backend:
+# numpy, scipy.fft with workers, checkerboard modulation instead of shifts), the output dtype follows
+# the precision policy (utils.precision)
+# out           optional preallocated output buffer
+# overwrite_x   the input may be used as work buffer
+@profiled()
+def fft2c(image, axes=(0,1), out=None, overwrite_x=False):
+    return get_fft_backend().fft2c(image, axes, out, overwrite_x)
 
-def ifft2c(kspace, axes=(0,1)):
-    return np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(kspace, axes=axes), norm='ortho', axes=axes), axes=axes)
+@profiled()
+def ifft2c(kspace, axes=(0,1), out=None, overwrite_x=False):
+    return get_fft_backend().ifft2c(kspace, axes, out, overwrite_x)
 
 # Define Batchelor's motion operator
 # motions is now a vertical stack of sparse motion matrices
-def BatchForwardOp(image, masks, smaps, motions, use_optox=False):
+# or a list of MotionOperator (one per motion state, see utils.motioncomp)
+# or a list of WarpOperator (matrix-free, see utils.motioncomp)
+# or a BatchMotionOperator / BatchWarpOperator / ELLMotionOperator, which selects the batched mode: all Nt states are warped
+# at once and transformed with one [Nx, Ny, Nc, Nt] FFT
+# (batched=True wraps a stacked matrix / list into a BatchMotionOperator on the fly)
+# or a TranslationMotion (explicit opt-in, flow fields are never converted), which selects the k-space
+# phase-ramp path: one multi-coil FFT, no image-domain warps. The ramps shift the coil images, i.e. the coil
+# maps move (circularly) with the object, unlike the static coil maps of the other paths; an approximation
+# for smooth coil maps and objects surrounded by background (see utils.motioncomp.TranslationMotion)
+@profiled()
+def BatchForwardOp(image, masks, smaps, motions, use_optox=False, batched=False):
     Nx = np.shape(image)[0]
     Ny = np.shape(image)[1]
     Nc = np.shape(smaps)[2]
     Nt = np.shape(masks)[-1]
 
-    kspace_out = np.zeros((Nx,Ny,Nc,Nt)) + 1j * np.zeros((Nx,Ny,Nc,Nt))
+    if isinstance(motions, TranslationMotion):
+        # k-space phase ramps: one multi-coil FFT for all states
+        modulation = motions.modulation(masks, complex_dtype(image, smaps))
+        return fft2c(smaps * image[:, :, np.newaxis], overwrite_x=True) * modulation
+
+    if not use_optox and (batched or isinstance(motions, BATCH_MOTION_OPERATORS)):
+        if not isinstance(motions, BATCH_MOTION_OPERATORS):
+            motions = BatchMotionOperator(motions)
+        im_aux = motions.forward(image)
+        kspace_out = fft2c(smaps[:, :, :, np.newaxis] * im_aux[:, :, np.newaxis, :], overwrite_x=True)
+        return np.einsum('xyct,xyct->xyc', kspace_out, masks)
+
+    kspace_out = np.zeros((Nx,Ny,Nc,Nt), dtype=complex_dtype(image, smaps))
     for t in range(Nt):
-        if use_optox:
-            im_aux = apply_sparse_motion(image,get_sparse_motion_matrix(motions[:,:,:,t]),0)
-        else:
-            im_aux = apply_sparse_motion(image,motions[t*Nx*Ny:(t+1)*Nx*Ny,:],0)
-        kspace_out[:,:,:,t] = mriForwardOp(im_aux, masks[:,:,:,t], smaps)
+        with region('BatchForwardOp', t):
+            if use_optox:
+                im_aux = apply_sparse_motion(image,get_sparse_motion_matrix(motions[:,:,:,t]),0)
+            elif isinstance(motions, (list, tuple)):
+                im_aux = motions[t].forward(image)
+            else:
+                im_aux = apply_sparse_motion(image,motions[t*Nx*Ny:(t+1)*Nx*Ny,:],0)
+            kspace_out[:,:,:,t] = mriForwardOp(im_aux, masks[:,:,:,t], smaps)
     return np.sum(kspace_out,3)
 
-def BatchAdjointOp(kspace, masks, smaps, motions, use_optox=False):
+@profiled()
+def BatchAdjointOp(kspace, masks, smaps, motions, use_optox=False, batched=False):
     Nx = np.shape(kspace)[0]
     Ny = np.shape(kspace)[1]
     Nc = np.shape(smaps)[2]
     Nt = np.shape(masks)[-1]
 
-    image_out = np.zeros((Nx,Ny,Nt)) + 1j * np.zeros((Nx,Ny,Nt))
+    if isinstance(motions, TranslationMotion):
+        modulation = motions.modulation(masks, complex_dtype(kspace, smaps))
+        coil_imgs = ifft2c(kspace * np.conj(modulation), overwrite_x=True)
+        return np.sum(coil_imgs * np.conj(smaps), 2)
+
+    if not use_optox and (batched or isinstance(motions, BATCH_MOTION_OPERATORS)):
+        if not isinstance(motions, BATCH_MOTION_OPERATORS):
+            motions = BatchMotionOperator(motions)
+        coil_imgs = ifft2c(kspace[:, :, :, np.newaxis] * masks, overwrite_x=True)
+        im_aux = np.einsum('xyct,xyc->xyt', coil_imgs, np.conj(smaps))
+        return np.sum(motions.adjoint(im_aux), 2)
+
+    image_out = np.zeros((Nx,Ny,Nt), dtype=complex_dtype(kspace, smaps))
     #im_aux = np.zeros((Nx,Ny,Nc))
     for t in range(Nt):
-        im_aux = mriAdjointOp(kspace, masks[:,:,:,t], smaps)
-        if use_optox:
-            image_out[:,:,t] = apply_sparse_motion(im_aux,get_sparse_motion_matrix(motions[:,:,:,t]),1)
-        else:
-            image_out[:,:,t] = apply_sparse_motion(im_aux,motions[t*Nx*Ny:(t+1)*Nx*Ny,:],1)
+        with region('BatchAdjointOp', t):
+            im_aux = mriAdjointOp(kspace, masks[:,:,:,t], smaps)
+            if use_optox:
+                image_out[:,:,t] = apply_sparse_motion(im_aux,get_sparse_motion_matrix(motions[:,:,:,t]),1)
+            elif isinstance(motions, (list, tuple)):
+                image_out[:,:,t] = motions[t].adjoint(im_aux)
+            else:
+                image_out[:,:,t] = apply_sparse_motion(im_aux,motions[t*Nx*Ny:(t+1)*Nx*Ny,:],1)
     return np.sum(image_out,2)
 
 
-def BatchGPUNUFFTForwardOp(image, traj, csm, dcf, motions, nufft=None, use_optox=False):
+# nufft     None: per-state operators are taken from the NUFFT plan cache (utils.nufft.nufft_cache), the
+#           trajectory/DCF content is hashed once per set of arrays (see NUFFTPlanCache.get_state)
+#           list: one (pre-planned) operator per motion state
+#           otherwise: a single operator shared by all motion states
+def get_state_nufft(nufft, t, traj, csm, dcf, Nx, implementation='gpuNUFFT'):
+    if nufft is None:
+        return nufft_cache.get_state(t, samples=traj, shape=[Nx, Nx], n_coils=np.shape(csm)[0], density_comp=dcf,
+                                     smaps=csm, implementation=implementation)
+    if isinstance(nufft, (list, tuple)):
+        return nufft[t]
+    return nufft
+
+@profiled()
+def BatchGPUNUFFTForwardOp(image, traj, csm, dcf, motions, nufft=None, use_optox=False, implementation='gpuNUFFT'):
     Nx = np.shape(image)[0]
     Ny = np.shape(image)[1]
     NSpokes = np.shape(traj)[0]
     Nc = np.shape(csm)[0]
     Nt = np.shape(motions)[-1]
-    mcomp = True if nufft is None else False
-    kspace_out = np.zeros((Nc, NSpokes, Nt)) + 1j * np.zeros((Nc, NSpokes, Nt))
+    kspace_out = np.zeros((Nc, NSpokes, Nt), dtype=complex_dtype(image, csm))
     for t in range(Nt):
-        if use_optox:
-            im_aux = apply_sparse_motion(image, get_sparse_motion_matrix(motions[:, :, :, t]), 0)
-        else:
-            im_aux = apply_sparse_motion(image, motions[t * Nx * Ny:(t + 1) * Nx * Ny, :], 0)
-        if mcomp:
-            nufft = NonCartesianFFT(samples=traj[..., t], shape=[Nx, Nx], n_coils=Nc, density_comp=dcf[..., t],
-                                smaps=csm, implementation='gpuNUFFT')
-        kspace_out[:, :, t] = nufft.op(im_aux)
+        with region('BatchGPUNUFFTForwardOp', t):
+            if use_optox:
+                im_aux = apply_sparse_motion(image, get_sparse_motion_matrix(motions[:, :, :, t]), 0)
+            elif isinstance(motions, (list, tuple)):
+                im_aux = motions[t].forward(image)
+            else:
+                im_aux = apply_sparse_motion(image, motions[t * Nx * Ny:(t + 1) * Nx * Ny, :], 0)
+            kspace_out[:, :, t] = get_state_nufft(nufft, t, traj, csm, dcf, Nx, implementation).op(im_aux)
     return np.sum(kspace_out, 2)
 
-def BatchGPUNUFFTAdjointOp(kspace, traj, csm, dcf, motions, nufft=None, use_optox=False):
+@profiled()
+def BatchGPUNUFFTAdjointOp(kspace, traj, csm, dcf, motions, nufft=None, use_optox=False, implementation='gpuNUFFT'):
     Nx = np.shape(csm)[1]
     Ny = np.shape(csm)[2]
+    Nc = np.shape(csm)[0]
     Nt = np.shape(motions)[-1]
-    mcomp = True if nufft is None else False
-    image_out = np.zeros((Nx, Ny, Nt)) + 1j * np.zeros((Nx, Ny, Nt))
+    image_out = np.zeros((Nx, Ny, Nt), dtype=complex_dtype(kspace, csm))
     for t in range(Nt):
-        if mcomp:
-            nufft = NonCartesianFFT(samples=traj[..., t], shape=[Nx, Nx], n_coils=Nc, density_comp=dcf[..., t],
-                                    smaps=csm, implementation='gpuNUFFT')
-        im_aux = nufft.adj_op(kspace)
-        if use_optox:
-            image_out[:, :, t] = apply_sparse_motion(im_aux, get_sparse_motion_matrix(motions[:, :, :, t]), 1)
-        else:
-            image_out[:, :, t] = apply_sparse_motion(im_aux, motions[t * Nx * Ny:(t + 1) * Nx * Ny, :], 1)
+        with region('BatchGPUNUFFTAdjointOp', t):
+            im_aux = get_state_nufft(nufft, t, traj, csm, dcf, Nx, implementation).adj_op(kspace)
+            if use_optox:
+                image_out[:, :, t] = apply_sparse_motion(im_aux, get_sparse_motion_matrix(motions[:, :, :, t]), 1)
+            elif isinstance(motions, (list, tuple)):
+                image_out[:, :, t] = motions[t].adjoint(im_aux)
+            else:
+                image_out[:, :, t] = apply_sparse_motion(im_aux, motions[t * Nx * Ny:(t + 1) * Nx * Ny, :], 1)
     return np.sum(image_out, 2)
 
 
+# TensorFlow-native layers (utils.tfops): motion as gather/scatter built once per flow tensor, FFTs via tf.signal,
+# i.e. no NumPy round trips and usable in graph mode (tf.function)
 class BatchelorFwd(tf.keras.layers.Layer):
+    graph_compatible = True
+
     def __init__(self):
         super().__init__()
-        self.op = BatchForwardOp
+        self.motion = TFMotionCache()
 
     def call(self, image, mask, smaps, flow):
-        flow = squeeze_batch_dim(flow.numpy())
-        flowlist = []
-        for t in range(np.shape(flow)[-1]):
-            flowlist.append(get_sparse_motion_matrix(flow[:, :, :, t]))
-        smm = vstack(flowlist)
-        return numpy2tensor(self.op(squeeze_batch_dim(image.numpy()), squeeze_batch_dim(mask.numpy()), squeeze_batch_dim(smaps.numpy()),
-                                    smm, use_optox=True), add_batch_dim=True, add_channel_dim=False)
+        # image [batch, X, Y], mask [batch, X, Y, coils, T], smaps [batch, X, Y, coils], flow [batch, X, Y, 2, T]
+        return batchelor_forward(image, mask, smaps, self.motion.get(flow))
 
 
 class BatchelorAdj(tf.keras.layers.Layer):
+    graph_compatible = True
+
     def __init__(self):
         super().__init__()
-        self.op = BatchAdjointOp
+        self.motion = TFMotionCache()
 
     def call(self, kspace, mask, smaps, flow):
-        flow = squeeze_batch_dim(flow.numpy())
-        flowlist = []
-        for t in range(np.shape(flow)[-1]):
-            flowlist.append(get_sparse_motion_matrix(flow[:, :, :, t]))
-        smm = vstack(flowlist)
-        return numpy2tensor(self.op(squeeze_batch_dim(kspace.numpy()), squeeze_batch_dim(mask.numpy()), squeeze_batch_dim(smaps.numpy()),
-                                    smm, use_optox=True), add_batch_dim=True, add_channel_dim=False)
+        # kspace [batch, X, Y, coils], mask [batch, X, Y, coils, T], smaps [batch, X, Y, coils], flow [batch, X, Y, 2, T]
+        return batchelor_adjoint(kspace, mask, smaps, self.motion.get(flow))
 
 # Non-Cartesian 2D operators
+# implementation selects the NUFFT engine: 'gpuNUFFT' or the built-in CPU engine 'kbnufft' (see utils.nufft)
 class GPUNUFFTOp():
-    def __init__(self, traj, csm, dcf, nRead):
+    def __init__(self, traj, csm, dcf, nRead, implementation='gpuNUFFT'):
         self.traj = traj
         self.csm = csm
         self.dcf = dcf
-        self.nufft = NonCartesianFFT(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
-                                smaps=csm, implementation='gpuNUFFT')
+        self.nRead = nRead
+        self.implementation = implementation
+        self.nufft = get_nufft(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
+                               smaps=csm, implementation=implementation)
 
+    @profiled()
     def forward(self, image, mask=None, smaps=None, dcf=None):
         return self.nufft.op(image)
 
+    @profiled()
     def adjoint(self, kspace, mask=None, smaps=None, dcf=None):
         return self.nufft.adj_op(kspace)
 
     def set_nufft(self, nufft):
         self.nufft = nufft
 
+    def compressed(self, csm):
+        # operator of the same trajectory for other (e.g. virtual, see utils.coilcompression) coil maps
+        return GPUNUFFTOp(self.traj, csm, self.dcf, self.nRead, self.implementation)
+
+
+def get_nufft_engine(op):
+    # NUFFT operator behind a non-Cartesian fwdop/adjop of iterativeSENSE: methods of a GPUNUFFTOp, partials with a
+    # single (pre-planned) nufft=...; None for other operators
+    owner = getattr(op, '__self__', None)
+    if isinstance(owner, GPUNUFFTOp):
+        return owner.nufft
+    nufft = getattr(op, 'keywords', {}).get('nufft')
+    if isinstance(nufft, (list, tuple)):
+        return nufft[0] if len(nufft) == 1 else None
+    return nufft
+
+
+def compress_nufft_ops(fwdop, adjop, csm):
+    # fwdop, adjop  non-Cartesian operators of iterativeSENSE
+    # csm           compressed coil maps [Nv, X, Y]
+    # return:       the operators for the virtual coils: methods of a GPUNUFFTOp are re-planned with csm, functions
+    #               taking the coil maps as argument are unchanged. Operators with their own fixed coil maps (other
+    #               objects, partials with a prebuilt nufft) cannot follow the compression.
+    owner = getattr(fwdop, '__self__', None)
+    if isinstance(owner, GPUNUFFTOp) and getattr(adjop, '__self__', None) is owner:
+        op = owner.compressed(csm)
+        return getattr(op, fwdop.__name__), getattr(op, adjop.__name__)
+    for fun in (fwdop, adjop):
+        if getattr(fun, '__self__', None) is not None or getattr(fun, 'keywords', {}).get('nufft') is not None:
+            raise ValueError('coil_compression on the non-Cartesian path needs operators which can be re-planned for '
+                             'the virtual coils (methods of one GPUNUFFTOp, or functions taking the coil maps), got %r; '
+                             'otherwise compress ahead with utils.coilcompression.compress_coils and plan the NUFFT '
+                             'for the virtual coils' % (fun,))
+    return fwdop, adjop
+
 
 class GPUNUFFTFwd(tf.keras.layers.Layer):
-    def __init__(self, nRead, traj, csm, dcf):
+    def __init__(self, nRead, traj, csm, dcf, implementation='gpuNUFFT'):
         super().__init__()
-        self.op = NonCartesianFFT(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
-                                smaps=csm, implementation='gpuNUFFT')
+        self.op = get_nufft(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
+                            smaps=csm, implementation=implementation)
 
     def call(self, x, traj, csm, dcf):
         return numpy2tensor(self.op.op(np.squeeze(x.numpy())), add_batch_dim=True, add_channel_dim=False)
 
 
 class GPUNUFFTAdj(tf.keras.layers.Layer):
-    def __init__(self, nRead, traj, csm, dcf):
+    def __init__(self, nRead, traj, csm, dcf, implementation='gpuNUFFT'):
         super().__init__()
-        self.op = NonCartesianFFT(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf, smaps=csm,
-                              implementation='gpuNUFFT')
+        self.op = get_nufft(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf, smaps=csm,
+                            implementation=implementation)
 
     def call(self, x, traj, csm, dcf):
         return numpy2tensor(self.op.adj_op(np.squeeze(x.numpy())), add_batch_dim=True, add_channel_dim=False)
 
 
-class BatchelorGPUNUFFTFwd(tf.keras.layers.Layer):
-    def __init__(self, nRead, traj, csm, dcf):
+class BatchelorGPUNUFFTLayer(tf.keras.layers.Layer):
+    # per-state NUFFTs are planned at construction: 'kbnufft' runs natively in TF (utils.tfops.TFKBNUFFT),
+    # other engines are wrapped with tf.numpy_function (graph mode works, but the NUFFT itself stays in NumPy)
+    graph_compatible = True
+
+    def __init__(self, nRead, traj, csm, dcf, implementation='gpuNUFFT'):
         super().__init__()
+        self.implementation = implementation
         self.Nx = nRead
         self.Ny = nRead
         self.Nc = np.shape(csm)[0]
@@ -194,54 +306,67 @@ class BatchelorGPUNUFFTFwd(tf.keras.layers.Layer):
             self.Nt = 1
         self.NSpokes = np.shape(traj)[0]
         if self.Nt > 1:
-            self.nufft = None
+            # plan the per-state NUFFTs once, later calls reuse them via the plan cache
+            self.nufft = [nufft_cache.get(samples=traj[..., t], shape=[nRead, nRead], n_coils=self.Nc,
+                                          density_comp=dcf[..., t], smaps=csm, implementation=implementation)
+                          for t in range(self.Nt)]
         else:
-            self.nufft = NonCartesianFFT(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
-                                smaps=csm, implementation='gpuNUFFT')
-        self.op = BatchGPUNUFFTForwardOp
-
+            self.nufft = get_nufft(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
+                                   smaps=csm, implementation=implementation)
+        self.tf_nufft = [tf_nufft(get_state_nufft(self.nufft, t, traj, csm, dcf, nRead)) for t in range(self.Nt)]
+        self.motion = TFMotionCache()
+
+    def nufft_op(self, t, image):
+        if self.tf_nufft[t] is not None:
+            return self.tf_nufft[t].op(image)
+        op = get_state_nufft(self.nufft, t, None, None, None, self.Nx)
+        kspace = tf.numpy_function(lambda x: np.complex64(op.op(x)), [image], tf.complex64)
+        return tf.reshape(kspace, [self.Nc, -1])
+
+    def nufft_adj_op(self, t, kspace):
+        if self.tf_nufft[t] is not None:
+            return self.tf_nufft[t].adj_op(kspace)
+        op = get_state_nufft(self.nufft, t, None, None, None, self.Nx)
+        image = tf.numpy_function(lambda x: np.complex64(op.adj_op(x)), [kspace], tf.complex64)
+        return tf.reshape(image, [self.Nx, self.Ny])
+
+
+class BatchelorGPUNUFFTFwd(BatchelorGPUNUFFTLayer):
     def call(self, image, traj, csm, dcf, flow):
-        flow = squeeze_batch_dim(flow.numpy())
-        flowlist = []
-        for t in range(np.shape(flow)[-1]):
-            flowlist.append(get_sparse_motion_matrix(flow[:, :, :, t]))
-        smm = vstack(flowlist)
-        return numpy2tensor(self.op(squeeze_batch_dim(image.numpy()), squeeze_batch_dim(traj.numpy()), squeeze_batch_dim(csm.numpy()),
-                                    squeeze_batch_dim(dcf.numpy()), smm, self.nufft, use_optox=True), add_batch_dim=True, add_channel_dim=False)
+        # image [1, X, Y], flow [1, X, Y, 2, T]; traj, csm, dcf are fixed by the planned NUFFTs
+        warped = self.motion.get(flow).forward(tf.cast(image, tf.complex64))
+        kspace = tf.add_n([self.nufft_op(t, warped[0, :, :, t]) for t in range(self.Nt)])
+        return kspace[tf.newaxis]
 
 
-class BatchelorGPUNUFFTAdj(tf.keras.layers.Layer):
-    def __init__(self, nRead, traj, csm, dcf):
-        super().__init__()
-        self.Nx = nRead
-        self.Ny = nRead
-        self.Nc = np.shape(csm)[0]
-        if len(np.shape(traj)) == 3:
-            self.Nt = np.shape(traj)[2]
-        else:
-            self.Nt = 1
-        self.NSpokes = np.shape(traj)[0]
-        if self.Nt > 1:
-            self.nufft = None
-        else:
-            self.nufft = NonCartesianFFT(samples=traj, shape=[nRead, nRead], n_coils=np.shape(csm)[0], density_comp=dcf,
-                                  smaps=csm, implementation='gpuNUFFT')
-        self.op = BatchGPUNUFFTAdjointOp
-
+class BatchelorGPUNUFFTAdj(BatchelorGPUNUFFTLayer):
     def call(self, kspace, traj, csm, dcf, flow):
-        flow = squeeze_batch_dim(flow.numpy())
-        flowlist = []
-        for t in range(np.shape(flow)[-1]):
-            flowlist.append(get_sparse_motion_matrix(flow[:, :, :, t]))
-        smm = vstack(flowlist)
-        return numpy2tensor(self.op(squeeze_batch_dim(kspace.numpy()), squeeze_batch_dim(traj.numpy()), squeeze_batch_dim(csm.numpy()),
-                    squeeze_batch_dim(dcf.numpy()), smm, self.nufft, use_optox=True), add_batch_dim=True,
-            add_channel_dim=False)
+        # kspace [1, coils, samples], flow [1, X, Y, 2, T]; traj, csm, dcf are fixed by the planned NUFFTs
+        kspace = tf.cast(kspace[0], tf.complex64)
+        images = tf.stack([self.nufft_adj_op(t, kspace) for t in range(self.Nt)], -1)
+        return tf.reduce_sum(self.motion.get(flow).adjoint(images[tf.newaxis]), -1)
+
+
+def get_n_states(flow, mask=None):
+    # number of motion states of the flow argument of iterativeSENSE: from the per-state masks [..., Nt] if given,
+    # otherwise from the motion representation (operator objects, lists of operators, stacked sparse matrices,
+    # [..., Nt] flow fields)
+    if mask is not None:
+        return np.shape(mask)[-1]
+    if hasattr(flow, 'Nt'):
+        return flow.Nt
+    if isinstance(flow, (list, tuple)):
+        return len(flow)
+    if issparse(flow):
+        return np.shape(flow)[0] // np.shape(flow)[1]
+    return np.shape(flow)[-1]
 
 
 def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None,
                      fwdop=MulticoilForwardOp, adjop=MulticoilAdjointOp,
-                     add_batch_dim=True, max_iter=10, tol=1e-12, weight_init=1.0, weight_scale=1.0, use_optox=False):
+                     add_batch_dim=True, max_iter=10, tol=1e-12, weight_init=1.0, weight_scale=1.0, use_optox=False,
+                     toeplitz=False, warm_start=False, precond=None, rtol=None, return_info=False, precision=None,
+                     coil_compression=None):
     # kspace        raw k-space data as [X, Y, coils] which will be converted to:
     #               Cartesian + no-motion compensation: [batch, coils, X, Y] or [batch, coils, X, Y, Z] or [batch, coils, time, X, Y] or [batch, coils, time, X, Y, Z] (numpy array)
     #               Cartesian + motion-compensation / non-Cartesian + no-motion/motion-comp.: [batch, X, Y, coils]
@@ -249,15 +374,39 @@ def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None
     # mask          subsampling including/excluding soft-weights with same shape as kspace (no-motion-comp) and shape: X, Y, coils, T (motion-comp) (numpy array)
     # noisy         initialiaztion for reconstructed image, if None it is created from A^H(kspace) (numpy array)
     # dcf           density compensation function (only non-Cartesian) (numpy array)
-    # flow          flow field (numpy array)
+    # flow          flow field (numpy array), stacked sparse motion matrix, list of MotionOperator / WarpOperator or a
+    #               batched motion operator (BatchMotionOperator, BatchWarpOperator, ELLMotionOperator, TranslationMotion)
     # fwdop         forward operator A
     # adjop         adjoint operator A^H
+    #               (use_optox=True) if both are TF-native (graph_compatible, e.g. BatchelorFwd/Adj), the solver runs under tf.function
     # add_batch_dim automatically append batch dimension for GPU execution
     # max_iter      maximum number of iterations for CG/iterative SENSE
     # tol           tolerance for stopping condition for CG/iterative SENSE
     # weight_init   initial weighting for lambda regularization parameter
     # weight_scale  scaling factor for lambda regularization parameter
-    # return:       reconstructed image (numpy array)
+    # toeplitz      non-Cartesian only (use_optox=False): evaluate A^H A in CG via a precomputed Toeplitz kernel
+    #               instead of NUFFT forward + adjoint, see utils.nufft.ToeplitzNormalOp. The kernel is built from
+    #               the KBNUFFT behind fwdop/adjop (see get_nufft_engine), so that A^H A and the right-hand side
+    #               A^H y have the same scaling; other NUFFT engines are rejected. Single motion state only: the
+    #               Batchelor model sums the k-space of all states, its normal operator has non-convolutional
+    #               cross terms between the trajectories of different states (use toeplitz=False, i.e. the exact
+    #               NUFFT forward + adjoint in every CG iteration)
+    # warm_start    (use_optox=False) start CG from noisy (e.g. previous solution or neighbouring slice) instead of zero
+    # precond       (use_optox=False) CG preconditioner: 'sens' (coil-sensitivity diagonal), inverse diagonal, callable or None
+    # rtol          (use_optox=False) relative-residual stopping criterion for CG
+    # return_info   (use_optox=False) additionally return the CGResult (residual history, iterations, timings)
+    # precision     (use_optox=False) 'double', 'single' or 'auto' for this call, if None the global policy
+    #               (see utils.precision for accuracy bounds)
+    # coil_compression (use_optox=False) SVD coil compression ahead of the reconstruction (utils.coilcompression):
+    #               number of virtual coils (int) or retained energy fraction (float in (0, 1)), None: off
+    #               non-Cartesian: GPUNUFFTOp operators are re-planned for the virtual coils (see compress_nufft_ops)
+    # return:       reconstructed image (numpy array), (image, CGResult) if return_info
+
+    if precision is not None:
+        with use_precision(precision):
+            return iterativeSENSE(kspace, smap, mask, noisy, dcf, flow, fwdop, adjop, add_batch_dim, max_iter, tol,
+                                  weight_init, weight_scale, use_optox, toeplitz, warm_start, precond, rtol, return_info,
+                                  None, coil_compression)
 
     if dcf is not None:
         bradial = True
@@ -276,7 +425,7 @@ def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None
     else:
         Nx, Ny, Nc = np.shape(kspace)
     if motioncomp:
-        Nt = np.shape(flow)[-1]
+        Nt = get_n_states(flow, mask)
     else:
         Nt = 1
     # Forward and Adjoint operators
@@ -319,6 +468,8 @@ def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None
             noisy = numpy2tensor(noisy, add_batch_dim=add_batch_dim, add_channel_dim=False)
 
         model = DCPM(A, AH, weight_init=weight_init, weight_scale=weight_scale, max_iter=max_iter, tol=tol)
+        if getattr(A, 'graph_compatible', False) and getattr(AH, 'graph_compatible', False):
+            model = tf.function(model)  # TF-native operators (e.g. Batchelor layers): run the solver as one graph
         if bradial:  # non-Cartesian
             if motioncomp:
                 return np.squeeze(model([noisy, kspace, smap, mask, dcf, flow]).numpy())
@@ -336,6 +487,22 @@ def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None
             else:
                 mask = np.ones(np.shape(kspace), dtype=np.float32)
 
+        if coil_compression is not None:
+            if isinstance(coil_compression, (int, np.integer)):
+                n_virtual, energy = coil_compression, None
+            else:
+                n_virtual, energy = None, coil_compression
+            if bradial:  # kspace [coils, samples], smap [coils, X, Y]
+                kspace, smap, _, _ = compress_coils(kspace, smap, n_virtual, energy, coil_axis=0)
+                A, AH = compress_nufft_ops(A, AH, smap)
+            else:
+                kspace, smap, mask, _ = compress_coils(kspace, smap, n_virtual, energy, coil_axis=2, mask=mask)
+
+        # inputs in the dtype of the precision policy, the operators then keep it
+        kspace, smap, noisy, flow = cast(kspace), cast(smap), cast(noisy), cast(flow)
+        if not bradial:
+            mask = cast(mask)
+
         if noisy is None:
             if bradial:
                 if motioncomp:
@@ -348,41 +515,230 @@ def iterativeSENSE(kspace, smap=None, mask=None, noisy=None, dcf=None, flow=None
                 else:
                     noisy = AH(kspace, mask, smap)
 
+        if isinstance(precond, str) and precond == 'sens':
+            precond = sensitivity_preconditioner(smap, coil_axis=0 if bradial else -1)
+        cg_args = dict(warm_start=warm_start, precond=precond, rtol=rtol, return_info=return_info)
         if bradial:  # non-Cartesian
-            if motioncomp:
-                return np.squeeze(conjugate_gradient([noisy, kspace, smap, mask, dcf, flow], A, AH, max_iter, tol))
-            else:
-                return np.squeeze(conjugate_gradient([noisy, kspace, smap, mask, dcf], A, AH, max_iter, tol))
+            constants = [smap, mask, dcf, flow] if motioncomp else [smap, mask, dcf]
+            normal_op = None
+            if toeplitz:
+                nufft = get_nufft_engine(A)
+                if not isinstance(nufft, KBNUFFT) or get_nufft_engine(AH) is not nufft:
+                    raise ValueError("toeplitz=True needs fwdop/adjop of one KBNUFFT (GPUNUFFTOp with "
+                                     "implementation='kbnufft' or partial(..., nufft=KBNUFFT)), got %r / %r: the "
+                                     "Toeplitz kernel has the KBNUFFT scaling, other engines scale A^H y differently; "
+                                     "use toeplitz=False" % (A, AH))
+                normal_op = ToeplitzNormalOp(nufft.samples, smap if nufft.smaps is None else nufft.smaps,
+                                             nufft.density_comp, nufft.shape, motions=flow if motioncomp else None)
+            result = conjugate_gradient([noisy, kspace] + constants, A, AH, max_iter, tol, normal_op=normal_op, **cg_args)
         else:  # Cartesian
             if motioncomp:
-                return np.squeeze(conjugate_gradient([noisy, kspace, mask, smap, flow], A, AH, max_iter, tol))
+                result = conjugate_gradient([noisy, kspace, mask, smap, flow], A, AH, max_iter, tol, **cg_args)
             else:
-                return np.squeeze(conjugate_gradient([noisy, kspace, mask, smap], A, AH, max_iter, tol))
+                result = conjugate_gradient([noisy, kspace, mask, smap], A, AH, max_iter, tol, **cg_args)
+        if return_info:
+            return np.squeeze(result.x), result
+        return np.squeeze(result)
+
+# Multi-slice reconstruction (Cartesian, no motion compensation, use_optox=False)
+def reconstruct_volume(kspace, smaps, mask=None, mode='batched', n_workers=None, fwdop=mriForwardOp, adjop=mriAdjointOp,
+                       max_iter=10, tol=1e-12, precond=None, rtol=None, return_info=False):
+    # kspace        raw k-space data [X, Y, slices, coils] (numpy array)
+    # smaps         coil sensitivity maps [X, Y, slices, coils] (numpy array)
+    # mask          subsampling mask broadcastable to kspace, if None fully sampled
+    # mode          'batched': multi-right-hand-side CG, all slices advance together as one array
+    #               'pool':    one iterativeSENSE per slice in a process pool with n_workers processes
+    #               'serial':  one iterativeSENSE per slice (reference)
+    # n_workers     number of worker processes (mode='pool'), None: number of CPUs
+    # fwdop, adjop  slice-wise operators A(x, mask, smaps), A^H(y, mask, smaps); for mode='batched' they have
+    #               to broadcast over a trailing slice dimension of x (as mriForwardOp, mriAdjointOp)
+    # max_iter, tol, precond, rtol: see iterativeSENSE / conjugate_gradient
+    # return:       reconstructed volume [X, Y, slices], (volume, info) if return_info with
+    #               info = {'mode', 'time', 'slices_per_second'}
+    Nslices = np.shape(kspace)[2]
+    if mask is None:
+        mask = np.ones(np.shape(kspace), dtype=np.float32)
+    mask = np.broadcast_to(mask, np.shape(kspace))
+
+    t = time.perf_counter()
+    if mode == 'batched':
+        if isinstance(precond, str) and precond == 'sens':
+            precond = sensitivity_preconditioner(smaps, coil_axis=-1)
+        volume = conjugate_gradient_batched([None, kspace, mask, smaps], fwdop, adjop, max_iter, tol, precond=precond,
+                                            rtol=rtol)
+    elif mode in ('pool', 'serial'):
+        kwargs = dict(fwdop=fwdop, adjop=adjop, max_iter=max_iter, tol=tol, precond=precond, rtol=rtol)
+        tasks = [(kspace[:, :, s], smaps[:, :, s], mask[:, :, s], kwargs) for s in range(Nslices)]
+        if mode == 'pool':
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                slices = list(pool.map(reconstruct_slice, tasks))
+        else:
+            slices = [reconstruct_slice(task) for task in tasks]
+        volume = np.stack(slices, 2)
+    else:
+        raise ValueError('Unknown reconstruction mode: %s' % mode)
+    elapsed = time.perf_counter() - t
+
+    if return_info:
+        return volume, {'mode': mode, 'time': elapsed, 'slices_per_second': Nslices / elapsed}
+    return volume
+
+
+def reconstruct_slice(task):
+    # task = (kspace [X, Y, coils], smaps [X, Y, coils], mask, iterativeSENSE keyword arguments)
+    kspace, smaps, mask, kwargs = task
+    return iterativeSENSE(kspace, smaps, mask=mask, **kwargs)
+
+
+# Conjugate gradient for a stack of independent problems (e.g. slices), multi-right-hand-side:
+# all problems advance together as one array, step sizes and stopping criteria are evaluated per problem
+# (reduction over axes), so every problem follows the same iterates as conjugate_gradient
+@profiled()
+def conjugate_gradient_batched(inputs, A, AH, max_iter=10, tol=1e-12, warm_start=False, precond=None, rtol=None,
+                               axes=(0, 1)):
+    x0 = inputs[0]
+    y = inputs[1]
+    constants = inputs[2:]
+
+    rhs = AH(y, *constants)
+    def M(p):
+        return AH(A(p, *constants), *constants)
+    def dot(a, b):
+        return np.real(np.sum(np.conj(a) * b, axis=axes, keepdims=True))
+
+    if precond is None:
+        P = lambda r: r
+    elif callable(precond):
+        P = precond
+    else:
+        P = lambda r: precond * r
+
+    if warm_start and x0 is not None:
+        x = np.reshape(np.asarray(x0), np.shape(rhs)).astype(rhs.dtype)
+        r = rhs - M(x)
+    else:
+        x = np.zeros_like(rhs)
+        r = rhs
+    z = P(r)
+    p = z
+    rTr = dot(r, r)
+    rTz = dot(r, z)
+    bound = tol if rtol is None else np.maximum(tol, rtol**2 * dot(rhs, rhs))
+    active = rTr > bound
+    num_iter = 0
+    while (num_iter < max_iter) and np.any(active):
+        Ap = M(p)
+        alpha = np.where(active, rTz / np.where(active, dot(p, Ap), 1), 0)
+        x = x + p * alpha
+        r = r - Ap * alpha
+        z = P(r)
+        rTr = dot(r, r)
+        rTzNew = dot(r, z)
+        beta = np.where(active, rTzNew / np.where(active, rTz, 1), 0)
+        rTz = np.where(active, rTzNew, rTz)
+        p = np.where(active, z + p * beta, p)
+        active = active & (rTr > bound)
+        num_iter += 1
+
+    return x
 
 # Conjugate gradient solver for linear inverse problem
-def conjugate_gradient(inputs, A, AH, max_iter=10, tol=1e-12):
-    #x0 = inputs[0]
+# normal_op     optional replacement for AH(A(.)), e.g. ToeplitzNormalOp
+# warm_start    start from inputs[0] (e.g. previous solution or neighbouring slice) instead of zero
+# precond       diagonal preconditioner: inverse diagonal (numpy array), callable r -> P^-1 r, or None
+# rtol          relative-residual stopping criterion ||r|| / ||A^H y|| <= rtol (tol remains the absolute bound on r^H r)
+# return_info   return a CGResult (solution, residual history, iteration count, per-iteration wall time)
+@profiled()
+def conjugate_gradient(inputs, A, AH, max_iter=10, tol=1e-12, normal_op=None, warm_start=False, precond=None,
+                       rtol=None, return_info=False):
+    x0 = inputs[0]
     y = inputs[1]
     constants = inputs[2:]
 
-    #xk = x0
     rhs = AH(y, *constants)
     def M(p):
+        if normal_op is not None:
+            return normal_op(p, *constants)
         return AH(A(p, *constants), *constants)
 
-    x = np.zeros_like(rhs)
-    i, r, p = 0, rhs, rhs
+    if precond is None:
+        P = lambda r: r
+    elif callable(precond):
+        P = precond
+    else:
+        P = lambda r: precond * r
+
+    if warm_start and x0 is not None:
+        x = np.reshape(np.asarray(x0), np.shape(rhs)).astype(rhs.dtype)
+        r = rhs - M(x)
+    else:
+        x = np.zeros_like(rhs)
+        r = rhs
+    z = P(r)
+    p = z
     rTr = np.real(np.sum(np.conj(r) * r))
+    rTz = np.real(np.sum(np.conj(r) * z))
+    rhs_norm = np.sqrt(np.real(np.sum(np.conj(rhs) * rhs)))
+    result = CGResult(rhs_norm, rTr)
     num_iter = 0
-    while (num_iter < max_iter) and (rTr > tol):
+    while (num_iter < max_iter) and (rTr > tol) and not result.converged(rtol):
+        t = time.perf_counter()
         Ap = M(p)
-        alpha = rTr / np.real(np.sum(np.conj(p) * Ap))
+        alpha = rTz / np.real(np.sum(np.conj(p) * Ap))
         x = x + p * alpha
         r = r - Ap * alpha
-        rTrNew = np.real(np.sum(np.conj(r) * r))
-        beta = rTrNew / rTr
-        rTr = rTrNew
-        p = r + p * beta
+        z = P(r)
+        rTr = np.real(np.sum(np.conj(r) * r))
+        rTzNew = np.real(np.sum(np.conj(r) * z))
+        beta = rTzNew / rTz
+        rTz = rTzNew
+        p = z + p * beta
         num_iter += 1
-
-    return x
\ No newline at end of file
+        result.update(rTr, time.perf_counter() - t)
+
+    if return_info:
+        result.x = x
+        return result
+    return x
+
+
+class CGResult():
+    # x            solution
+    # residuals    relative residual norm ||r_k|| / ||A^H y|| per iteration (index 0: initial residual)
+    # iter_times   wall time per iteration [s]
+    # num_iter     number of performed iterations
+    def __init__(self, rhs_norm, rTr):
+        self.x = None
+        self.rhs_norm = rhs_norm
+        self.residuals = [self._relative(rTr)]
+        self.iter_times = []
+
+    def _relative(self, rTr):
+        return float(np.sqrt(rTr) / self.rhs_norm) if self.rhs_norm > 0 else 0.0
+
+    def update(self, rTr, elapsed):
+        self.residuals.append(self._relative(rTr))
+        self.iter_times.append(elapsed)
+
+    def converged(self, rtol):
+        return rtol is not None and self.residuals[-1] <= rtol
+
+    @property
+    def num_iter(self):
+        return len(self.iter_times)
+
+    @property
+    def total_time(self):
+        return float(np.sum(self.iter_times))
+
+    def __repr__(self):
+        return 'CGResult(num_iter=%d, residual=%.3e, time=%.3fs)' % (self.num_iter, self.residuals[-1], self.total_time)
+
+
+def sensitivity_preconditioner(smap, coil_axis=-1, eps=1e-3):
+    # smap        coil sensitivity maps
+    # coil_axis   coil dimension of smap ([X, Y, coils] Cartesian: -1, [coils, X, Y] non-Cartesian: 0)
+    # eps         regularization relative to the maximum of the diagonal
+    # return      inverse of the (approximate) diagonal of A^H A, sum_c |S_c|^2, for conjugate_gradient(precond=...)
+    diag = np.sum(np.abs(smap)**2, axis=coil_axis)
+    return (1 / (diag + eps * np.amax(diag))).astype(np.float32)
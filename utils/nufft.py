@@ -0,0 +1,349 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import scipy.fft
+from scipy.sparse import coo_matrix, issparse
+from mri.operators import NonCartesianFFT
+from utils.motioncomp import get_motion_operators
+from utils.profiling import profiled
+
+
+# Pure-CPU NUFFT engine based on Kaiser-Bessel gridding.
+# It mimics the interface of mri.operators.NonCartesianFFT (op / adj_op) so that it can
+# be selected with implementation='kbnufft' wherever the gpuNUFFT implementation is used.
+#
+# Convention:
+#   samples      [M, 2] k-space positions normalized to [-0.5, 0.5) (as returned by prepare_radial),
+#                samples[:, d] corresponds to image axis d
+#   forward      y_m = 1/sqrt(Nx*Ny) * sum_n x_n * exp(-2*pi*i * k_m . (n - N/2))
+#   adjoint      exact adjoint of the forward model, density compensation is applied to the
+#                k-space data before gridding (as done by gpuNUFFT)
+
+
+def kaiser_bessel(u, width, beta):
+    # u       distance to kernel centre (grid units)
+    # width   kernel width (grid units)
+    # beta    kernel shape parameter
+    arg = 1 - (2 * np.asarray(u) / width) ** 2
+    return np.where(arg >= 0, np.i0(beta * np.sqrt(np.maximum(arg, 0))), 0.)
+
+
+def kaiser_bessel_ft(t, width, beta):
+    # continuous Fourier transform of the Kaiser-Bessel kernel at frequency t (cycles per grid point)
+    z = np.sqrt((np.pi * width * np.asarray(t)) ** 2 - beta ** 2 + 0j)
+    return np.real(width * np.sinc(z / np.pi))
+
+
+@profiled()
+def get_nufft(samples, shape, n_coils=1, density_comp=None, smaps=None, implementation='gpuNUFFT', **kwargs):
+    # factory selecting the NUFFT engine
+    # implementation  'kbnufft': built-in CPU Kaiser-Bessel NUFFT (KBNUFFT)
+    #                 otherwise: passed on to mri.operators.NonCartesianFFT (e.g. 'gpuNUFFT', 'cpu')
+    if implementation == 'kbnufft':
+        return KBNUFFT(samples=samples, shape=shape, n_coils=n_coils, density_comp=density_comp, smaps=smaps, **kwargs)
+    return NonCartesianFFT(samples=samples, shape=shape, n_coils=n_coils, density_comp=density_comp, smaps=smaps,
+                           implementation=implementation, **kwargs)
+
+
+class KBNUFFT():
+    def __init__(self, samples, shape, n_coils=1, density_comp=None, smaps=None, osf=2, kernel_width=4, n_workers=-1):
+        # samples       [M, 2] k-space positions in [-0.5, 0.5)
+        # shape         image shape [Nx, Ny]
+        # n_coils       number of coils
+        # density_comp  density compensation function, [M] or [M, 1] (optional)
+        # smaps         coil sensitivity maps [Nc, Nx, Ny] (optional), if given op/adj_op act on the
+        #               coil-combined image
+        # osf           grid oversampling factor
+        # kernel_width  Kaiser-Bessel kernel width (grid units)
+        # n_workers     number of FFT threads (scipy.fft workers, -1 = all cores)
+        self.samples = np.reshape(np.asarray(samples, dtype=np.float64), (-1, 2))
+        self.shape = tuple(int(s) for s in shape[-2:])
+        self.n_coils = n_coils
+        self.smaps = None if smaps is None else np.asarray(smaps)
+        self.density_comp = None if density_comp is None else np.ravel(np.asarray(density_comp))
+        self.osf = osf
+        self.kernel_width = kernel_width
+        self.n_workers = n_workers
+        self.grid_shape = tuple(int(np.ceil(osf * s)) for s in self.shape)
+        # Beatty et al., IEEE TMI 2005
+        self.beta = np.pi * np.sqrt((kernel_width / osf) ** 2 * (osf - 0.5) ** 2 - 0.8)
+        self.scale = 1 / np.sqrt(np.prod(self.shape))
+
+        self.interp = self._interpolation_matrix()
+        self.interp_h = self.interp.conj().transpose().tocsr()
+        self.deapod = self._deapodization()
+
+    def _interpolation_matrix(self):
+        # sparse [M, Gx*Gy] matrix holding the Kaiser-Bessel weights of all grid neighbours per sample
+        M = np.shape(self.samples)[0]
+        W = int(np.ceil(self.kernel_width))
+        idx, wgt = [], []
+        for d in range(2):
+            u = self.samples[:, d] * self.grid_shape[d]  # grid units
+            j = np.ceil(u - self.kernel_width / 2)[:, np.newaxis] + np.arange(W)[np.newaxis, :]
+            wgt.append(kaiser_bessel(u[:, np.newaxis] - j, self.kernel_width, self.beta))
+            idx.append(np.mod(j, self.grid_shape[d]).astype(np.int64))
+        rows = np.repeat(np.arange(M), W * W)
+        cols = (idx[0][:, :, np.newaxis] * self.grid_shape[1] + idx[1][:, np.newaxis, :]).ravel()
+        vals = (wgt[0][:, :, np.newaxis] * wgt[1][:, np.newaxis, :]).ravel()
+        return coo_matrix((vals, (rows, cols)), shape=(M, np.prod(self.grid_shape))).tocsr()
+
+    def _deapodization(self):
+        # separable roll-off correction for the centred image grid
+        apod = []
+        for d in range(2):
+            t = (np.arange(self.shape[d]) - self.shape[d] // 2) / self.grid_shape[d]
+            apod.append(kaiser_bessel_ft(t, self.kernel_width, self.beta))
+        return self.scale / (apod[0][:, np.newaxis] * apod[1][np.newaxis, :])
+
+    def _grid_index(self):
+        # image pixel n is stored at grid position (n - N/2) mod G
+        return tuple(np.mod(np.arange(s) - s // 2, g) for s, g in zip(self.shape, self.grid_shape))
+
+    def _forward(self, coil_imgs):
+        # coil_imgs [Nc, Nx, Ny] -> [Nc, M]
+        Nc = np.shape(coil_imgs)[0]
+        grid = np.zeros((Nc,) + self.grid_shape, dtype=np.complex128)
+        ix, iy = self._grid_index()
+        grid[:, ix[:, np.newaxis], iy[np.newaxis, :]] = coil_imgs * self.deapod
+        grid = scipy.fft.fft2(grid, axes=(-2, -1), workers=self.n_workers, overwrite_x=True)
+        return (self.interp @ grid.reshape(Nc, -1).T).T
+
+    def _adjoint(self, kspace):
+        # kspace [Nc, M] -> [Nc, Nx, Ny]
+        Nc = np.shape(kspace)[0]
+        if self.density_comp is not None:
+            kspace = kspace * self.density_comp[np.newaxis, :]
+        grid = (self.interp_h @ kspace.T).T.reshape((Nc,) + self.grid_shape)
+        grid = scipy.fft.ifft2(grid, axes=(-2, -1), norm='forward', workers=self.n_workers, overwrite_x=True)
+        ix, iy = self._grid_index()
+        return grid[:, ix[:, np.newaxis], iy[np.newaxis, :]] * self.deapod
+
+    @profiled()
+    def op(self, image):
+        # image     [Nx, Ny] (smaps given or single coil) or [Nc, Nx, Ny]
+        # return:   k-space [Nc, M] ([M] for a single coil without smaps)
+        image = np.asarray(image)
+        dtype = np.result_type(image.dtype, np.complex64)
+        if self.smaps is not None:
+            coil_imgs = self.smaps * image[np.newaxis, ...]
+        else:
+            coil_imgs = np.reshape(image, (-1,) + self.shape)
+        kspace = self._forward(coil_imgs).astype(dtype, copy=False)
+        if self.smaps is None and image.ndim == 2:
+            return kspace[0]
+        return kspace
+
+    @profiled()
+    def adj_op(self, coeffs):
+        # coeffs    k-space [Nc, M] or [M]
+        # return:   coil-combined image [Nx, Ny] (smaps given) or coil images [Nc, Nx, Ny] ([Nx, Ny] for a single coil)
+        coeffs = np.asarray(coeffs)
+        dtype = np.result_type(coeffs.dtype, np.complex64)
+        coil_imgs = self._adjoint(np.reshape(coeffs, (-1, np.shape(self.samples)[0])))
+        if self.smaps is not None:
+            return np.sum(coil_imgs * np.conj(self.smaps), axis=0).astype(dtype, copy=False)
+        if coeffs.ndim == 1:
+            return coil_imgs[0].astype(dtype, copy=False)
+        return coil_imgs.astype(dtype, copy=False)
+
+
+class StackedKBNUFFT():
+    # Several KBNUFFT plans with the same image and grid shape (e.g. one trajectory per cardiac phase) applied in
+    # one call: the oversampled grids of all plans are transformed with one batched FFT, only the sparse
+    # interpolation runs per plan. Coil maps of the plans are not used, op/adj_op act on coil images.
+    def __init__(self, nuffts):
+        # nuffts    list of KBNUFFT plans with the same shape, grid, kernel and number of samples
+        self.nuffts = list(nuffts)
+        ref = self.nuffts[0]
+        for nufft in self.nuffts:
+            if (nufft.shape, nufft.grid_shape, nufft.kernel_width, np.shape(nufft.samples)) != \
+                    (ref.shape, ref.grid_shape, ref.kernel_width, np.shape(ref.samples)):
+                raise ValueError('Stacked NUFFT plans need the same image shape, grid, kernel and number of samples')
+        self.shape = ref.shape
+        self.grid_shape = ref.grid_shape
+        self.deapod = ref.deapod
+        self.n_workers = ref.n_workers
+
+    @profiled()
+    def op(self, coil_imgs):
+        # coil_imgs [P, Nc, Nx, Ny] one stack of coil images per plan
+        # return:   k-space [P, Nc, M]
+        coil_imgs = np.asarray(coil_imgs)
+        P, Nc = np.shape(coil_imgs)[:2]
+        dtype = np.result_type(coil_imgs.dtype, np.complex64)
+        grid = np.zeros((P, Nc) + self.grid_shape, dtype=np.complex128)
+        ix, iy = self.nuffts[0]._grid_index()
+        grid[:, :, ix[:, np.newaxis], iy[np.newaxis, :]] = coil_imgs * self.deapod
+        grid = scipy.fft.fft2(grid, axes=(-2, -1), workers=self.n_workers, overwrite_x=True).reshape(P, Nc, -1)
+        return np.stack([(nufft.interp @ grid[p].T).T for p, nufft in enumerate(self.nuffts)]).astype(dtype, copy=False)
+
+    @profiled()
+    def adj_op(self, kspace):
+        # kspace    [P, Nc, M]
+        # return:   coil images [P, Nc, Nx, Ny]
+        kspace = np.asarray(kspace)
+        P, Nc = np.shape(kspace)[:2]
+        dtype = np.result_type(kspace.dtype, np.complex64)
+        grid = np.empty((P, Nc) + self.grid_shape, dtype=np.complex128)
+        for p, nufft in enumerate(self.nuffts):
+            coeffs = kspace[p] if nufft.density_comp is None else kspace[p] * nufft.density_comp[np.newaxis, :]
+            grid[p] = (nufft.interp_h @ coeffs.T).T.reshape((Nc,) + self.grid_shape)
+        grid = scipy.fft.ifft2(grid, axes=(-2, -1), norm='forward', workers=self.n_workers, overwrite_x=True)
+        ix, iy = self.nuffts[0]._grid_index()
+        return (grid[:, :, ix[:, np.newaxis], iy[np.newaxis, :]] * self.deapod).astype(dtype, copy=False)
+
+
+def _fingerprint(x):
+    # content hash of an array (None allowed), used as cache key component
+    if x is None:
+        return None
+    x = np.ascontiguousarray(x)
+    return (x.shape, x.dtype.str, hashlib.sha1(x.view(np.uint8)).hexdigest())
+
+
+def _plan_nbytes(nufft):
+    # best-effort memory footprint of a NUFFT operator (arrays and sparse matrices it holds)
+    nbytes = 0
+    for value in vars(nufft).values():
+        if issparse(value):
+            value = value.tocsr()
+            nbytes += value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        elif isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+    return nbytes
+
+
+class NUFFTPlanCache():
+    # LRU cache of NUFFT operators keyed by the content of trajectory, DCF and coil maps.
+    # Avoids re-planning the per-state NUFFTs of the Batchelor operators in every CG iteration.
+    def __init__(self, maxsize=32):
+        # maxsize   maximum number of cached operators (least recently used ones are evicted)
+        self.maxsize = maxsize
+        self.plans = OrderedDict()
+        self.states = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, samples, shape, n_coils=1, density_comp=None, smaps=None, implementation='gpuNUFFT', **kwargs):
+        # same arguments as get_nufft, returns a cached operator if available
+        key = (implementation, tuple(np.atleast_1d(shape).tolist()), n_coils, _fingerprint(samples),
+               _fingerprint(density_comp), _fingerprint(smaps), tuple(sorted(kwargs.items())))
+        if key in self.plans:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return self.plans[key]
+        self.misses += 1
+        nufft = get_nufft(samples=samples, shape=shape, n_coils=n_coils, density_comp=density_comp, smaps=smaps,
+                          implementation=implementation, **kwargs)
+        self.plans[key] = nufft
+        while len(self.plans) > self.maxsize:
+            self.plans.popitem(last=False)
+        return nufft
+
+    def get_state(self, t, samples, shape, n_coils=1, density_comp=None, smaps=None, implementation='gpuNUFFT', **kwargs):
+        # operator of motion state t (samples [M, 2, Nt], density_comp [M, 1, Nt]): the plans of all states are looked
+        # up by content once per set of arrays, repeated calls with the same array objects (e.g. every CG iteration)
+        # only compare identities, i.e. the arrays must not be modified in place in between
+        arrays = (samples, density_comp, smaps)
+        key = (implementation, tuple(np.atleast_1d(shape).tolist()), n_coils, tuple(sorted(kwargs.items())))
+        if self.states is None or self.states[1] != key or any(a is not b for a, b in zip(self.states[0], arrays)):
+            plans = [self.get(samples=samples[..., s], shape=shape, n_coils=n_coils,
+                              density_comp=None if density_comp is None else density_comp[..., s], smaps=smaps,
+                              implementation=implementation, **kwargs) for s in range(np.shape(samples)[-1])]
+            self.states = (arrays, key, plans)
+        else:
+            self.hits += 1
+        return self.states[2][t]
+
+    def clear(self):
+        self.plans.clear()
+        self.states = None
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        # cache statistics, nbytes is the (estimated) memory held by the cached operators
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.plans), 'maxsize': self.maxsize,
+                'nbytes': sum(_plan_nbytes(nufft) for nufft in self.plans.values())}
+
+
+# module-wide cache shared by the Batchelor NUFFT operators (see utils.mri)
+nufft_cache = NUFFTPlanCache()
+
+
+# Toeplitz embedding of the normal operator A^H A of the (motion-compensated) radial SENSE model.
+# For a trajectory k with density compensation w, F^H W F is a convolution with the kernel
+#   T(m) = 1/(Nx*Ny) * sum_k w_k * exp(2*pi*i * k . m),  m in [-N+1, N-1]
+# which is precomputed once on a 2x grid and applied with two FFTs (no gridding).
+# The kernel carries the analytic scaling of the KBNUFFT convention (orthonormal forward, DCF in the adjoint),
+# i.e. it matches the right-hand side A^H y of KBNUFFT operators only (other engines scale differently).
+# A single motion state W is supported: A^H A x = W^H sum_c conj(s_c) * (T conv (s_c * W x)).
+# Several motion states are rejected: the Batchelor model sums the k-space of all states, so A^H A contains
+# the cross terms F_t^H D F_t' of different trajectories, which are not convolutions. A per-state kernel
+# sum would drop these terms and converge to a wrong image; the exact NUFFT forward + adjoint is the fallback.
+class ToeplitzNormalOp():
+    def __init__(self, traj, csm, dcf, shape, motions=None, kernel_width=6, n_workers=-1):
+        # traj          trajectory [M, 2] (or [M, 2, 1])
+        # csm           coil sensitivity maps [Nc, Nx, Ny]
+        # dcf           density compensation function [M, 1] (or [M, 1, 1])
+        # shape         image shape [Nx, Ny]
+        # motions       None or one motion state (sparse matrix, [Nx,Ny,2,1] flow or list of one MotionOperator)
+        # kernel_width  Kaiser-Bessel kernel width used to compute the Toeplitz kernels
+        # n_workers     number of FFT threads
+        self.shape = tuple(int(s) for s in shape[-2:])
+        self.csm = np.asarray(csm)
+        self.n_workers = n_workers
+        traj = np.asarray(traj)
+        dcf = np.ones(np.shape(traj)[:1]) if dcf is None else np.asarray(dcf)
+        if traj.ndim == 2:
+            traj = traj[..., np.newaxis]
+            dcf = np.reshape(dcf, (-1, 1, 1))
+        else:
+            dcf = np.reshape(dcf, (np.shape(dcf)[0], 1, -1))
+        if motions is not None and not isinstance(motions, (list, tuple)):
+            motions = get_motion_operators(motions)
+        Nt = max(np.shape(traj)[-1], 0 if motions is None else len(motions))
+        if Nt != 1:
+            raise ValueError('Toeplitz embedding supports a single motion state, the normal operator of %d states '
+                             'has non-convolutional cross terms between the trajectories; use the exact NUFFT '
+                             'forward + adjoint instead (iterativeSENSE: toeplitz=False)' % Nt)
+        self.kernel = self._kernel(traj[..., 0], dcf[..., 0], kernel_width)
+        self.motion = None if motions is None else motions[0]
+
+    def _kernel(self, traj, dcf, kernel_width):
+        # Fourier transform of the circulant embedding of T on the [2Nx, 2Ny] grid
+        Nx, Ny = self.shape
+        nufft = KBNUFFT(traj, (2 * Nx, 2 * Ny), density_comp=dcf, kernel_width=kernel_width, n_workers=self.n_workers)
+        kernel = nufft.adj_op(np.ones(np.shape(nufft.samples)[0], dtype=np.complex128)) * 2 / np.sqrt(Nx * Ny)
+        return scipy.fft.fft2(np.fft.ifftshift(kernel), workers=self.n_workers)
+
+    def _normal(self, image, kernel):
+        # sum_c conj(s_c) * (T conv (s_c * image))
+        Nx, Ny = self.shape
+        coil_imgs = self.csm * image[np.newaxis, ...]
+        coil_imgs = scipy.fft.fft2(coil_imgs, s=(2 * Nx, 2 * Ny), axes=(-2, -1), workers=self.n_workers)
+        coil_imgs = scipy.fft.ifft2(coil_imgs * kernel, axes=(-2, -1), workers=self.n_workers, overwrite_x=True)
+        return np.sum(coil_imgs[:, :Nx, :Ny] * np.conj(self.csm), axis=0)
+
+    @profiled()
+    def __call__(self, image, *constants):
+        # image     [Nx, Ny], additional arguments (CG constants) are ignored
+        image = np.asarray(image)
+        dtype = np.result_type(image.dtype, np.complex64)
+        if self.motion is None:
+            out = self._normal(image, self.kernel)
+        else:
+            out = self.motion.adjoint(self._normal(self.motion.forward(image), self.kernel))
+        return out.astype(dtype, copy=False)
+
+def ndft(image, samples):
+    # direct non-uniform DFT (reference for KBNUFFT, O(N*M))
+    # image     [..., Nx, Ny]
+    # samples   [M, 2] k-space positions in [-0.5, 0.5)
+    # return:   [..., M]
+    Nx, Ny = np.shape(image)[-2:]
+    samples = np.reshape(np.asarray(samples, dtype=np.float64), (-1, 2))
+    ex = np.exp(-2j * np.pi * np.outer(samples[:, 0], np.arange(Nx) - Nx // 2))  # [M, Nx]
+    ey = np.exp(-2j * np.pi * np.outer(samples[:, 1], np.arange(Ny) - Ny // 2))  # [M, Ny]
+    return np.einsum('...xy,mx,my->...m', image, ex, ey, optimize=True) / np.sqrt(Nx * Ny)
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+
+# Opt-in instrumentation of the operators (utils.mri, utils.motioncomp, utils.nufft)
+#
+#   with profile() as prof:
+#       img = iterativeSENSE(...)
+#   print(prof.summary())
+#   prof.dump_chrome_trace('trace.json')  # open in chrome://tracing or https://ui.perfetto.dev
+#
+# Instrumented functions check a single module-level variable when no profiler is active,
+# i.e. the overhead is one additional Python call.
+_active = {'profiler': None}
+
+
+class Profiler():
+    # calls, cumulative (inclusive) wall time and bytes per operator and motion state
+    # trace_memory  measure allocated bytes with tracemalloc (peak above the start of a call, slow),
+    #               otherwise the size of the returned arrays is recorded
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stats = {}
+        self.events = []
+        self.regions = []  # trace_memory: [start bytes, peak bytes] of the open (nested) regions
+        self.t0 = time.perf_counter()
+
+    def record(self, name, start, elapsed, nbytes=0, state=None):
+        key = name if state is None else '%s[state %d]' % (name, state)
+        calls, total, total_bytes = self.stats.get(key, (0, 0.0, 0))
+        self.stats[key] = (calls + 1, total + elapsed, total_bytes + nbytes)
+        self.events.append({'name': key, 'ph': 'X', 'ts': (start - self.t0) * 1e6, 'dur': elapsed * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {'bytes': nbytes}})
+
+    def summary(self):
+        # table sorted by cumulative time
+        lines = ['%-44s %8s %12s %12s %12s' % ('operator', 'calls', 'total [ms]', 'per call [ms]', 'MB')]
+        for key, (calls, total, nbytes) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            lines.append('%-44s %8d %12.2f %12.3f %12.1f' % (key, calls, total * 1e3, total * 1e3 / calls, nbytes / 1024**2))
+        return '\n'.join(lines)
+
+    def dump_chrome_trace(self, filename):
+        # Chrome trace event format (complete events)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def reset(self):
+        self.stats = {}
+        self.events = []
+        self.regions = []
+        self.t0 = time.perf_counter()
+
+
+@contextmanager
+def profile(trace_memory=False, profiler=None):
+    # activate a (new) Profiler for the enclosed block
+    prof = Profiler(trace_memory) if profiler is None else profiler
+    previous = _active['profiler']
+    _active['profiler'] = prof
+    started = prof.trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield prof
+    finally:
+        if started:
+            tracemalloc.stop()
+        _active['profiler'] = previous
+
+
+def get_profiler():
+    return _active['profiler']
+
+
+def output_nbytes(out):
+    # bytes of the returned array(s)
+    if isinstance(out, np.ndarray):
+        return out.nbytes
+    if isinstance(out, (list, tuple)):
+        return sum(output_nbytes(o) for o in out)
+    return 0
+
+
+class _Region():
+    def __init__(self, prof, name, state):
+        self.prof, self.name, self.state = prof, name, state
+
+    def __enter__(self):
+        self.nbytes = 0
+        if self.prof.trace_memory:
+            # the peak reached so far is handed to the enclosing region before the peak is reset (Python >= 3.9),
+            # so nested regions do not hide the peaks of outer ones
+            current, peak = tracemalloc.get_traced_memory()
+            if self.prof.regions:
+                self.prof.regions[-1][1] = max(self.prof.regions[-1][1], peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.prof.regions.append([current, current])
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        if self.prof.trace_memory:
+            start, peak = self.prof.regions.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            self.nbytes = max(peak - start, 0)
+            if self.prof.regions:
+                self.prof.regions[-1][1] = max(self.prof.regions[-1][1], peak)
+        self.prof.record(self.name, self.start, elapsed, self.nbytes, self.state)
+        return False
+
+
+class _NullRegion():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_region = _NullRegion()
+
+
+def region(name, state=None):
+    # context manager timing a code region (e.g. one motion state inside an operator), no-op when disabled
+    prof = _active['profiler']
+    if prof is None:
+        return _null_region
+    return _Region(prof, name, state)
+
+
+def profiled(name=None):
+    # decorator recording calls of an operator (name: default function qualname)
+    def decorate(fun):
+        label = name or fun.__qualname__
+
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            prof = _active['profiler']
+            if prof is None:
+                return fun(*args, **kwargs)
+            with _Region(prof, label, None) as reg:
+                out = fun(*args, **kwargs)
+                reg.nbytes = output_nbytes(out)
+            return out
+        return wrapper
+    return decorate
@@ -1,8 +1,15 @@
+import os
 import numpy as np
+from functools import lru_cache
 #import scipy.io as sio
 #import optopy.gpunufft as op
 #import pysap
 from mri.operators import NonCartesianFFT
+from utils.nufft import get_nufft, nufft_cache, KBNUFFT, StackedKBNUFFT
+from utils.padding import zpad
+
+# rotation between consecutive golden-angle spokes / phases in degrees
+GOLDEN_ANGLE = 180 * 0.618034
 
 
 def get_kpos(n_FE, n_spokes, RadProfOrder, start_angle):
@@ -10,8 +17,10 @@ def get_kpos(n_FE, n_spokes, RadProfOrder, start_angle):
     # n_spokes = number of radial spokes
     # RadProfOrder = string with either "GC" for golden angle or "GC_23deg" for tiny golden angle
     # start_angle = if you want to rotate the trajectory by some amount you can change the start_angle.
+    #               An array of start angles (one per phase) generates all phases at once.
     #
-    # Ouput is kpos containing k-space positions along x and y normalized from -0.5 to +0.5.
+    # Ouput is kpos containing k-space positions along x and y normalized from -0.5 to +0.5,
+    # [2, n_spokes, n_FE] or [phases, 2, n_spokes, n_FE].
 
     # K - space values along each radial spoke
     # delta_kr = 1 / size(Data, 1);
@@ -32,42 +41,36 @@ def get_kpos(n_FE, n_spokes, RadProfOrder, start_angle):
         # Flag indicating that each even radial line is sampled from +k_max to - k_max and each odd line is acquired from -k_max to + k_max
         isalternated = 1
 
-    RadialAngles = RadialAngles + start_angle * np.pi / 180
+    RadialAngles = RadialAngles + np.asarray(start_angle)[..., np.newaxis] * np.pi / 180
 
     # Kpos has to be the same size as the FE, PE and SE dimension of MR.Data
 
     kpos = CalcTraj_2d_radial(rad_pos, RadialAngles, isalternated)
 
-    return np.transpose(kpos, (2, 1, 0))  # tranpose to: _, num_spokes, num_readout
+    return np.swapaxes(kpos, -1, -3)  # tranpose to: (phases,) _, num_spokes, num_readout
 
 
 def CalcTraj_2d_radial(rad_pos, rad_angles, isalternated):
     # Calculate k - space trajectory for a 2D radial acquisition
 
     # rad_pos: K - space points along radial spokes
-    # rad_angles: Angle values for each of the radial lines
+    # rad_angles: Angle values for each of the radial lines, [n_spokes] or [phases, n_spokes]
     # isalternated: Flag indicating that each even radial line is sampled from +k_max to - k_max and each odd line is acquired from -k_max to + k_max
+    # return: kpos [n_FE, n_spokes, 2] or [phases, n_FE, n_spokes, 2]
 
     rad_pos = np.asarray(rad_pos, dtype=np.float32)
-    rad_angles = np.asarray(rad_angles, dtype=np.float32)
-    kpos = np.zeros((np.shape(rad_pos)[0], np.shape(rad_angles)[0], 2))
+    rad_angles = np.asarray(rad_angles, dtype=np.float32)[..., np.newaxis, :]
+    kpos = np.zeros(np.shape(rad_angles)[:-2] + (np.shape(rad_pos)[0], np.shape(rad_angles)[-1], 2))
 
     if isalternated:
-        # Radius from -k_max to + k_max
-        kpos[:, :, :][:, 0:-1:2, :][:, :, 0] = rad_pos[:, np.newaxis] * np.sin(rad_angles[0:-1:2])[:,
-                                                                        np.newaxis].transpose()
-        kpos[:, :, :][:, 0:-1:2, :][:, :, 1] = rad_pos[:, np.newaxis] * np.cos(rad_angles[0:-1:2])[:,
-                                                                        np.newaxis].transpose()
-
-        # Radius from +k_max to - k_max
-        kpos[:, :, :][:, 1:-1:2, :][:, :, 0] = -rad_pos[:, np.newaxis] * np.sin(rad_angles[1:-1:2])[:,
-                                                                         np.newaxis].transpose()
-        kpos[:, :, :][:, 1:-1:2, :][:, :, 1] = -rad_pos[:, np.newaxis] * np.cos(rad_angles[1:-1:2])[:,
-                                                                         np.newaxis].transpose()
+        # Radius from -k_max to + k_max (even lines), from +k_max to - k_max (odd lines), the last line is not assigned
+        sign = np.where(np.arange(np.shape(rad_angles)[-1] - 1) % 2 == 0, 1, -1).astype(np.float32)
+        kpos[..., :-1, 0] = (sign * rad_pos[:, np.newaxis]) * np.sin(rad_angles[..., :-1])
+        kpos[..., :-1, 1] = (sign * rad_pos[:, np.newaxis]) * np.cos(rad_angles[..., :-1])
 
     else:
-        kpos[:, :, 1] = rad_pos[:, np.newaxis] * np.sin(rad_angles)[:, np.newaxis].transpose()
-        kpos[:, :, 0] = rad_pos[:, np.newaxis] * np.cos(rad_angles)[:, np.newaxis].transpose()
+        kpos[..., 1] = rad_pos[:, np.newaxis] * np.sin(rad_angles)
+        kpos[..., 0] = rad_pos[:, np.newaxis] * np.cos(rad_angles)
 
     return kpos
 
@@ -80,138 +83,195 @@ def generateRadialTrajectory(Nread, Nspokes=1, kmax=0.5):
     :return: complex-valued trajectory
     """
     tmp_trajectory = np.linspace(-1, 1, num=Nread, endpoint=False) * kmax
-    trajectory = np.zeros((2, Nread, Nspokes))
-    for n in range(Nspokes):
-        phi = (np.mod(Nspokes, 2) + 1) * np.pi * n / Nspokes
-        kx = np.cos(phi) * tmp_trajectory
-        ky = np.sin(phi) * tmp_trajectory
-        trajectory[0, :, n] = kx
-        trajectory[1, :, n] = ky
+    phi = (np.mod(Nspokes, 2) + 1) * np.pi * np.arange(Nspokes) / Nspokes
+    trajectory = np.stack([np.cos(phi)[np.newaxis, :] * tmp_trajectory[:, np.newaxis],
+                           np.sin(phi)[np.newaxis, :] * tmp_trajectory[:, np.newaxis]])
     return trajectory
     # return trajectory[0] + 1j*trajectory[1]
 
 
 def calc_radial_dcf(kpos, lens):
-    """ This is suboptimal... Room for (a lot of) improvement. """
-    dcf = []
+    # kpos        [phases, 2, num_spokes, num_readout] trajectories of all phases
+    # return:     [phases, 1, num_spokes, num_readout] density compensation, all phases at once
     num_phases, _, num_spokes, num_readout = kpos.shape
-    # num_readout, num_spokes, _ = kpos.shape
-    # num_phases = 1
-    for idx_bin in range(num_phases):
-        dcf_idx = compute_radial_dcf(kpos[idx_bin])
-        # print(np.max(dcf_idx), lens[idx_bin])
-        dcf_idx = dcf_idx * num_readout * np.pi  # dirty hack... / (lens[idx_bin]) * 2 * np.pi # * num_readout #* 2.5 # correct with nyu trick?
-        dcf.append(dcf_idx)
-    dcf = np.ascontiguousarray(dcf)
-
-    return dcf  # / np.max(dcf)
+    dcf = compute_radial_dcf(kpos)
+    dcf = dcf * num_readout * np.pi  # dirty hack... / (lens[idx_bin]) * 2 * np.pi # * num_readout #* 2.5 # correct with nyu trick?
+    return np.ascontiguousarray(dcf)  # / np.max(dcf)
 
 
 def compute_radial_dcf(Kpos):
-    angles = np.degrees(np.arctan2(Kpos[1, ..., 0], Kpos[0, ..., 0])) + 180  # previously [1,...] [0,....]
-    dcf = np.linspace(-0.5, 0.5, Kpos.shape[-1])
-    dcf = np.tile(np.abs(dcf), [Kpos.shape[1], 1])
+    # Kpos        [2, num_spokes, num_readout] or [phases, 2, num_spokes, num_readout]
+    # return:     [1, num_spokes, num_readout] or [phases, 1, num_spokes, num_readout]
+    # ramp filter weighted by the angular gap to the neighbouring spokes (sorted per phase)
+    angles = np.degrees(np.arctan2(Kpos[..., 1, :, 0], Kpos[..., 0, :, 0])) + 180  # previously [1,...] [0,....]
+    dcf = np.abs(np.linspace(-0.5, 0.5, Kpos.shape[-1]))
 
-    idx = np.argsort(angles)
-    sorted_angles = angles[idx]
+    idx = np.argsort(angles, axis=-1)
+    sorted_angles = np.take_along_axis(angles, idx, axis=-1)
 
-    last_angle = sorted_angles[-1]
-    first_angle = sorted_angles[0]
-
-    angle_n = np.insert(sorted_angles[:-1], 0, last_angle - 360)
-    angle_p = np.append(sorted_angles[1:], first_angle + 360)
+    angle_n = np.concatenate((sorted_angles[..., -1:] - 360, sorted_angles[..., :-1]), axis=-1)
+    angle_p = np.concatenate((sorted_angles[..., 1:], sorted_angles[..., :1] + 360), axis=-1)
 
     delta_p = np.abs(angle_p - sorted_angles)
     delta_n = np.abs(angle_n - sorted_angles)
 
     sorted_diff = 0.5 * np.radians(delta_p + delta_n)
     # dcf = np.maximum(dcf, 1e-9)
-    dcf[idx] *= 0.5 * sorted_diff[:, np.newaxis] / np.pi
+    weights = np.empty_like(sorted_diff)
+    np.put_along_axis(weights, idx, 0.5 * sorted_diff / np.pi, axis=-1)
+    dcf = dcf * weights[..., np.newaxis]
 
-    return dcf.reshape((1, *dcf.shape))
+    return dcf[..., np.newaxis, :, :]
 
 
-def prepare_radial(acc, nRead, nSlices=1):
-    """
-    :param acc:         acceleration factor
-    :param nRead:       number of readout steps
-    :param nSlices:     number of slices
-    :return:            radial trajectory, density compensation function
-    """
+def get_n_spokes(nRead, acc=1):
+    # number of spokes of an acc-fold undersampled radial acquisition (Nyquist: pi/2 * nRead)
     nyquist_spokes = np.round(np.pi / 2 * nRead)
-
     if acc > 1:
-        n_spokes = int(np.round(nyquist_spokes / acc))
-    else:
-        n_spokes = int(nyquist_spokes)
-    startangle = 0
-    kpos = get_kpos(nRead, n_spokes, 'golden', startangle)
-    dcf = compute_radial_dcf(kpos)
-    dcf = dcf * nRead * np.pi
+        return int(np.round(nyquist_spokes / acc))
+    return int(nyquist_spokes)
 
-    kpos = np.tile(kpos.reshape(1, -1, nRead * n_spokes), (nSlices, 1, 1))
-    dcf = np.tile(dcf.reshape(1, 1, nRead * n_spokes) / np.max(dcf), (nSlices, 1, 1))
 
-    kpos = np.transpose(kpos[0, ...], (1, 0))
-    #mask_rad = convert_locations_to_mask(kpos, (nRead, nRead))
-    dcf = np.transpose(dcf[0, ...], (1, 0))
+def radial_trajectory(nRead, acc=1, order='golden', start_angle=0, n_phases=1, phase_angle=GOLDEN_ANGLE, cache_dir=None):
+    """
+    Trajectories and density compensation of all phases (e.g. cardiac/respiratory), generated at once.
+    Results are memoized per parameter set and optionally stored in cache_dir, i.e. repeated calls (and jobs
+    sharing cache_dir) skip the trajectory setup.
+    :param nRead:       number of readout steps
+    :param acc:         acceleration factor
+    :param order:       spoke order, see get_kpos ('golden', 'tinygolden', otherwise linear)
+    :param start_angle: rotation of the first phase in degrees
+    :param n_phases:    number of phases
+    :param phase_angle: rotation between consecutive phases in degrees
+    :param cache_dir:   optional directory of the on-disk cache
+    :return:            kpos [n_phases, nRead * n_spokes, 2], dcf [n_phases, nRead * n_spokes, 1] (maximum 1 per phase), read-only
+    """
+    return _radial_trajectory(int(nRead), float(acc), str(order), float(start_angle), int(n_phases), float(phase_angle),
+                              None if cache_dir is None else os.path.abspath(cache_dir))
+
+
+@lru_cache(maxsize=16)
+def _radial_trajectory(nRead, acc, order, start_angle, n_phases, phase_angle, cache_dir):
+    path = None
+    if cache_dir is not None:
+        name = 'radial_%s_N%d_acc%g_start%g_phases%d_rot%g.npz' % (order, nRead, acc, start_angle, n_phases, phase_angle)
+        path = os.path.join(cache_dir, name)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                kpos, dcf = cached['kpos'], cached['dcf']
+            kpos.flags.writeable = False
+            dcf.flags.writeable = False
+            return kpos, dcf
+
+    n_spokes = get_n_spokes(nRead, acc)
+    kpos = get_kpos(nRead, n_spokes, order, start_angle + np.arange(n_phases) * phase_angle)  # phases x 2 x nSpokes x nRO
+    dcf = compute_radial_dcf(kpos) * nRead * np.pi
+    dcf = dcf / np.max(dcf, axis=(1, 2, 3), keepdims=True)
+    kpos = np.ascontiguousarray(np.swapaxes(np.reshape(kpos, (n_phases, 2, nRead * n_spokes)), 1, 2))
+    dcf = np.reshape(dcf, (n_phases, nRead * n_spokes, 1))
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, kpos=kpos, dcf=dcf)
+        os.replace(tmp, path)
+    kpos.flags.writeable = False
+    dcf.flags.writeable = False
     return kpos, dcf
 
 
-def subsample_radial(img_cart, smaps=None, acc=1, cphases=[0]):
-    # return radial subsampled image
-
-    # zero-pad to quadratic FOV
-    maxsize = np.amax(np.shape(img_cart)[0:2])
-    img_cart = zpad(img_cart, (maxsize, maxsize, np.shape(img_cart)[2], np.shape(img_cart)[3])).astype(np.complex64)
-
-    nyquist_spokes = np.round(np.pi / 2 * maxsize)
+def clear_trajectory_cache():
+    # empty the in-memory cache of radial_trajectory (files in cache_dir are kept)
+    _radial_trajectory.cache_clear()
 
-    if acc > 1:
-        n_spokes = int(np.round(nyquist_spokes / acc))
-    else:
-        n_spokes = int(nyquist_spokes)
 
-    golden_angle = 180 * 0.618034
-    if len(np.shape(img_cart) == 4):
+def prepare_radial(acc, nRead, nSlices=1, cache_dir=None):
+    """
+    :param acc:         acceleration factor
+    :param nRead:       number of readout steps
+    :param nSlices:     number of slices
+    :param cache_dir:   optional on-disk trajectory cache, see radial_trajectory
+    :return:            radial trajectory, density compensation function
+    """
+    kpos, dcf = radial_trajectory(nRead, acc, 'golden', 0, cache_dir=cache_dir)
+    #mask_rad = convert_locations_to_mask(kpos, (nRead, nRead))
+    return kpos[0].copy(), dcf[0].copy()
+
+
+def subsample_radial(img_cart, smaps=None, acc=1, cphases=[0], implementation='cpu', cache_dir=None, mode='batched',
+                     output='image'):
+    # return radial subsampled image: A^H A of every selected phase, coil-combined (smaps, otherwise root
+    # sum-of-squares)
+    # img_cart        coil images [X, Y, slices, coils] or cine [X, Y, slices, phases, coils]
+    #                 (e.g. heart_large, layout 'xytc': img_cart[:, :, np.newaxis])
+    # smaps           coil sensitivity maps [X, Y, coils] or [X, Y, slices, coils], None: root sum-of-squares
+    # acc             acceleration factor
+    # cphases         selected phases, each one is sampled with its own (golden-angle rotated) trajectory
+    # implementation  NUFFT engine, see utils.nufft.get_nufft (e.g. 'cpu', 'gpuNUFFT', 'kbnufft')
+    # cache_dir       optional on-disk trajectory cache, see radial_trajectory
+    # mode            'batched': all phases in one operator call (StackedKBNUFFT: one batched grid FFT),
+    #                            implementation='kbnufft' only, other engines run as 'serial'
+    #                 'serial':  one phase after the other
+    #                 The per-phase operators are planned once and shared via the NUFFT plan cache
+    #                 (utils.nufft.nufft_cache), coils and slices of a phase are transformed in one call.
+    # output          'image':  A^H A images, nRO x nRO x nSlices x cPhases
+    #                 'kspace': radial k-space (nufft.op) of the coil images of every phase (former return value),
+    #                           nRO * nSpokes x nSlices x coils x cPhases
+    # return:         see output
+
+    if np.ndim(img_cart) == 4:
         img_cart = img_cart[:, :, :, np.newaxis, :]
 
+    # zero-pad to quadratic FOV
+    maxsize = int(np.amax(np.shape(img_cart)[0:2]))
+    img_cart = zpad(img_cart, (maxsize, maxsize) + np.shape(img_cart)[2:]).astype(np.complex64)
+
     nRO, _, nSlices, n_phases_img, ncoils = np.shape(img_cart)
+    cphases = np.atleast_1d(cphases)
     n_phases = len(cphases)
-    if np.any(np.asarray(cphases) > n_phases_img):
-        raise ValueError
-
-    img = np.transpose(img_cart, (3, 4, 2, 0, 1)).copy().view()  # phase must be first to be c-contiguous
-
-    startangle = 0
-    img_rad = []
-    if smaps is None:
-        csm = np.ones((1, maxsize, maxsize))
-    for ipha in cphases:  # range(n_phases):
-        kpos = get_kpos(maxsize, n_spokes, 'golden', startangle)
-        # kpos = generateRadialTrajectory(int(maxsize), int(n_spokes))
-        # kpos_idx = np.transpose(kpos_idx,(0,2,1))
-
-        # kpos_idx = kpos_idx[np.newaxis, :, :, :]  # phases x 2 x nSpokes x nRO -> required input of dcf
-        # kpos.append(kpos_idx)
-
-        dcf = compute_radial_dcf(kpos)
-        dcf = dcf * nRO * np.pi
-
-        kpos = np.tile(kpos.reshape(1, -1, maxsize * n_spokes), (nSlices, 1, 1))
-        dcf = np.tile(dcf.reshape(1, 1, maxsize * n_spokes) / np.max(dcf), (nSlices, 1, 1))
-
-        # nufft = op.GpuNufft(img_dim=maxsize, osf=1, kernel_width=3, sector_width=5)
-        # nufft.setDcf(dcf.astype(np.float32))  # nBatch x 1 x nRO * nSpokes
-        # nufft.setTraj(kpos.astype(np.float32))  # nBatch x 2 x nRO * nSpokes
-        # nufft.setCsm(csm.astype(np.complex64))  # nCoils x nRO x nRO
-        # out = nufft.adjoint(nufft.forward(img[ipha, ...].astype(np.complex64)))
-        nufft = NonCartesianFFT(samples=kpos, shape=np.shape(img), n_coils=np.shape(csm)[0], density_comp=dcf,
-                                smaps=csm)
-        out = nufft.op(img)
-        img_rad.append(out)
-
-        startangle += golden_angle
+    if np.any(cphases >= n_phases_img) or np.any(cphases < -n_phases_img):
+        raise ValueError('cphases out of range, the image has %d phases' % n_phases_img)
+
+    # phases x coils x slices x nRO x nRO, only the selected phases
+    img = np.ascontiguousarray(np.transpose(img_cart[:, :, :, cphases], (3, 4, 2, 0, 1)))
+    if smaps is not None:
+        smaps = np.asarray(smaps)
+        if np.ndim(smaps) == 3:
+            smaps = smaps[:, :, np.newaxis, :]
+        smaps = zpad(smaps, (maxsize, maxsize) + np.shape(smaps)[2:])
+        csm = np.transpose(smaps, (3, 2, 0, 1))  # coils x slices x nRO x nRO
+
+    # golden-angle trajectories of all phases at once (each phase rotated by the golden angle), memoized
+    kpos_all, dcf_all = radial_trajectory(maxsize, acc, 'golden', 0, n_phases, GOLDEN_ANGLE, cache_dir)
+    plan = dict(shape=[nRO, nRO], n_coils=ncoils * nSlices, implementation=implementation)
+
+    def combine(coil_imgs):
+        # coils x slices x nRO x nRO -> slices x nRO x nRO
+        if smaps is None:
+            return np.sqrt(np.sum(np.abs(coil_imgs) ** 2, 0))
+        return np.sum(coil_imgs * np.conj(csm), 0)
+
+    def subsample(i, nufft):
+        coil_imgs = np.reshape(img[i], (ncoils * nSlices, nRO, nRO))
+        coil_imgs = nufft.adj_op(nufft.op(coil_imgs))
+        return combine(np.reshape(coil_imgs, (ncoils, nSlices, nRO, nRO)))
+
+    if output not in ('image', 'kspace'):
+        raise ValueError('Unknown subsampling output: %s' % output)
+    if mode not in ('batched', 'serial'):
+        raise ValueError('Unknown subsampling mode: %s' % mode)
+    nufft = [nufft_cache.get(samples=kpos_all[i], density_comp=dcf_all[i], **plan) for i in range(n_phases)]
+    if output == 'kspace':
+        kspace = [op.op(np.reshape(img[i], (ncoils * nSlices, nRO, nRO))) for i, op in enumerate(nufft)]
+        kspace = np.reshape(np.ascontiguousarray(kspace), (n_phases, ncoils, nSlices, -1))
+        return np.transpose(kspace, (3, 2, 1, 0))  # nRO * nSpokes x nSlices x coils x cPhases
+    if mode == 'batched' and all(isinstance(op, KBNUFFT) for op in nufft):
+        stacked = StackedKBNUFFT(nufft)
+        coil_imgs = stacked.adj_op(stacked.op(np.reshape(img, (n_phases, ncoils * nSlices, nRO, nRO))))
+        img_rad = [combine(np.reshape(x, (ncoils, nSlices, nRO, nRO))) for x in coil_imgs]
+    else:
+        img_rad = [subsample(i, op) for i, op in enumerate(nufft)]
 
     img_rad = np.transpose(np.ascontiguousarray(img_rad), (2, 3, 1, 0))  # nRO x nRO x nSlices x cPhases
-    return img_rad
\ No newline at end of file
+    return img_rad
@@ -0,0 +1,180 @@
+import numpy as np
+import tensorflow as tf
+from utils.nufft import KBNUFFT
+
+# TensorFlow-native building blocks of the Batchelor layers (utils.mri): pure TF ops, i.e. usable in
+# graph mode / tf.function without NumPy round trips.
+# Conventions as in the NumPy operators: images [batch, Nx, Ny], coil maps [batch, Nx, Ny, Nc],
+# flow fields [batch, Nx, Ny, 2, Nt], masks [batch, Nx, Ny, Nc, Nt].
+
+
+def tf_fft2c(x, axes=(1, 2)):
+    # centered orthonormal 2D FFT along axes (tf.signal.fft2d acts on the two innermost dimensions)
+    return _tf_transform(x, axes, tf.signal.fft2d)
+
+
+def tf_ifft2c(x, axes=(1, 2)):
+    return _tf_transform(x, axes, tf.signal.ifft2d)
+
+
+def _tf_transform(x, axes, fun):
+    rank = len(x.shape)
+    axes = [a % rank for a in axes]
+    perm = [a for a in range(rank) if a not in axes] + axes
+    inv = np.argsort(perm).tolist()
+    y = tf.transpose(x, perm)
+    inner = [rank - 2, rank - 1]
+    y = tf.signal.fftshift(fun(tf.signal.ifftshift(y, axes=inner)), axes=inner)
+    n = tf.cast(tf.shape(y)[-1] * tf.shape(y)[-2], y.dtype.real_dtype)
+    y = y * tf.cast(tf.sqrt(n) if fun is tf.signal.ifft2d else 1 / tf.sqrt(n), y.dtype)
+    return tf.transpose(y, inv)
+
+
+class TFMotionOperator():
+    # Gather/scatter form of the sparse motion matrices (utils.motioncomp.get_sparse_motion_matrix) with the
+    # Jacobian normalization of apply_sparse_motion, built once per flow with TF ops:
+    # forward   y_t[i] = sum_k w_t[i,k] x[idx_t[i,k]] / sum_k w_t[i,k]                 (gather)
+    # adjoint   z_t[j] = sum_{i,k: idx_t[i,k]=j} w_t[i,k] y_t[i] / sum w_t[i,k]        (scatter)
+    def __init__(self, flow):
+        # flow      [batch, Nx, Ny, 2, Nt] flow fields
+        flow = tf.convert_to_tensor(flow)
+        flow = tf.cast(flow, tf.float32)
+        shape = tf.shape(flow)
+        B, Nx, Ny, Nt = shape[0], shape[1], shape[2], shape[4]
+        self.shape = (B, Nx, Ny, Nt)
+        N = Nx * Ny
+        x, y = tf.meshgrid(tf.range(Nx), tf.range(Ny), indexing='ij')
+        x = tf.cast(x, tf.float32)[tf.newaxis, :, :, tf.newaxis]
+        y = tf.cast(y, tf.float32)[tf.newaxis, :, :, tf.newaxis]
+        ux = flow[:, :, :, 0, :]
+        uy = flow[:, :, :, 1, :]
+        x1 = tf.floor(x + ux)
+        y1 = tf.floor(y + uy)
+        wx = ux - tf.floor(ux)
+        wy = uy - tf.floor(uy)
+        idx, wgt = [], []
+        for w, xc, yc in (((1 - wx) * (1 - wy), x1, y1), ((1 - wx) * wy, x1, y1 + 1),
+                          (wx * (1 - wy), x1 + 1, y1), (wx * wy, x1 + 1, y1 + 1)):
+            # null weights outside the FOV and avoid out of FOV indexes
+            nxf, nyf = tf.cast(Nx - 1, tf.float32), tf.cast(Ny - 1, tf.float32)
+            outside = (xc < 0) | (xc > nxf) | (yc < 0) | (yc > nyf)
+            wgt.append(tf.where(outside, tf.zeros_like(w), w))
+            xc = tf.cast(tf.clip_by_value(xc, 0, nxf), tf.int32)
+            yc = tf.cast(tf.clip_by_value(yc, 0, nyf), tf.int32)
+            idx.append(xc * Ny + yc)  # C-order linear index, consistent with tf.reshape
+        # [B, Nt, N, 4]
+        self.idx = tf.reshape(tf.transpose(tf.stack(idx, -1), [0, 3, 1, 2, 4]), [B, Nt, N, 4])
+        self.wgt = tf.reshape(tf.transpose(tf.stack(wgt, -1), [0, 3, 1, 2, 4]), [B, Nt, N, 4])
+        # correction pertaining to errors in discrete interpolations with large jacobians (zero where nothing contributes)
+        self.norm_fwd = tf.math.divide_no_nan(1., tf.reduce_sum(self.wgt, -1))
+        # global segment ids (batch, state, pixel) for the scatter of the adjoint
+        offset = tf.reshape(tf.range(B * Nt) * N, [B, Nt, 1, 1])
+        self.segments = tf.reshape(self.idx + offset, [-1])
+        norm_adj = tf.math.unsorted_segment_sum(tf.reshape(self.wgt, [-1]), self.segments, B * Nt * N)
+        self.norm_adj = tf.reshape(tf.math.divide_no_nan(1., norm_adj), [B, Nt, N])
+
+    def forward(self, image):
+        # image     [batch, Nx, Ny]
+        # return:   [batch, Nx, Ny, Nt] image warped into every motion state
+        B, Nx, Ny, Nt = self.shape
+        flat = tf.reshape(image, [B, 1, Nx * Ny])
+        flat = tf.broadcast_to(flat, [B, Nt, Nx * Ny])
+        vals = tf.gather(flat, self.idx, batch_dims=2)  # [B, Nt, N, 4]
+        out = tf.reduce_sum(vals * tf.cast(self.wgt, vals.dtype), -1) * tf.cast(self.norm_fwd, vals.dtype)
+        return tf.transpose(tf.reshape(out, [B, Nt, Nx, Ny]), [0, 2, 3, 1])
+
+    def adjoint(self, images):
+        # images    [batch, Nx, Ny, Nt] one image per motion state
+        # return:   [batch, Nx, Ny, Nt] images warped back to the reference state (sum over Nt for A^H)
+        B, Nx, Ny, Nt = self.shape
+        flat = tf.reshape(tf.transpose(images, [0, 3, 1, 2]), [B, Nt, Nx * Ny, 1])
+        vals = flat * tf.cast(self.wgt, flat.dtype)
+        out = tf.math.unsorted_segment_sum(tf.reshape(vals, [-1]), self.segments, B * Nt * Nx * Ny)
+        out = tf.reshape(out, [B, Nt, Nx * Ny]) * tf.cast(self.norm_adj, out.dtype)
+        return tf.transpose(tf.reshape(out, [B, Nt, Nx, Ny]), [0, 2, 3, 1])
+
+
+class TFMotionCache():
+    # one TFMotionOperator per flow tensor: repeated calls with the same tensor object (e.g. every
+    # iteration of the data-consistency solver, in eager mode or within one tf.function trace) reuse it
+    def __init__(self):
+        self.flow = None
+        self.op = None
+
+    def get(self, flow):
+        if flow is not self.flow:
+            self.op = TFMotionOperator(flow)
+            self.flow = flow
+        return self.op
+
+
+def batchelor_forward(image, mask, smaps, motion):
+    # image [B, Nx, Ny], mask [B, Nx, Ny, Nc, Nt], smaps [B, Nx, Ny, Nc] -> k-space [B, Nx, Ny, Nc]
+    warped = motion.forward(tf.cast(image, smaps.dtype))  # [B, Nx, Ny, Nt]
+    coil_imgs = smaps[..., tf.newaxis] * warped[:, :, :, tf.newaxis, :]
+    kspace = tf_fft2c(coil_imgs, axes=(1, 2))
+    return tf.reduce_sum(kspace * tf.cast(mask, kspace.dtype), -1)
+
+
+def batchelor_adjoint(kspace, mask, smaps, motion):
+    # kspace [B, Nx, Ny, Nc], mask [B, Nx, Ny, Nc, Nt], smaps [B, Nx, Ny, Nc] -> image [B, Nx, Ny]
+    coil_imgs = tf_ifft2c(kspace[..., tf.newaxis] * tf.cast(mask, kspace.dtype), axes=(1, 2))
+    images = tf.reduce_sum(coil_imgs * tf.math.conj(smaps)[..., tf.newaxis], 3)  # [B, Nx, Ny, Nt]
+    return tf.reduce_sum(motion.adjoint(images), -1)
+
+
+class TFKBNUFFT():
+    # TensorFlow version of utils.nufft.KBNUFFT (same grid, kernel and scaling): the interpolation matrix is a
+    # tf.SparseTensor built once, the oversampled FFTs use tf.signal.fft2d
+    def __init__(self, nufft, dtype=tf.complex64):
+        # nufft     KBNUFFT instance (plan)
+        self.shape = nufft.shape
+        self.grid_shape = nufft.grid_shape
+        interp = nufft.interp.tocoo()
+        order = np.lexsort((interp.col, interp.row))
+        self.interp = tf.SparseTensor(np.stack([interp.row[order], interp.col[order]], 1).astype(np.int64),
+                                      tf.constant(interp.data[order], dtype=dtype), interp.shape)
+        self.deapod = tf.constant(nufft.deapod, dtype=dtype)
+        self.smaps = None if nufft.smaps is None else tf.constant(nufft.smaps, dtype=dtype)
+        self.dcf = None if nufft.density_comp is None else tf.constant(nufft.density_comp, dtype=dtype)
+        self.dtype = dtype
+
+    def _to_grid(self, coil_imgs):
+        # image pixel n is stored at grid position (n - N/2) mod G
+        (Nx, Ny), (Gx, Gy) = self.shape, self.grid_shape
+        grid = tf.pad(coil_imgs, [[0, 0], [0, Gx - Nx], [0, Gy - Ny]])
+        return tf.roll(grid, shift=[-(Nx // 2), -(Ny // 2)], axis=[1, 2])
+
+    def _from_grid(self, grid):
+        (Nx, Ny) = self.shape
+        grid = tf.roll(grid, shift=[Nx // 2, Ny // 2], axis=[1, 2])
+        return grid[:, :Nx, :Ny]
+
+    def op(self, image):
+        # image [Nx, Ny] -> k-space [Nc, M]
+        image = tf.cast(image, self.dtype)
+        coil_imgs = self.smaps * image[tf.newaxis] if self.smaps is not None else image[tf.newaxis]
+        grid = tf.signal.fft2d(self._to_grid(coil_imgs * self.deapod))
+        Nc = tf.shape(grid)[0]
+        kspace = tf.sparse.sparse_dense_matmul(self.interp, tf.transpose(tf.reshape(grid, [Nc, -1])))
+        return tf.transpose(kspace)
+
+    def adj_op(self, kspace):
+        # k-space [Nc, M] -> coil-combined image [Nx, Ny] (coil images [Nc, Nx, Ny] without smaps)
+        kspace = tf.cast(tf.reshape(kspace, [-1, self.interp.shape[0]]), self.dtype)
+        if self.dcf is not None:
+            kspace = kspace * self.dcf[tf.newaxis, :]
+        grid = tf.sparse.sparse_dense_matmul(self.interp, tf.transpose(kspace), adjoint_a=True)
+        grid = tf.reshape(tf.transpose(grid), [-1, self.grid_shape[0], self.grid_shape[1]])
+        grid = tf.signal.ifft2d(grid) * tf.cast(np.prod(self.grid_shape), self.dtype)
+        coil_imgs = self._from_grid(grid) * self.deapod
+        if self.smaps is not None:
+            return tf.reduce_sum(coil_imgs * tf.math.conj(self.smaps), 0)
+        return coil_imgs
+
+
+def tf_nufft(nufft):
+    # TF-native operator for a KBNUFFT plan, None for other engines (handled via tf.numpy_function)
+    if isinstance(nufft, KBNUFFT):
+        return TFKBNUFFT(nufft)
+    return None